@@ -0,0 +1,418 @@
+import os
+import numpy
+import h5py
+from scipy import ndimage, sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from boxkit.library import Action
+
+import CommonModule
+
+# Flash-X node type of leaf blocks, only leaf blocks are used by
+# the kernels since parent blocks hold restricted copies of them
+LEAF_NODE = 1
+
+def read_layout(filename):
+    """
+    Read layout of leaf blocks from plotfile header. Every block carries
+    bounding box, refinement level, cell size and cell volume, which is
+    the weight of its cells so that blocks at mixed levels can be reduced
+    """
+    with h5py.File(filename, "r") as h5file:
+        tags = numpy.flatnonzero(h5file["node type"][:] == LEAF_NODE)
+        bounds = h5file["bounding box"][:][tags]
+        level = h5file["refine level"][:][tags]
+        varkey = h5file["unknown names"][0][0].decode().strip()
+        nzb, nyb, nxb = h5file[varkey].shape[1:]
+
+    ncells = numpy.array([nxb, nyb, nzb])
+    cellsize = (bounds[:, :, 1] - bounds[:, :, 0])/ncells
+
+    return {"time": CommonModule.plotfile_time(filename), "tags": tags, "bounds": bounds, "level": level,
+            "cellsize": cellsize, "volume": numpy.prod(numpy.where(ncells > 1, cellsize, 1.), axis=1),
+            "shape": (int(nzb), int(nyb), int(nxb)), "ndim": int(numpy.count_nonzero(ncells > 1))}
+
+def read_blocks(h5file, varkey, layout, positions):
+    """
+    Read leaf blocks at positions of the layout for a variable
+    """
+    return numpy.asarray(h5file[varkey][layout["tags"][positions]], dtype=float)
+
+def cell_centers(layout, positions):
+    """
+    Get x, y and z cell centers of blocks at positions of the layout,
+    broadcastable to block data of shape (nblocks, nzb, nyb, nxb)
+    """
+    nzb, nyb, nxb = layout["shape"]
+    lower = layout["bounds"][positions, :, 0, None, None, None]
+    cellsize = layout["cellsize"][positions, :, None, None, None]
+
+    return (lower[:, 0] + (numpy.arange(nxb) + 0.5)[None, None, None, :]*cellsize[:, 0],
+            lower[:, 1] + (numpy.arange(nyb) + 0.5)[None, None, :, None]*cellsize[:, 1],
+            lower[:, 2] + (numpy.arange(nzb) + 0.5)[None, :, None, None]*cellsize[:, 2])
+
+def block_batches(positions, batch_size):
+    """
+    Split positions of leaf blocks into batches of batch_size
+    """
+    return [positions[index:index+batch_size] for index in range(0, len(positions), batch_size)]
+
+def map_batches(kernel, filename, layout, *args, positions=None, batch_size=64, nthreads=1, backend="loky"):
+    """
+    Apply kernel(batch, filename, layout, *args) to batches of leaf blocks on
+    a pool of nthreads workers. Every worker reads only the blocks of its
+    batch, so memory is bounded by batch_size blocks per worker
+    """
+    positions = numpy.arange(len(layout["tags"])) if positions is None else numpy.asarray(positions)
+    batches = block_batches(positions, batch_size)
+
+    if not batches:
+        return []
+
+    return Action(kernel, nthreads=nthreads, backend=backend)(batches, filename, layout, *args)
+
+def smooth_heaviside(phi, eps):
+    """
+    Smoothed Heaviside and delta functions of a level-set with half-width eps
+    """
+    ratio = numpy.clip(phi/eps, -1., 1.)
+    inside = numpy.abs(phi) < eps
+
+    heaviside = 0.5*(1 + ratio + numpy.sin(numpy.pi*ratio)/numpy.pi)
+    delta = numpy.where(inside, 0.5*(1 + numpy.cos(numpy.pi*ratio))/eps, 0.)
+
+    return heaviside, delta
+
+def lset_batch(batch, filename, layout):
+    """
+    Get volume, interface area, first moments and velocity integrals of the
+    region dfun >= 0 for a batch of blocks. Gradients are computed inside
+    every block with one sided differences at block faces
+    """
+    with CommonModule.profile_stage("lset_batch", filename):
+        with h5py.File(filename, "r") as h5file:
+            dfun = read_blocks(h5file, "dfun", layout, batch)
+            velocity = [read_blocks(h5file, varkey, layout, batch) if varkey in h5file else numpy.zeros_like(dfun)
+                        for varkey in ["velx", "vely", "velz"]]
+
+        cellsize = layout["cellsize"][batch]
+        volume = layout["volume"][batch][:, None, None, None]
+        eps = 1.5*numpy.where(cellsize > 0, cellsize, numpy.inf).min(axis=1)[:, None, None, None]
+
+        gradient = numpy.zeros_like(dfun)
+        for axis, direction in [(3, 0), (2, 1), (1, 2)]:
+            if dfun.shape[axis] > 1:
+                gradient += (numpy.gradient(dfun, axis=axis)/cellsize[:, direction, None, None, None])**2
+
+        heaviside, delta = smooth_heaviside(dfun, eps)
+        weight = heaviside*volume
+
+        return numpy.array([weight.sum(), (delta*numpy.sqrt(gradient)*volume).sum(),
+                            *[(weight*center).sum() for center in cell_centers(layout, batch)],
+                            *[(weight*value).sum() for value in velocity]])
+
+def lset_measures(filename, batch_size=64, nthreads=1, backend="loky"):
+    """
+    Measure region dfun >= 0 on leaf blocks of a plotfile at any mix of
+    refinement levels and in 2D or 3D. Returns dictionary with time,
+    volume (area in 2D), interface area (perimeter in 2D), circularity
+    (sphericity in 3D), centroid and mean velocity, summed over all bubbles
+    """
+    layout = read_layout(filename)
+    partials = map_batches(lset_batch, filename, layout, batch_size=batch_size, nthreads=nthreads, backend=backend)
+    total = numpy.sum(partials, axis=0) if partials else numpy.zeros(8)
+
+    volume, interface = total[0], total[1]
+
+    if layout["ndim"] == 2:
+        circularity = 2*numpy.sqrt(numpy.pi*volume)/interface if interface > 0 else 0.
+    else:
+        circularity = numpy.pi**(1/3)*(6*volume)**(2/3)/interface if interface > 0 else 0.
+
+    return {"time": layout["time"], "volume": volume, "interface": interface, "circularity": circularity,
+            "centroid": total[2:5]/volume if volume > 0 else numpy.zeros(3),
+            "velocity": total[5:8]/volume if volume > 0 else numpy.zeros(3)}
+
+def regions_batch(batch, filename, layout):
+    """
+    Label region dfun >= 0 inside every block of a batch with full
+    connectivity. Returns for every block the volume and the center of
+    the first cell of every label, as well as centers and labels of
+    cells on block faces, which connect labels across blocks
+    """
+    with CommonModule.profile_stage("regions_batch", filename):
+        with h5py.File(filename, "r") as h5file:
+            dfun = read_blocks(h5file, "dfun", layout, batch)
+
+        centers = numpy.stack(numpy.broadcast_arrays(*cell_centers(layout, batch)), axis=-1)
+
+        face = numpy.zeros(layout["shape"], dtype=bool)
+        for axis, size in enumerate(layout["shape"]):
+            if size > 1:
+                face[(slice(None),)*axis + ([0, -1],)] = True
+
+        blocks = []
+        for index, position in enumerate(batch):
+            labels, nlabels = ndimage.label(dfun[index] >= 0, structure=numpy.ones((3, 3, 3)))
+            values, first = numpy.unique(labels.ravel(), return_index=True)
+            boundary = face & (labels > 0)
+
+            blocks.append((numpy.bincount(labels.ravel(), minlength=nlabels+1)[1:]*layout["volume"][position],
+                           centers[index].reshape(-1, 3)[first[values > 0]],
+                           centers[index][boundary], labels[boundary]-1))
+
+        return blocks
+
+def lset_regions(filename, batch_size=64, nthreads=1, backend="loky"):
+    """
+    Measure connected regions dfun >= 0 on leaf blocks of a plotfile at any
+    mix of refinement levels. Labels of every block are joined where cells
+    on faces of neighbouring blocks touch. Regions are ordered by their
+    first cell in z, y, x order like scipy.ndimage.label on the merged
+    grid, so on uniform grids region 0 is the first region of
+    boxkit.regionprops. Returns dictionary with time and volume (area
+    in 2D) of every region
+    """
+    layout = read_layout(filename)
+    blocks = [block for partial in map_batches(regions_batch, filename, layout, batch_size=batch_size,
+                                               nthreads=nthreads, backend=backend) for block in partial]
+
+    offsets = numpy.cumsum([0] + [len(volume) for volume, *_ in blocks])
+    if not offsets[-1]:
+        return {"time": layout["time"], "volume": numpy.zeros(0)}
+
+    volume = numpy.concatenate([block[0] for block in blocks])
+    first = numpy.concatenate([block[1] for block in blocks])
+    centers = numpy.concatenate([block[2] for block in blocks])
+    labels = numpy.concatenate([block[3] + offset for block, offset in zip(blocks, offsets)])
+    cellsize = numpy.repeat(layout["cellsize"], [len(block[3]) for block in blocks], axis=0)
+
+    # cells of neighbouring blocks touch if their centers are at most
+    # half the sum of their sizes apart along every direction
+    pairs = cKDTree(centers).query_pairs(1.25*cellsize.max(), p=numpy.inf, output_type="ndarray")
+    left, right = pairs[:, 0], pairs[:, 1]
+    touch = numpy.all(numpy.abs(centers[left]-centers[right]) <= 0.5*(cellsize[left]+cellsize[right])
+                      + 0.25*numpy.minimum(cellsize[left], cellsize[right]), axis=1)
+
+    graph = sparse.coo_matrix((numpy.ones(numpy.count_nonzero(touch)), (labels[left[touch]], labels[right[touch]])),
+                              shape=(offsets[-1], offsets[-1]))
+    component = connected_components(graph, directed=False)[1]
+
+    # order labels by first cell on a quarter of the finest cell size,
+    # so that centers of the same row in different blocks compare equal
+    finest = numpy.where(layout["cellsize"] > 0, layout["cellsize"], numpy.inf).min(axis=0)
+    key = numpy.rint(first/(0.25*numpy.where(numpy.isfinite(finest), finest, 1.)))
+    ordered = component[numpy.lexsort(key.T)]
+    order = ordered[numpy.sort(numpy.unique(ordered, return_index=True)[1])]
+
+    return {"time": layout["time"], "volume": numpy.bincount(component, weights=volume)[order]}
+
+def heat_flux_batch(batch, filename, layout, yloc):
+    """
+    Get wall heat flux and liquid fraction integrals over the cells
+    nearest to yloc for a batch of blocks that contain yloc
+    """
+    with CommonModule.profile_stage("heat_flux_batch", filename):
+        with h5py.File(filename, "r") as h5file:
+            dfun = read_blocks(h5file, "dfun", layout, batch)
+            temp = read_blocks(h5file, "temp", layout, batch)
+
+        cellsize = layout["cellsize"][batch]
+        yindex = numpy.abs(cell_centers(layout, batch)[1][:, 0, :, 0] - yloc).argmin(axis=1)
+        rows = numpy.arange(len(batch))
+
+        liquid = dfun[rows, :, yindex, :] < 0
+        flux = liquid*(1 - temp[rows, :, yindex, :])/(0.5*cellsize[:, 1, None, None])
+        area = (layout["volume"][batch]/cellsize[:, 1])[:, None, None]
+
+        return numpy.array([(flux*area).sum(), (liquid*area).sum()])
+
+def wall_heat_flux(filename, yloc=0.0, batch_size=64, nthreads=1, backend="loky"):
+    """
+    Get mean wall heat flux over the liquid covered part of the wall at yloc,
+    with every wall cell weighted by its face area at its own level. Only
+    blocks with ymin <= yloc < ymax are read
+    """
+    layout = read_layout(filename)
+    positions = numpy.flatnonzero((layout["bounds"][:, 1, 0] <= yloc) & (yloc < layout["bounds"][:, 1, 1]))
+
+    partials = map_batches(heat_flux_batch, filename, layout, yloc, positions=positions,
+                           batch_size=batch_size, nthreads=nthreads, backend=backend)
+    total = numpy.sum(partials, axis=0) if partials else numpy.zeros(2)
+
+    return total[0]/total[1] if total[1] > 0 else 0.
+
+def restrict_block(data, factors):
+    """
+    Restrict block data of shape (nz, ny, nx) by averaging
+    over factors (fz, fy, fx) cells in every direction
+    """
+    if any(size % factor for size, factor in zip(data.shape, factors)):
+        raise ValueError(f"[AMRModule.restrict_block] Shape {data.shape} not divisible by {factors}")
+
+    (nz, ny, nx), (fz, fy, fx) = data.shape, factors
+
+    return data.reshape(nz//fz, fz, ny//fy, fy, nx//fx, fx).mean(axis=(1, 3, 5))
+
+def overlap_region(lower, upper, block_lower, cellsize, ncells):
+    """
+    Get slices of a block covering the box between lower and upper
+    """
+    start = numpy.rint((lower - block_lower)/numpy.where(cellsize > 0, cellsize, 1.)).astype(int)
+    stop = numpy.rint((upper - block_lower)/numpy.where(cellsize > 0, cellsize, 1.)).astype(int)
+    stop = numpy.where(ncells > 1, stop, 1)
+    start = numpy.where(ncells > 1, start, 0)
+
+    return tuple(slice(start[axis], stop[axis]) for axis in [2, 1, 0])
+
+def norms_batch(batch, filename, layout, reference, reference_layout, varlist):
+    """
+    Get integrals of absolute and squared differences and the maximum
+    difference between a batch of blocks and overlapping leaf blocks of the
+    reference. Every overlap is compared on the coarser of the two grids
+    """
+    with CommonModule.profile_stage("norms_batch", filename):
+        lower, upper = reference_layout["bounds"][:, :, 0], reference_layout["bounds"][:, :, 1]
+        ncells = numpy.array(layout["shape"][::-1])
+
+        pairs = []
+        for position in batch:
+            tolerance = 0.25*layout["cellsize"][position]
+            overlap = numpy.all((lower < layout["bounds"][position, :, 1] - tolerance) &
+                                (upper > layout["bounds"][position, :, 0] + tolerance) | (ncells == 1), axis=1)
+            pairs.extend((position, other) for other in numpy.flatnonzero(overlap))
+
+        others = numpy.unique([other for _, other in pairs]).astype(int)
+        norms = numpy.zeros((len(varlist), 3))
+
+        with h5py.File(filename, "r") as h5file, h5py.File(reference, "r") as reference_file:
+            for index, varkey in enumerate(varlist):
+                data = dict(zip(batch, read_blocks(h5file, varkey, layout, batch)))
+                reference_data = dict(zip(others, read_blocks(reference_file, varkey, reference_layout, others)))
+
+                for position, other in pairs:
+                    box_lower = numpy.maximum(layout["bounds"][position, :, 0], lower[other])
+                    box_upper = numpy.minimum(layout["bounds"][position, :, 1], upper[other])
+                    cellsize = numpy.maximum(layout["cellsize"][position], reference_layout["cellsize"][other])
+
+                    values = []
+                    for block_data, block_layout, block in [(data[position], layout, position),
+                                                            (reference_data[other], reference_layout, other)]:
+                        region = block_data[overlap_region(box_lower, box_upper, block_layout["bounds"][block, :, 0],
+                                                           block_layout["cellsize"][block], ncells)]
+                        factors = [int(round(cellsize[axis]/block_layout["cellsize"][block, axis]))
+                                   if ncells[axis] > 1 else 1 for axis in [2, 1, 0]]
+                        values.append(restrict_block(region, factors))
+
+                    error = numpy.abs(values[0] - values[1])
+                    weight = numpy.prod(numpy.where(ncells > 1, cellsize, 1.))
+
+                    norms[index, 0] += error.sum()*weight
+                    norms[index, 1] += (error**2).sum()*weight
+                    norms[index, 2] = max(norms[index, 2], error.max(initial=0.))
+
+        return norms
+
+def compute_norms(filename, reference, varlist=None, batch_size=64, nthreads=1, backend="loky"):
+    """
+    Compute L1, L2 and Linf norms of the difference between two plotfiles of
+    the same domain at any refinement, comparing overlapping leaf blocks on
+    the coarser grid without merging either plotfile. L1 and L2 are integral
+    norms weighted by cell volume, unlike the cell sums of LocalModule
+    """
+    varlist = varlist or ["dfun", "velx", "vely"]
+    layout, reference_layout = read_layout(filename), read_layout(reference)
+
+    partials = map_batches(norms_batch, filename, layout, reference, reference_layout, varlist,
+                           batch_size=batch_size, nthreads=nthreads, backend=backend)
+    total = numpy.zeros((len(varlist), 3))
+
+    for partial in partials:
+        total[:, :2] += partial[:, :2]
+        total[:, 2] = numpy.maximum(total[:, 2], partial[:, 2])
+
+    return {varkey: {"L1": float(total[index, 0]), "L2": float(numpy.sqrt(total[index, 1])),
+                     "Linf": float(total[index, 2])} for index, varkey in enumerate(varlist)}
+
+def moments_batch(batch, filelist, layout, varlist, pairs):
+    """
+    Get mean, M2 and co-moments of a batch of blocks over every plotfile
+    in filelist with the single pass update of Welford
+    """
+    with CommonModule.profile_stage("moments_batch"):
+        moments = {}
+
+        for count, filename in enumerate(filelist, start=1):
+            with h5py.File(filename, "r") as h5file:
+                sample = {varkey: read_blocks(h5file, varkey, layout, batch) for varkey in varlist}
+
+            if count == 1:
+                moments = {**{varkey+"_mean": sample[varkey] for varkey in varlist},
+                           **{varkey+"_m2": numpy.zeros_like(sample[varkey]) for varkey in varlist},
+                           **{name: numpy.zeros_like(sample[varlist[0]]) for name in pairs}}
+                continue
+
+            delta = {varkey: sample[varkey] - moments[varkey+"_mean"] for varkey in varlist}
+
+            for varkey in varlist:
+                moments[varkey+"_mean"] += delta[varkey]/count
+
+            for name, (first, second) in pairs.items():
+                moments[name] += delta[first]*(sample[second] - moments[second+"_mean"])
+
+            for varkey in varlist:
+                moments[varkey+"_m2"] += delta[varkey]*(sample[varkey] - moments[varkey+"_mean"])
+
+        return moments
+
+def temporal_moments(filelist, output, varlist, pairs=None, batch_size=64, nthreads=1, backend="loky"):
+    """
+    Compute mean, variance as <varkey>_fluc and covariance for every name in
+    pairs of name to (varkey, varkey) across plotfiles with the same leaf
+    blocks, at any mix of refinement levels. Batches of blocks are streamed
+    through all plotfiles and written to output, a plotfile with the layout
+    of the first plotfile, so memory is bounded by nthreads batches
+    """
+    pairs = pairs or {}
+    layout = read_layout(filelist[0])
+
+    for filename in filelist[1:]:
+        other = read_layout(filename)
+        if not (numpy.array_equal(other["tags"], layout["tags"]) and numpy.allclose(other["bounds"], layout["bounds"])):
+            raise ValueError(f"[AMRModule.temporal_moments] Leaf blocks of {filename} differ from {filelist[0]}")
+
+    statlist = [varkey+"_mean" for varkey in varlist] + [varkey+"_fluc" for varkey in varlist] + list(pairs)
+
+    with h5py.File(filelist[0], "r") as h5file, h5py.File(output + ".tmp", "w") as outfile:
+        unknowns = [name[0].decode().strip() for name in h5file["unknown names"][:]]
+        for key in h5file:
+            if key not in unknowns and key != "unknown names":
+                h5file.copy(key, outfile)
+
+        outfile["unknown names"] = numpy.array([[name.encode()] for name in statlist])
+        for name in statlist:
+            outfile.create_dataset(name, shape=h5file[unknowns[0]].shape, dtype=float)
+
+        positions = numpy.arange(len(layout["tags"]))
+        batches = block_batches(positions, batch_size)
+
+        for group in block_batches(batches, nthreads):
+            for batch, moments in zip(group, Action(moments_batch, nthreads=nthreads, backend=backend)(
+                    group, filelist, layout, varlist, pairs)):
+
+                tags = layout["tags"][batch]
+                for varkey in varlist:
+                    outfile[varkey+"_mean"][tags] = moments[varkey+"_mean"]
+                    outfile[varkey+"_fluc"][tags] = moments[varkey+"_m2"]/len(filelist)
+                for name in pairs:
+                    outfile[name][tags] = moments[name]/len(filelist)
+
+    os.replace(output + ".tmp", output)
+
+    return output
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
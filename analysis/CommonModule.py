@@ -0,0 +1,568 @@
+import os
+import io
+import glob
+import json
+import time
+import resource
+import threading
+import contextlib
+import sqlite3
+import tempfile
+import warnings
+import h5py
+import numpy
+from scipy.interpolate import make_interp_spline
+import boxkit
+from boxkit.library import Action
+
+CACHE_FILENAME = ".analysis_cache.sqlite"
+HEADER_KEYS = ["time", "nblocks", "nxb", "nyb", "nzb", "level_min", "level_max",
+               "xmin", "xmax", "ymin", "ymax", "zmin", "zmax"]
+
+# Environment variable with directory for profiling output, profiling
+# is disabled when it is not set. Pool workers inherit it from the parent
+PROFILE_ENV = "ANALYSIS_PROFILE"
+
+def file_fingerprint(filename):
+    """
+    Get fingerprint (mtime, size) of a file
+    """
+    stat = os.stat(filename)
+    return int(stat.st_mtime_ns), int(stat.st_size)
+
+def open_cache(dataset_dir):
+    """
+    Open result cache for an archive directory
+    """
+    connection = sqlite3.connect(os.path.join(dataset_dir, CACHE_FILENAME), timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS results (filename TEXT, label TEXT, version TEXT, "
+                       + "mtime INTEGER, size INTEGER, value BLOB, PRIMARY KEY (filename, label))")
+    return connection
+
+def encode_array(value):
+    """
+    Serialize array to bytes
+    """
+    buffer = io.BytesIO()
+    numpy.save(buffer, numpy.asarray(value), allow_pickle=False)
+    return buffer.getvalue()
+
+def decode_array(value):
+    """
+    Deserialize array from bytes
+    """
+    return numpy.load(io.BytesIO(value), allow_pickle=False)
+
+def cached_apply(filelist, process_func, version, label=None, nthreads=1, backend="serial"):
+    """
+    Apply process_func to every file in filelist and return list of results.
+
+    Results are stored in one cache file per archive directory keyed by file
+    name, label (defaults to name of process_func) and version. Only files
+    that are new, changed on disk, or processed by a different version of
+    process_func are processed again.
+    """
+    label = label or f"{process_func.__module__}.{process_func.__name__}"
+    version = str(version)
+
+    resultlist = [None] * len(filelist)
+    pending = []
+
+    for dataset_dir in sorted(set(os.path.dirname(os.path.abspath(filename)) for filename in filelist)):
+        try:
+            connection = open_cache(dataset_dir)
+        except sqlite3.OperationalError:
+            connection = None
+
+        for index, filename in enumerate(filelist):
+            if os.path.dirname(os.path.abspath(filename)) != dataset_dir:
+                continue
+
+            if connection is not None:
+                row = connection.execute("SELECT version, mtime, size, value FROM results "
+                                         + "WHERE filename=? AND label=?",
+                                         (os.path.basename(filename), label)).fetchone()
+
+                if row and row[:3] == (version, *file_fingerprint(filename)):
+                    resultlist[index] = decode_array(row[3])
+                    continue
+
+            pending.append(index)
+
+        if connection is not None:
+            connection.close()
+
+    if not pending:
+        return resultlist
+
+    with profile_stage("cached_apply"):
+        newlist = Action(process_func, nthreads=nthreads, backend=backend)([filelist[index] for index in pending])
+
+    for index, value in zip(pending, newlist):
+        resultlist[index] = value
+
+    for dataset_dir in sorted(set(os.path.dirname(os.path.abspath(filelist[index])) for index in pending)):
+        try:
+            connection = open_cache(dataset_dir)
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                                       [(os.path.basename(filelist[index]), label, version,
+                                         *file_fingerprint(filelist[index]), encode_array(resultlist[index]))
+                                        for index in pending
+                                        if os.path.dirname(os.path.abspath(filelist[index])) == dataset_dir])
+            connection.close()
+        except sqlite3.OperationalError as error:
+            warnings.warn(f"[CommonModule.cached_apply] Unable to write cache in {dataset_dir}: {error}")
+
+    return resultlist
+
+def plotfile_time(filename):
+    """
+    Read simulation time from plotfile header
+    """
+    with h5py.File(filename, "r") as h5file:
+        for name, value in h5file["real scalars"][:]:
+            if name.decode().strip() == "time":
+                return float(value)
+
+    raise ValueError(f"[CommonModule.plotfile_time] Time not found in {filename}")
+
+def plotfile_tags(dataset_dir, basename):
+    """
+    Get sorted file tags of all plotfiles in a directory
+    """
+    return sorted(int(filename[-4:]) for filename in glob.glob(os.path.join(dataset_dir, basename + "[0-9]"*4)))
+
+def plotfile_times(dataset_dir, basename, file_tags=None):
+    """
+    Get simulation time for file tags, all plotfiles in the directory by default
+    """
+    file_tags = plotfile_tags(dataset_dir, basename) if file_tags is None else list(file_tags)
+    filelist = [os.path.join(dataset_dir, basename + str(tag).zfill(4)) for tag in file_tags]
+
+    return file_tags, numpy.array(cached_apply(filelist, plotfile_time, 1), dtype=float).reshape(-1)
+
+def nearest_file_tags(dataset_dir, basename, times, file_tags=None):
+    """
+    Get file tags with simulation time nearest to each of times
+    """
+    file_tags, tag_times = plotfile_times(dataset_dir, basename, file_tags)
+    index = numpy.abs(tag_times[None, :] - numpy.asarray(times, dtype=float)[:, None]).argmin(axis=1)
+
+    return [file_tags[loc] for loc in index]
+
+def align_series(results, time_base=None, npoints=None, kind="linear"):
+    """
+    Resample series of shape (ntimes, nquant) with time in the first column
+    onto a common time base. By default the time base spans the overlap of
+    all series with as many points as the longest one. kind is linear or cubic,
+    values outside the time range of a series are NaN instead of extrapolated
+    """
+    if kind not in ["linear", "cubic"]:
+        raise ValueError(f"[CommonModule.align_series] Unknown kind {kind}, use linear or cubic")
+
+    if time_base is None:
+        tmin = max(series[:, 0].min() for series in results.values())
+        tmax = min(series[:, 0].max() for series in results.values())
+        npoints = npoints or max(len(series) for series in results.values())
+        time_base = numpy.linspace(tmin, tmax, npoints)
+
+    time_base = numpy.asarray(time_base, dtype=float)
+    degree = {"linear": 1, "cubic": 3}[kind]
+    aligned = {}
+
+    for key, series in results.items():
+        time, index = numpy.unique(series[:, 0], return_index=True)
+
+        if len(time) < degree+1:
+            raise ValueError(f"[CommonModule.align_series] Series {key} has {len(time)} distinct times, "
+                             + f"{kind} interpolation needs at least {degree+1}")
+
+        values = make_interp_spline(time, series[index, 1:], k=degree, axis=0)(time_base)
+        values[(time_base < time[0]) | (time_base > time[-1])] = numpy.nan
+        aligned[key] = numpy.column_stack([time_base, values])
+
+    return aligned
+
+def scratch_dataset(dataset):
+    """
+    Store numpy-memmap variables of a created or cloned dataset in a new
+    temporary directory instead of boxmem/ in the working directory, which
+    boxkit uses by default. Call before any variable is added, the
+    directory is removed by dataset.purge
+    """
+    dataset._data.boxmem = tempfile.mkdtemp(prefix="boxmem_")
+    return dataset
+
+def merge_array(dataset, data, tags=None):
+    """
+    Merge block data of shape (nblocks, nzb, nyb, nxb) onto a uniform grid of
+    shape (nz, ny, nx) with a single copy. tags selects blocks of the dataset
+    that correspond to data, all blocks must be at the same level
+    """
+    blocklist = dataset.blocklist if tags is None else [dataset.blocklist[tag] for tag in tags]
+
+    level = blocklist[0].level
+    for block in blocklist:
+        if block.level != level:
+            raise ValueError(f"[CommonModule.merge_array] All blocks must be at level {level}")
+
+    bounds = numpy.array([[block.xmin, block.ymin, block.zmin, block.xmax, block.ymax, block.zmax]
+                          for block in blocklist])
+
+    size = bounds[0, 3:] - bounds[0, :3]
+    size[size == 0] = 1.
+
+    loc = numpy.rint((bounds[:, :3] - bounds[:, :3].min(axis=0))/size).astype(int)
+    nblockx, nblocky, nblockz = loc.max(axis=0) + 1
+    nblocks, nzb, nyb, nxb = data.shape
+
+    with profile_stage("merge_array"):
+        merged = numpy.zeros((nblockz, nblocky, nblockx, nzb, nyb, nxb), dtype=data.dtype)
+        merged[loc[:, 2], loc[:, 1], loc[:, 0]] = data
+
+        return merged.transpose(0, 3, 1, 4, 2, 5).reshape(nblockz*nzb, nblocky*nyb, nblockx*nxb)
+
+def merge_dataset(dataset, varlist, storage="numpy-memmap"):
+    """
+    Merge blocks of a dataset at one level to a single block dataset like
+    boxkit.mergeblocks. numpy-memmap storage is placed by scratch_dataset,
+    use storage="numpy" for merged datasets that are only used in memory
+    """
+    blocklist = dataset.blocklist
+    merged_dataset = None
+
+    for varkey in varlist:
+        data = merge_array(dataset, numpy.asarray(dataset[varkey][:]))
+
+        if merged_dataset is None:
+            merged_dataset = boxkit.create_dataset(nblockx=1, nblocky=1, nblockz=1, nxb=data.shape[2],
+                                                   nyb=data.shape[1], nzb=data.shape[0],
+                                                   xmin=min(block.xmin for block in blocklist),
+                                                   xmax=max(block.xmax for block in blocklist),
+                                                   ymin=min(block.ymin for block in blocklist),
+                                                   ymax=max(block.ymax for block in blocklist),
+                                                   zmin=min(block.zmin for block in blocklist),
+                                                   zmax=max(block.zmax for block in blocklist), storage=storage)
+            if storage == "numpy-memmap":
+                scratch_dataset(merged_dataset)
+
+        merged_dataset.addvar(varkey)
+        block = merged_dataset.blocklist[0]
+        block[varkey][block.zguard:block.nzb+block.zguard,
+                      block.yguard:block.nyb+block.yguard,
+                      block.xguard:block.nxb+block.xguard] = data
+
+    return merged_dataset
+
+def plotfile_complete(filename, newer=False, settle_time=60.):
+    """
+    Check if a plotfile has been completely written, i.e. a newer plotfile
+    exists or it has not changed for settle_time seconds, and it can be read
+    """
+    if not newer and time.time() - os.stat(filename).st_mtime < settle_time:
+        return False
+
+    try:
+        with h5py.File(filename, "r") as h5file:
+            return all(varkey[0].decode() in h5file for varkey in h5file["unknown names"][:])
+    except (OSError, KeyError):
+        return False
+
+def follow_plotfiles(run_dir, basename, process_func, series_file, version=1,
+                     poll_interval=30., settle_time=60., timeout=None, retries=3):
+    """
+    Watch run_dir of a running simulation and process every complete plotfile
+    once, in order, appending file tag and result as a row to series_file.
+    A plotfile that fails to process is retried on the next polls and
+    skipped with a warning after retries attempts. Stops after timeout
+    seconds without new plotfiles or on interrupt and returns the series
+    """
+    if os.path.exists(series_file):
+        processed = set(int(row[0]) for row in numpy.loadtxt(series_file, ndmin=2))
+    else:
+        processed = set()
+
+    failures = {}
+    last_update = time.time()
+
+    try:
+        while timeout is None or time.time() - last_update < timeout:
+            file_tags = plotfile_tags(run_dir, basename)
+
+            for tag in file_tags:
+                if tag in processed:
+                    continue
+
+                filename = os.path.join(run_dir, basename + str(tag).zfill(4))
+                if not plotfile_complete(filename, newer=tag < file_tags[-1], settle_time=settle_time):
+                    break
+
+                try:
+                    result = cached_apply([filename], process_func, version)[0]
+
+                except Exception as error:
+                    failures[tag] = failures.get(tag, 0) + 1
+                    warnings.warn(f"[CommonModule.follow_plotfiles] Processing {filename} failed "
+                                  + f"({failures[tag]} of {retries} attempts): {error!r}")
+
+                    if failures[tag] < retries:
+                        break
+
+                    processed.add(tag)
+                    last_update = time.time()
+                    continue
+
+                with open(series_file, "a") as series:
+                    series.write(" ".join([str(tag)] + [repr(float(value)) for value in numpy.ravel(result)]) + "\n")
+
+                processed.add(tag)
+                last_update = time.time()
+
+            time.sleep(poll_interval)
+
+    except KeyboardInterrupt:
+        pass
+
+    return numpy.loadtxt(series_file, ndmin=2) if os.path.exists(series_file) else numpy.empty((0, 0))
+
+def plotfile_header(filename):
+    """
+    Read time, block layout and refinement levels from plotfile
+    header without touching the variable data
+    """
+    with h5py.File(filename, "r") as h5file:
+        varkey = h5file["unknown names"][0][0].decode()
+        nblocks, nzb, nyb, nxb = h5file[varkey].shape
+        levels = h5file["refine level"][:]
+        bounds = h5file["bounding box"][:]
+
+    return numpy.array([plotfile_time(filename), nblocks, nxb, nyb, nzb, levels.min(), levels.max(),
+                        bounds[:, 0, 0].min(), bounds[:, 0, 1].max(),
+                        bounds[:, 1, 0].min(), bounds[:, 1, 1].max(),
+                        bounds[:, 2, 0].min(), bounds[:, 2, 1].max()], dtype=float)
+
+def plotfile_index(dataset_dir, basename, file_tags=None):
+    """
+    Get lazy datasets for file tags, all plotfiles in the directory by default.
+    Headers are stored in the cache file of the directory, so only new
+    or changed plotfiles are scanned
+    """
+    file_tags = plotfile_tags(dataset_dir, basename) if file_tags is None else list(file_tags)
+    filelist = [os.path.join(dataset_dir, basename + str(tag).zfill(4)) for tag in file_tags]
+
+    headerlist = cached_apply(filelist, plotfile_header, 1)
+
+    return [LazyDataset(filename, header) for filename, header in zip(filelist, headerlist)]
+
+class LazyDataset:
+    """
+    Proxy for a boxkit dataset which serves header information from the
+    plotfile index. Indexing with a variable reads only that variable,
+    any other attribute opens the plotfile as a boxkit dataset which
+    stays loaded until release is called or the with block ends
+    """
+
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = dict(zip(HEADER_KEYS, [float(value) for value in header]))
+        self._dataset = None
+
+    def __repr__(self):
+        return f"LazyDataset({self.filename!r}, time={self.time}, loaded={self._dataset is not None})"
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __getitem__(self, varkey):
+        if self._dataset is not None:
+            return self._dataset[varkey]
+
+        with profile_stage("read_variable", self.filename), h5py.File(self.filename, "r") as h5file:
+            if varkey not in h5file:
+                raise ValueError(f"[CommonModule.LazyDataset] Variable {varkey} not found in {self.filename}")
+            return h5file[varkey][:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @property
+    def time(self):
+        """time"""
+        return self.header["time"]
+
+    def load(self):
+        """
+        Open plotfile as a boxkit dataset
+        """
+        if self._dataset is None:
+            with profile_stage("read_dataset", self.filename):
+                self._dataset = boxkit.read_dataset(self.filename, source="flash")
+        return self._dataset
+
+    def release(self):
+        """
+        Close plotfile and release memory
+        """
+        if self._dataset is not None:
+            self._dataset.purge()
+            self._dataset = None
+
+    def purge(self, purgeflag="all"):
+        """
+        Same as release for compatibility with boxkit datasets
+        """
+        self.release()
+
+def io_counters():
+    """
+    Get bytes read by this process through system calls and from
+    storage, zeros where /proc/self/io is not available
+    """
+    try:
+        with open("/proc/self/io", "r") as iofile:
+            counters = dict(line.split(":") for line in iofile.read().splitlines())
+        return int(counters["rchar"]), int(counters["read_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def profile_directory(profile_dir=None):
+    """
+    Get absolute path of profile_dir or of ANALYSIS_PROFILE, which is
+    resolved once and written back to the environment so that later
+    changes of working directory and pool workers use the same path
+    """
+    if profile_dir:
+        return os.path.abspath(profile_dir)
+
+    if not os.environ.get(PROFILE_ENV):
+        return None
+
+    os.environ[PROFILE_ENV] = os.path.abspath(os.environ[PROFILE_ENV])
+    return os.environ[PROFILE_ENV]
+
+@contextlib.contextmanager
+def profile_stage(name, filename=None):
+    """
+    Record wall time, bytes read and peak memory of a stage as a trace
+    event when ANALYSIS_PROFILE is set to a directory. Every process
+    appends events to its own file so pool workers can record too
+    """
+    profile_dir = profile_directory()
+
+    if not profile_dir:
+        yield
+        return
+
+    start_io = io_counters()
+    start = time.time()
+
+    try:
+        yield
+
+    finally:
+        stop = time.time()
+        stop_io = io_counters()
+
+        event = {"name": name, "cat": "analysis", "ph": "X", "ts": start*1e6, "dur": (stop-start)*1e6,
+                 "pid": os.getpid(), "tid": threading.get_native_id(),
+                 "args": {"file": os.path.basename(filename) if filename else "",
+                          "rchar": stop_io[0]-start_io[0], "read_bytes": stop_io[1]-start_io[1],
+                          "maxrss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024}}
+
+        os.makedirs(profile_dir, exist_ok=True)
+        with open(os.path.join(profile_dir, f"trace_{os.getpid()}.jsonl"), "a") as tracefile:
+            tracefile.write(json.dumps(event) + "\n")
+
+def read_trace(profile_dir=None):
+    """
+    Read trace events recorded by all processes in profile_dir
+    """
+    profile_dir = profile_directory(profile_dir)
+    events = []
+
+    if not profile_dir:
+        raise ValueError(f"[CommonModule.read_trace] Pass profile_dir or set {PROFILE_ENV}")
+
+    for filename in sorted(glob.glob(os.path.join(profile_dir, "trace_*.jsonl"))):
+        with open(filename, "r") as tracefile:
+            events.extend(json.loads(line) for line in tracefile if line.strip())
+
+    return sorted(events, key=lambda event: event["ts"])
+
+def write_trace(profile_dir=None, filename=None):
+    """
+    Merge trace events of all processes into a Chrome trace JSON file which
+    can be opened in Perfetto or chrome://tracing. The process that recorded
+    the first event is labelled main and the others worker
+    """
+    profile_dir = profile_directory(profile_dir)
+    filename = filename or os.path.join(profile_dir, "trace.json")
+    events = read_trace(profile_dir)
+
+    pidlist = list(dict.fromkeys(event["pid"] for event in events))
+    metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"{'main' if not index else 'worker'} {pid}"}}
+                for index, pid in enumerate(pidlist)]
+
+    with open(filename, "w") as tracefile:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, tracefile)
+
+    return filename
+
+def profile_summary(profile_dir=None):
+    """
+    Print and return summary of trace events per stage (count, total and
+    maximum time, bytes read, peak memory) and per process (busy time
+    in outermost stages and idle fraction of the traced interval).
+    Times of nested stages are included in their enclosing stage
+    """
+    events = read_trace(profile_dir)
+
+    if not events:
+        return {}, {}
+
+    stages = {}
+    for event in events:
+        stage = stages.setdefault(event["name"], {"count": 0, "total": 0., "max": 0., "rchar": 0,
+                                                  "read_bytes": 0, "maxrss_mb": 0.})
+        stage["count"] += 1
+        stage["total"] += event["dur"]/1e6
+        stage["max"] = max(stage["max"], event["dur"]/1e6)
+        stage["rchar"] += event["args"]["rchar"]
+        stage["read_bytes"] += event["args"]["read_bytes"]
+        stage["maxrss_mb"] = max(stage["maxrss_mb"], event["args"]["maxrss_mb"])
+
+    span = (max(event["ts"] + event["dur"] for event in events) - events[0]["ts"])/1e6
+
+    processes = {}
+    for event in events:
+        process = processes.setdefault(event["pid"], {"busy": 0., "end": 0.})
+        if event["ts"] >= process["end"]:
+            process["busy"] += event["dur"]/1e6
+            process["end"] = event["ts"] + event["dur"]
+
+    for process in processes.values():
+        del process["end"]
+        process["idle"] = 1. - process["busy"]/span if span else 0.
+
+    print(f"{'stage':<24}{'count':>8}{'total [s]':>12}{'mean [s]':>12}{'max [s]':>12}{'read [MB]':>12}{'rss [MB]':>12}")
+    for name, stage in sorted(stages.items(), key=lambda item: -item[1]["total"]):
+        print(f"{name:<24}{stage['count']:>8}{stage['total']:>12.4f}{stage['total']/stage['count']:>12.4f}"
+              + f"{stage['max']:>12.4f}{stage['rchar']/2**20:>12.1f}{stage['maxrss_mb']:>12.1f}")
+
+    print(f"\n{'process':<24}{'busy [s]':>12}{'idle':>12}")
+    for pid, process in processes.items():
+        print(f"{pid:<24}{process['busy']:>12.4f}{process['idle']:>12.1%}")
+
+    return stages, processes
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
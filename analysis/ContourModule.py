@@ -0,0 +1,152 @@
+import os
+import glob
+import shutil
+import subprocess
+import numpy
+import contourpy
+import boxkit
+from boxkit.library import Action
+
+import CommonModule
+
+# Version of contour_plotfile, increment when the
+# computation changes to invalidate cached contours
+CONTOUR_VERSION = 1
+
+FRAME_NAME = "frame_{:05d}.png"
+
+def contour_dataset(dataset, varkey="dfun", level=0.0):
+    """
+    Extract iso-contour of a variable on the merged grid of a two dimensional
+    dataset. Returns float32 vertex array of shape (nvertices, 2) with
+    polylines separated by a row of NaN, which matplotlib plots directly
+    """
+    with CommonModule.profile_stage("contour_dataset"):
+        data = CommonModule.merge_array(dataset, numpy.asarray(dataset[varkey][:]))[0]
+
+        block = dataset.blocklist[0]
+        xmin = min(block.xmin for block in dataset.blocklist)
+        ymin = min(block.ymin for block in dataset.blocklist)
+
+        xcenter = xmin + (numpy.arange(data.shape[1]) + 0.5)*block.dx
+        ycenter = ymin + (numpy.arange(data.shape[0]) + 0.5)*block.dy
+
+        lines = contourpy.contour_generator(xcenter, ycenter, data, line_type="ChunkCombinedNan").lines(level)[0][0]
+
+    return numpy.empty((0, 2), dtype=numpy.float32) if lines is None else lines.astype(numpy.float32)
+
+def contour_plotfile(filename):
+    """
+    Read a plotfile, extract dfun=0 contour and release the dataset
+    """
+    with CommonModule.profile_stage("contour_plotfile", filename):
+        dataset = boxkit.read_dataset(filename, source="flash")
+        contour = contour_dataset(dataset)
+        dataset.purge()
+    return contour
+
+def contour_series(dataset_dir, basename, file_tags, nthreads=1, backend="loky"):
+    """
+    Get simulation times and dfun=0 contours for file tags. Contours are
+    stored in the cache file of the archive so that only new or changed
+    plotfiles are read again
+    """
+    filelist = [os.path.join(dataset_dir, basename + str(tag).zfill(4)) for tag in file_tags]
+
+    times = CommonModule.plotfile_times(dataset_dir, basename, file_tags)[1]
+    contours = CommonModule.cached_apply(filelist, contour_plotfile, CONTOUR_VERSION,
+                                         nthreads=nthreads, backend=backend)
+
+    return times, [numpy.reshape(contour, (-1, 2)) for contour in contours]
+
+def render_frame(frame):
+    """
+    Render one frame from a dictionary with filename, contours and styles
+    for every key, title, axis limits, xmirror, figsize and dpi
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot
+
+    figure, plot = pyplot.subplots(figsize=frame["figsize"], dpi=frame["dpi"])
+
+    for key, contour in frame["contours"].items():
+        style = {"color": "black", "linewidth": 1, **frame["styles"].get(key, {})}
+        plot.plot(contour[:, 0], contour[:, 1], **style)
+        if frame["xmirror"]:
+            plot.plot(-contour[:, 0], contour[:, 1], **style)
+
+    plot.set_title(frame["title"])
+    plot.set_aspect("equal")
+    if frame["xlim"]:
+        plot.set_xlim(frame["xlim"])
+    if frame["ylim"]:
+        plot.set_ylim(frame["ylim"])
+
+    figure.savefig(frame["filename"])
+    pyplot.close(figure)
+
+    return frame["filename"]
+
+def render_frames(contours, times, frame_dir, styles=None, title="t = {time:.2f}", time_scale=1.0,
+                  xlim=None, ylim=None, xmirror=False, figsize=(4, 6), dpi=100, nthreads=1, backend="loky"):
+    """
+    Render a frame for every time from cached contours, a dictionary of key
+    to list of contours with one contour per time. Frames are rendered on a
+    pool of nthreads workers without reading any plotfile, so changing
+    styles only costs the rendering. Returns list of frame files
+    """
+    os.makedirs(frame_dir, exist_ok=True)
+    for filename in glob.glob(os.path.join(frame_dir, FRAME_NAME.replace("{:05d}", "*"))):
+        os.remove(filename)
+
+    framelist = [{"filename": os.path.join(frame_dir, FRAME_NAME.format(index)),
+                  "contours": {key: contours[key][index] for key in contours},
+                  "styles": styles or {}, "title": title.format(time=time*time_scale),
+                  "xlim": xlim, "ylim": ylim, "xmirror": xmirror, "figsize": figsize, "dpi": dpi}
+                 for index, time in enumerate(times)]
+
+    with CommonModule.profile_stage("render_frames"):
+        return Action(render_frame, nthreads=nthreads, backend=backend)(framelist)
+
+def encode_animation(frame_dir, filename, fps=10):
+    """
+    Encode frames written by render_frames to a GIF with Pillow or
+    to an MP4, or any other format known to ffmpeg, with ffmpeg
+    """
+    framelist = sorted(glob.glob(os.path.join(frame_dir, FRAME_NAME.replace("{:05d}", "*"))))
+
+    if not framelist:
+        raise ValueError(f"[ContourModule.encode_animation] No frames found in {frame_dir}")
+
+    with CommonModule.profile_stage("encode_animation"):
+        if filename.endswith(".gif"):
+            from PIL import Image
+
+            images = [Image.open(frame).convert("RGB") for frame in framelist]
+            images[0].save(filename, save_all=True, append_images=images[1:], duration=int(1000/fps), loop=0)
+
+        else:
+            if shutil.which("ffmpeg") is None:
+                raise ValueError("[ContourModule.encode_animation] ffmpeg is required for " + filename)
+
+            subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-framerate", str(fps),
+                            "-i", os.path.join(frame_dir, FRAME_NAME.replace("{:05d}", "%05d")),
+                            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p", filename], check=True)
+
+    return filename
+
+def animate(contours, times, filename, frame_dir=None, fps=10, **kwargs):
+    """
+    Render frames from cached contours and encode them to filename,
+    keyword arguments are passed to render_frames
+    """
+    frame_dir = frame_dir or os.path.splitext(filename)[0] + "_frames"
+    render_frames(contours, times, frame_dir, **kwargs)
+    return encode_animation(frame_dir, filename, fps)
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
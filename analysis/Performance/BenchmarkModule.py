@@ -0,0 +1,247 @@
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy
+import h5py
+import boxkit
+import SyntheticModule
+
+ANALYSIS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BASENAME = "INS_Rising_Bubble_hdf5_plt_cnt_"
+LINKNAMES = ["INS_Pool_Boiling_hdf5_plt_cnt_"]
+
+def stage_plotfile_index(module, dataset_dir, file_tags, nthreads):
+    """
+    Scan plotfile headers into the index
+    """
+    module.CommonModule.plotfile_index(dataset_dir, module.SIM_BASENAME, file_tags)
+
+def stage_read_datasets(module, dataset_dir, file_tags, nthreads):
+    """
+    Open every plotfile as a boxkit dataset
+    """
+    for dataset in module.read_datasets(dataset_dir, file_tags, lazy=False):
+        dataset.purge()
+
+def stage_process_datasets(module, dataset_dir, file_tags, nthreads):
+    """
+    Measure bubble quantities for every plotfile without the result cache
+    """
+    module.process_datasets({"synthetic": dataset_dir}, {"synthetic": file_tags}, nthreads=nthreads, cache=False)
+
+def stage_process_series_band(module, dataset_dir, file_tags, nthreads):
+    """
+    Measure bubble quantities in a narrow band following the bubble
+    """
+    module.process_series_band(dataset_dir, file_tags)
+
+def stage_compute_norm(module, dataset_dir, file_tags, nthreads):
+    """
+    Compute norms of every plotfile against itself, which costs the
+    same merge and restriction as a comparison across resolutions
+    """
+    fine = module.read_datasets(dataset_dir, file_tags, lazy=False)
+    coarse = module.read_datasets(dataset_dir, file_tags, lazy=False)
+    module.compute_norm(fine, coarse)
+
+    for dataset in fine + coarse:
+        dataset.purge()
+
+def stage_temporal_stats(module, dataset_dir, file_tags, nthreads):
+    """
+    Compute temporal statistics over datasets held in memory
+    """
+    datasets = module.read_datasets(dataset_dir, file_tags, lazy=False)
+    module.temporal_stats(datasets).purge()
+
+    for dataset in datasets:
+        dataset.purge()
+
+def stage_temporal_stats_stream(module, dataset_dir, file_tags, nthreads):
+    """
+    Compute temporal statistics streaming one plotfile at a time
+    """
+    module.temporal_stats_stream(dataset_dir, file_tags).purge()
+
+def stage_temporal_stats_parallel(module, dataset_dir, file_tags, nthreads):
+    """
+    Compute temporal statistics from chunks on a pool of workers
+    """
+    module.temporal_stats_parallel(dataset_dir, file_tags, chunk_size=max(1, len(file_tags)//nthreads),
+                                   nthreads=nthreads).purge()
+
+# Stage name to (simulation providing LocalModule, stage function, stage uses nthreads)
+STAGES = {"plotfile_index": ("RisingBubble", stage_plotfile_index, False),
+          "read_datasets": ("RisingBubble", stage_read_datasets, False),
+          "process_datasets": ("RisingBubble", stage_process_datasets, True),
+          "process_series_band": ("RisingBubble", stage_process_series_band, False),
+          "compute_norm": ("RisingBubble", stage_compute_norm, False),
+          "temporal_stats": ("PoolBoiling", stage_temporal_stats, False),
+          "temporal_stats_stream": ("PoolBoiling", stage_temporal_stats_stream, False),
+          "temporal_stats_parallel": ("PoolBoiling", stage_temporal_stats_parallel, True)}
+
+def clear_cache(dataset_dir):
+    """
+    Remove analysis cache so every stage starts from plotfiles on disk
+    """
+    for filename in glob.glob(os.path.join(dataset_dir, ".analysis_cache.sqlite*")):
+        os.remove(filename)
+
+def maxrss_mb():
+    """
+    Get peak resident set size of this process in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def run_stage(stage, dataset_dir, file_tags, nthreads, repeat):
+    """
+    Import LocalModule of the stage, time it repeat times and print the
+    measurement as JSON. Meant to run in a fresh interpreter so that peak
+    memory belongs to this stage, peak memory does not include pool workers
+    """
+    simulation, stage_func, _ = STAGES[stage]
+    sys.path.insert(0, os.path.join(ANALYSIS_PATH, simulation))
+    sys.path.insert(1, ANALYSIS_PATH)
+
+    import LocalModule
+
+    baseline_rss = maxrss_mb()
+    elapsed = []
+
+    for _ in range(repeat):
+        clear_cache(dataset_dir)
+        start = time.perf_counter()
+        stage_func(LocalModule, dataset_dir, file_tags, nthreads)
+        elapsed.append(time.perf_counter() - start)
+
+    print(json.dumps({"elapsed": elapsed, "baseline_rss_mb": baseline_rss, "maxrss_mb": maxrss_mb()}))
+
+def measure_stage(stage, dataset_dir, file_tags, nthreads=1, repeat=3):
+    """
+    Run a stage in a new interpreter and return a result record. Failures,
+    for example missing optional dependencies of a LocalModule, are
+    recorded with the last line of the error message
+    """
+    with h5py.File(os.path.join(dataset_dir, BASENAME + str(file_tags[0]).zfill(4)), "r") as h5file:
+        nblocks, nzb, nyb, nxb = h5file["dfun"].shape
+
+    record = {"stage": stage, "nthreads": nthreads, "nfiles": len(file_tags), "nblocks": int(nblocks),
+              "cells": int(nblocks*nzb*nyb*nxb)}
+
+    # A new interpreter instead of a multiprocessing child, stages
+    # start pools of their own which need a regular main module
+    command = (f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); "
+               + f"import BenchmarkModule; BenchmarkModule.run_stage({stage!r}, {os.path.abspath(dataset_dir)!r}, "
+               + f"{list(file_tags)!r}, {nthreads}, {repeat})")
+
+    # Run in a scratch directory, boxkit writes memmap storage to
+    # boxmem/ in the working directory and stages do not remove it
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as scratch:
+        process = subprocess.run([sys.executable, "-c", command], capture_output=True, text=True, check=False,
+                                 cwd=scratch)
+
+    if process.returncode != 0:
+        message = process.stderr.strip().splitlines() or [f"Exit code {process.returncode}"]
+        return {**record, "status": message[-1]}
+
+    measurement = json.loads(process.stdout.strip().splitlines()[-1])
+
+    best = min(measurement["elapsed"])
+
+    return {**record, "status": "ok",
+            "time": best,
+            "time_median": float(numpy.median(measurement["elapsed"])),
+            "files_per_second": len(file_tags)/best,
+            "cells_per_second": record["cells"]*len(file_tags)/best,
+            "baseline_rss_mb": measurement["baseline_rss_mb"],
+            "maxrss_mb": measurement["maxrss_mb"]}
+
+def run_suite(workdir, resolutions=None, nfiles=8, workers=None, stages=None, repeat=3):
+    """
+    Generate synthetic plotfiles for every resolution and measure every stage,
+    stages that use a pool of workers are measured for every worker count
+    """
+    resolutions = resolutions or [40, 80, 160]
+    workers = workers or [1, 2, 4]
+    stages = stages or list(STAGES)
+
+    results = []
+    for resolution in resolutions:
+        dataset_dir = os.path.join(workdir, f"h{resolution}")
+        file_tags = SyntheticModule.generate_series(dataset_dir, BASENAME, resolution, nfiles, linknames=LINKNAMES)
+
+        for stage in stages:
+            for nthreads in (workers if STAGES[stage][2] else [1]):
+                record = {"resolution": resolution, **measure_stage(stage, dataset_dir, file_tags, nthreads, repeat)}
+                print(format_record(record))
+                results.append(record)
+
+    return {"environment": environment(), "nfiles": nfiles, "repeat": repeat, "results": results}
+
+def environment():
+    """
+    Get description of machine and library versions for a benchmark run
+    """
+    return {"host": socket.gethostname(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "numpy": numpy.__version__,
+            "h5py": h5py.__version__,
+            "boxkit": getattr(boxkit, "__version__", "unknown"),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def format_record(record):
+    """
+    Format a result record as a single line
+    """
+    label = f"{record['stage']:<24} h{record['resolution']:<4} nthreads={record['nthreads']:<3}"
+
+    if record["status"] != "ok":
+        return f"{label} {record['status']}"
+
+    return (f"{label} {record['time']:9.4f} s {record['files_per_second']:9.2f} files/s "
+            + f"{record['cells_per_second']/1e6:9.2f} Mcells/s {record['maxrss_mb']:9.1f} MB")
+
+def write_results(suite, filename):
+    """
+    Write results of run_suite to a JSON file
+    """
+    with open(filename, "w") as results_file:
+        json.dump(suite, results_file, indent=1)
+
+def compare_results(suite, baseline, tolerance=0.2):
+    """
+    Compare results of run_suite against a baseline suite and return list of
+    (stage, resolution, nthreads, time ratio, peak memory ratio, regressed)
+    for records present in both. A record regresses if time or peak
+    memory grows by more than tolerance
+    """
+    reference = {(record["stage"], record["resolution"], record["nthreads"]): record
+                 for record in baseline["results"] if record["status"] == "ok"}
+
+    comparison = []
+    for record in suite["results"]:
+        key = (record["stage"], record["resolution"], record["nthreads"])
+
+        if record["status"] != "ok" or key not in reference:
+            continue
+
+        time_ratio = record["time"]/reference[key]["time"]
+        memory_ratio = record["maxrss_mb"]/reference[key]["maxrss_mb"]
+        comparison.append((*key, time_ratio, memory_ratio, time_ratio > 1+tolerance or memory_ratio > 1+tolerance))
+
+    return comparison
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
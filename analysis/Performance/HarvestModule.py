@@ -0,0 +1,367 @@
+import os
+import re
+import glob
+import sqlite3
+import numpy
+
+SIM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../simulation")
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../config.sh")
+DATABASE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "performance.sqlite")
+
+# Version of parse_log, increment when parsing
+# changes to harvest archives again
+HARVEST_VERSION = 1
+
+RUN_COLUMNS = ["archive", "logfile", "version", "mtime", "size", "study", "casename", "resolution", "date",
+               "site", "flash_sha", "flash_version", "ranks", "nodes", "dim", "nxb", "nyb", "nzb", "nblocks",
+               "nsteps", "dt", "sim_time", "wall_time", "cell_updates", "cost_per_cell_update", "core_hours"]
+
+STEP_PATTERN = re.compile(r"step:\s+n=\s*(\d+)\s+t=\s*(\S+)\s+dt=\s*(\S+)")
+BLOCK_PATTERN = re.compile(r"tot blks(?: requested)?:?\s+(\d+)")
+STAMP_PATTERN = re.compile(r"^\s*\[\s*(\d+-\d+-\d+\s+\d+:\d+:\d+(?:\.\d+)?)\s*\]")
+TIMER_PATTERN = re.compile(r"^(\s*)(\S.*?)\s+((?:[-+\d.Ee]+\s+){1,}[-+\d.Ee]+)\s*$")
+
+HEADER_KEYS = {"Number of MPI tasks": "ranks", "Dimensionality": "dim", "Number x zones": "nxb",
+               "Number y zones": "nyb", "Number z zones": "nzb", "Version": "flash_version",
+               "System info": "system", "seconds in monitoring period": "monitoring_time"}
+
+def open_database(database=DATABASE_FILE):
+    """
+    Open performance database creating tables and indices
+    """
+    connection = sqlite3.connect(database, timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, "
+                       + ", ".join(f"{column}{' UNIQUE' if column == 'archive' else ''}"
+                                   for column in RUN_COLUMNS) + ")")
+    connection.execute("CREATE TABLE IF NOT EXISTS timers (run INTEGER, unit TEXT, depth INTEGER, "
+                       + "time REAL, calls INTEGER)")
+    connection.execute("CREATE INDEX IF NOT EXISTS runs_case ON runs (study, casename, resolution)")
+    connection.execute("CREATE INDEX IF NOT EXISTS runs_site ON runs (site, flash_sha)")
+    connection.execute("CREATE INDEX IF NOT EXISTS timers_run ON timers (run, unit)")
+    return connection
+
+def find_archives(sim_path=SIM_PATH):
+    """
+    Find every jobnode.archive/<date> directory below sim_path
+    """
+    return sorted(path for path in glob.glob(os.path.join(sim_path, "**", "jobnode.archive", "*"), recursive=True)
+                  if os.path.isdir(path))
+
+def find_logfile(archive):
+    """
+    Find Flash-X log file in an archive directory
+    """
+    logfiles = sorted(glob.glob(os.path.join(archive, "*.log")), key=os.path.getsize)
+    return logfiles[-1] if logfiles else None
+
+def shell_variables(filename):
+    """
+    Read assignments NAME=value and export NAME=value from a shell script
+    """
+    variables = {}
+
+    if filename and os.path.exists(filename):
+        with open(filename, "r") as shellfile:
+            for name, value in re.findall(r"^\s*(?:export\s+)?(\w+)=\"?([^\"\n]*)\"?", shellfile.read(), re.M):
+                variables[name] = value.strip()
+
+    return variables
+
+def nearest_file(directory, filename, sim_path=SIM_PATH):
+    """
+    Find filename in directory or its parents up to sim_path, which is how
+    Jobfile scripts are combined by jobrunner
+    """
+    directory = os.path.abspath(directory)
+    sim_path = os.path.abspath(sim_path)
+
+    while directory.startswith(sim_path):
+        if os.path.exists(os.path.join(directory, filename)):
+            return os.path.join(directory, filename)
+        directory = os.path.dirname(directory)
+
+    return None
+
+def parse_log(logfile):
+    """
+    Parse header, time steps, block counts and timer summary of a Flash-X
+    log file. Returns dictionary with header values, arrays of step
+    number, time and dt, block counts, wall time and list of timers
+    (unit, depth, time, calls) from the first timer summary
+    """
+    header = {}
+    steps = []
+    blocks = []
+    stamps = []
+    timers = []
+    in_timers = False
+
+    with open(logfile, "r", errors="replace") as log:
+        for line in log:
+            stamp = STAMP_PATTERN.match(line)
+            if stamp:
+                stamps.append(stamp.group(1))
+
+            step = STEP_PATTERN.search(line)
+            if step:
+                steps.append([float(value.replace("D", "E")) for value in step.groups()])
+                continue
+
+            block = BLOCK_PATTERN.search(line)
+            if block:
+                blocks.append(int(block.group(1)))
+                continue
+
+            if "accounting unit" in line:
+                in_timers = not timers
+                continue
+
+            if in_timers:
+                if line.strip().startswith("=") and timers:
+                    in_timers = False
+                    continue
+
+                timer = TIMER_PATTERN.match(line.rstrip("\n"))
+                if timer and not line.strip().startswith("-"):
+                    values = timer.group(3).split()
+                    timers.append((timer.group(2).strip(), len(timer.group(1))//2, float(values[0]),
+                                   int(float(values[1])) if len(values) > 1 else 1))
+                continue
+
+            if ":" in line:
+                key, value = [part.strip() for part in line.split(":", 1)]
+                if key in HEADER_KEYS and HEADER_KEYS[key] not in header:
+                    header[HEADER_KEYS[key]] = value
+
+    steps = numpy.array(steps).reshape(-1, 3)
+
+    wall_time = float(header["monitoring_time"].split()[0]) if "monitoring_time" in header else None
+    if wall_time is None and len(stamps) > 1:
+        wall_time = float(elapsed_seconds(stamps[0], stamps[-1]))
+
+    return {"header": header, "steps": steps, "blocks": numpy.array(blocks, dtype=int),
+            "wall_time": wall_time, "timers": timers}
+
+def elapsed_seconds(start, stop):
+    """
+    Get seconds between two Flash-X log stamps like 11-26-2023  10:12:04.123
+    """
+    to_datetime = lambda stamp: numpy.datetime64("{2}-{0}-{1}T{3}".format(*re.split(r"[-\s]+", stamp.strip())))
+    return (to_datetime(stop) - to_datetime(start))/numpy.timedelta64(1, "s")
+
+def toml_grid(archive, sim_path=SIM_PATH):
+    """
+    Read nblockx, nblocky and nblockz from flash.par or flash.toml
+    of a run, used when the log has no block counts
+    """
+    grid = {}
+
+    for filename in [os.path.join(archive, "flash.par"), nearest_file(os.path.dirname(os.path.dirname(archive)),
+                                                                      "flash.toml", sim_path)]:
+        if filename and os.path.exists(filename):
+            with open(filename, "r") as parfile:
+                for name, value in re.findall(r"^\s*(nblock[xyz])\s*=\s*(\d+)", parfile.read(), re.M | re.I):
+                    grid.setdefault(name.lower(), int(value))
+
+    return grid
+
+def run_record(archive, logfile, parsed, site=None, sim_path=SIM_PATH):
+    """
+    Build database record for a run from parsed log and the scripts
+    and parameter files of its job directory
+    """
+    jobdir = os.path.dirname(os.path.dirname(archive))
+    relative = os.path.relpath(jobdir, sim_path).split(os.sep)
+    header, steps, blocks = parsed["header"], parsed["steps"], parsed["blocks"]
+
+    resolution = next((int(match.group(1)) for match in map(re.compile(r"^h(\d+)").match, relative) if match), None)
+    casename = next((part for part in relative if re.match(r"^Case\d+$", part)), relative[-1])
+
+    options = shell_variables(nearest_file(jobdir, "flashOptions.sh", sim_path))
+    resources = shell_variables(nearest_file(jobdir, "calResources.sh", sim_path))
+
+    ranks = int(header["ranks"]) if "ranks" in header else None
+    ranks_per_node = (int(resources["NRS_PER_NODE"])*int(resources["NMPI_PER_RS"])
+                      if {"NRS_PER_NODE", "NMPI_PER_RS"} <= set(resources) else None)
+
+    cells_per_block = numpy.prod([int(header.get(key, 1)) for key in ["nxb", "nyb", "nzb"]])
+
+    if len(blocks):
+        nblocks = int(blocks[-1])
+    else:
+        grid = toml_grid(archive, sim_path)
+        nblocks = int(numpy.prod([grid.get(key, 1) for key in ["nblockx", "nblocky", "nblockz"]])) if grid else None
+
+    nsteps = int(steps[-1, 0] - steps[0, 0] + 1) if len(steps) else 0
+    wall_time = parsed["wall_time"]
+
+    # Cell updates use the mean of logged block
+    # counts when the grid is refined during the run
+    if len(blocks) > 1 and nsteps:
+        cell_updates = float(numpy.mean(blocks))*cells_per_block*nsteps
+    else:
+        cell_updates = float(nblocks*cells_per_block*nsteps) if nblocks else None
+
+    cost = wall_time*ranks/cell_updates if wall_time and ranks and cell_updates else None
+
+    return {"archive": os.path.relpath(archive, sim_path), "logfile": os.path.basename(logfile),
+            "version": HARVEST_VERSION, "mtime": int(os.stat(logfile).st_mtime_ns),
+            "size": int(os.stat(logfile).st_size),
+            "study": "/".join(relative[:2]), "casename": casename, "resolution": resolution,
+            "date": os.path.basename(archive), "site": site or host_name(header.get("system", "")),
+            "flash_sha": options.get("FlashSha"), "flash_version": header.get("flash_version"),
+            "ranks": ranks, "nodes": int(numpy.ceil(ranks/ranks_per_node)) if ranks and ranks_per_node else None,
+            "dim": int(header["dim"]) if "dim" in header else None,
+            "nxb": int(header.get("nxb", 0)) or None, "nyb": int(header.get("nyb", 0)) or None,
+            "nzb": int(header.get("nzb", 0)) or None, "nblocks": nblocks, "nsteps": nsteps,
+            "dt": float(numpy.mean(steps[:, 2])) if len(steps) else None,
+            "sim_time": float(steps[-1, 1]) if len(steps) else None,
+            "wall_time": wall_time, "cell_updates": cell_updates, "cost_per_cell_update": cost,
+            "core_hours": wall_time*ranks/3600 if wall_time and ranks else None}
+
+def host_name(system):
+    """
+    Get host name from System info line of the log header like Linux login1 ...
+    """
+    parts = system.split()
+    return parts[1] if len(parts) > 1 else None
+
+def site_name(config_file=CONFIG_FILE):
+    """
+    Get SiteName from config.sh written by configure
+    """
+    return shell_variables(config_file).get("SiteName") or None
+
+def harvest(sim_path=SIM_PATH, database=DATABASE_FILE, site=None):
+    """
+    Parse log files of every archive below sim_path into the database.
+    Archives whose log file has not changed since the last harvest are
+    skipped. site defaults to SiteName from config.sh and then to the
+    host name in the log. Returns number of archives parsed
+    """
+    site = site or site_name()
+    connection = open_database(database)
+    nparsed = 0
+
+    for archive in find_archives(sim_path):
+        logfile = find_logfile(archive)
+        if not logfile:
+            continue
+
+        row = connection.execute("SELECT id, version, mtime, size FROM runs WHERE archive=?",
+                                 (os.path.relpath(archive, sim_path),)).fetchone()
+
+        if row and row[1:] == (HARVEST_VERSION, int(os.stat(logfile).st_mtime_ns), int(os.stat(logfile).st_size)):
+            continue
+
+        parsed = parse_log(logfile)
+        record = run_record(archive, logfile, parsed, site, sim_path)
+
+        with connection:
+            if row:
+                connection.execute("DELETE FROM timers WHERE run=?", (row[0],))
+                connection.execute("DELETE FROM runs WHERE id=?", (row[0],))
+
+            cursor = connection.execute(f"INSERT INTO runs ({', '.join(RUN_COLUMNS)}) VALUES "
+                                        + f"({', '.join('?'*len(RUN_COLUMNS))})",
+                                        [record[column] for column in RUN_COLUMNS])
+
+            connection.executemany("INSERT INTO timers VALUES (?, ?, ?, ?, ?)",
+                                   [(cursor.lastrowid, *timer) for timer in parsed["timers"]])
+
+        nparsed = nparsed + 1
+
+    connection.close()
+
+    return nparsed
+
+def query_runs(database=DATABASE_FILE, **filters):
+    """
+    Query runs matching filters on columns such as study, casename,
+    resolution, site or flash_sha. Returns list of dictionaries
+    """
+    for column in filters:
+        if column not in RUN_COLUMNS:
+            raise ValueError(f"[HarvestModule.query_runs] Unknown column {column!r}")
+
+    connection = open_database(database)
+    connection.row_factory = sqlite3.Row
+
+    condition = " AND ".join(f"{column}=?" for column in filters) or "1"
+    rows = connection.execute(f"SELECT * FROM runs WHERE {condition} ORDER BY study, casename, resolution, ranks",
+                              list(filters.values())).fetchall()
+    connection.close()
+
+    return [dict(row) for row in rows]
+
+def query_timers(run, database=DATABASE_FILE):
+    """
+    Get timer summary of a run as list of (unit, depth, time, calls)
+    """
+    connection = open_database(database)
+    timers = connection.execute("SELECT unit, depth, time, calls FROM timers WHERE run=? ORDER BY rowid",
+                                (run,)).fetchall()
+    connection.close()
+
+    return timers
+
+def scaling(runs, kind="strong"):
+    """
+    Compute scaling efficiency relative to the run with fewest ranks.
+    Strong scaling compares time per step for the same problem, weak
+    scaling compares time per step for the same cells per rank.
+    Returns dictionary of group to list of (ranks, time per step, efficiency)
+    """
+    groups = {}
+    for run in runs:
+        if not (run["ranks"] and run["wall_time"] and run["nsteps"] and run["nblocks"]):
+            continue
+
+        if kind == "strong":
+            key = (run["study"], run["casename"], run["resolution"], run["site"], run["flash_sha"])
+        elif kind == "weak":
+            key = (run["study"], run["casename"], run["site"], run["flash_sha"],
+                   int(round(run["nblocks"]/run["ranks"])))
+        else:
+            raise ValueError(f"[HarvestModule.scaling] Unknown kind {kind!r}, use strong or weak")
+
+        groups.setdefault(key, []).append((run["ranks"], run["wall_time"]/run["nsteps"]))
+
+    efficiency = {}
+    for key, points in groups.items():
+        points = sorted(points)
+        ranks_ref, time_ref = points[0]
+
+        if kind == "strong":
+            efficiency[key] = [(ranks, time, time_ref*ranks_ref/(time*ranks)) for ranks, time in points]
+        else:
+            efficiency[key] = [(ranks, time, time_ref/time) for ranks, time in points]
+
+    return efficiency
+
+def compare_versions(runs, tolerance=0.1):
+    """
+    Compare cost per cell-update across Flash-X versions and sites for the
+    same case and resolution. Returns list of (study, casename, resolution,
+    site, flash_sha, cost, ratio to cheapest, regressed)
+    """
+    groups = {}
+    for run in runs:
+        if run["cost_per_cell_update"]:
+            groups.setdefault((run["study"], run["casename"], run["resolution"]), []).append(run)
+
+    comparison = []
+    for key, grouped in sorted(groups.items(), key=lambda item: str(item[0])):
+        cheapest = min(run["cost_per_cell_update"] for run in grouped)
+        for run in sorted(grouped, key=lambda run: (str(run["site"]), str(run["flash_sha"]), run["date"])):
+            ratio = run["cost_per_cell_update"]/cheapest
+            comparison.append((*key, run["site"], run["flash_sha"], run["cost_per_cell_update"],
+                               ratio, ratio > 1 + tolerance))
+
+    return comparison
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
@@ -0,0 +1,126 @@
+import os
+import json
+import numpy
+import h5py
+
+# Block layout of the RisingBubble benchmark ladder in
+# simulation/RisingBubble/Benchmark/Case*/h*/flash.toml
+LADDER = {40: (5, 10), 80: (10, 20), 160: (20, 40), 320: (40, 80), 640: (80, 160)}
+DOMAIN = {"xmin": -1.0, "xmax": 1.0, "ymin": -1.0, "ymax": 3.0}
+VARLIST = ["dfun", "velx", "vely", "temp", "pres"]
+
+def block_layout(nblockx, nblocky, nxb=8, nyb=8, xmin=-1.0, xmax=1.0, ymin=-1.0, ymax=3.0):
+    """
+    Get bounding box of shape (nblocks, 3, 2) and block size of shape
+    (nblocks, 3) for a uniform two dimensional grid of blocks
+    """
+    iblock, jblock = numpy.meshgrid(numpy.arange(nblockx), numpy.arange(nblocky))
+    size = numpy.array([(xmax-xmin)/nblockx, (ymax-ymin)/nblocky, 0.])
+
+    bounds = numpy.zeros((nblockx*nblocky, 3, 2))
+    bounds[:, 0, 0] = xmin + iblock.ravel()*size[0]
+    bounds[:, 1, 0] = ymin + jblock.ravel()*size[1]
+    bounds[:, :, 1] = bounds[:, :, 0] + size
+
+    return bounds, numpy.tile(size, (nblockx*nblocky, 1))
+
+def synthetic_fields(bounds, nxb=8, nyb=8, time=0.0, radius=0.25, rise_velocity=0.25):
+    """
+    Evaluate fields on cell centers of blocks for a bubble of given radius
+    rising from the origin. dfun is the signed distance, positive inside
+    the bubble, velocity is a vortex pair around the bubble and temp
+    decreases linearly from the wall at the bottom of the domain
+    """
+    dx = (bounds[:, 0, 1] - bounds[:, 0, 0])/nxb
+    dy = (bounds[:, 1, 1] - bounds[:, 1, 0])/nyb
+
+    xcenter = bounds[:, 0, 0, None] + (numpy.arange(nxb) + 0.5)*dx[:, None]
+    ycenter = bounds[:, 1, 0, None] + (numpy.arange(nyb) + 0.5)*dy[:, None]
+
+    xcell = numpy.broadcast_to(xcenter[:, None, None, :], (len(bounds), 1, nyb, nxb))
+    ycell = numpy.broadcast_to(ycenter[:, None, :, None], (len(bounds), 1, nyb, nxb))
+
+    ybubble = rise_velocity*time
+    distance = numpy.sqrt(xcell**2 + (ycell-ybubble)**2)
+    swirl = numpy.exp(-(distance/(2*radius))**2)
+
+    ymin = bounds[:, 1, 0].min()
+    ymax = bounds[:, 1, 1].max()
+
+    return {"dfun": radius - distance,
+            "velx": -(ycell-ybubble)*swirl*rise_velocity/radius,
+            "vely": rise_velocity*swirl + xcell*swirl*rise_velocity/radius,
+            "temp": 1.0 - (ycell-ymin)/(ymax-ymin) - 0.1*swirl,
+            "pres": 0.5*(ymax - ycell) + 0.1*swirl}
+
+def write_plotfile(filename, nblockx, nblocky, nxb=8, nyb=8, time=0.0, varlist=None, **domain):
+    """
+    Write a Flash-X style plotfile with a uniform grid of blocks
+    """
+    varlist = varlist or VARLIST
+    domain = {**DOMAIN, **domain}
+
+    bounds, size = block_layout(nblockx, nblocky, nxb, nyb, **domain)
+    fields = synthetic_fields(bounds, nxb, nyb, time)
+    nblocks = len(bounds)
+
+    scalar_type = numpy.dtype([("name", "S80"), ("value", "<f8")])
+    integer_type = numpy.dtype([("name", "S80"), ("value", "<i4")])
+
+    with h5py.File(filename + ".tmp", "w") as h5file:
+        h5file["real scalars"] = numpy.array([(b"time".ljust(80), time)], dtype=scalar_type)
+        h5file["integer scalars"] = numpy.array([(name.ljust(80).encode(), value) for name, value in
+                                                 [("nxb", nxb), ("nyb", nyb), ("nzb", 1),
+                                                  ("globalnumblocks", nblocks)]], dtype=integer_type)
+        h5file["unknown names"] = numpy.array([[var.ljust(4).encode()] for var in varlist])
+
+        for var in varlist:
+            h5file[var] = fields[var]
+
+        h5file["block size"] = size
+        h5file["bounding box"] = bounds
+        h5file["refine level"] = numpy.ones(nblocks, dtype="<i4")
+        h5file["node type"] = numpy.ones(nblocks, dtype="<i4")
+        h5file["processor number"] = numpy.zeros(nblocks, dtype="<i4")
+
+    os.replace(filename + ".tmp", filename)
+
+def generate_series(dataset_dir, basename, resolution, nfiles, dt=0.1, nxb=8, nyb=8, linknames=None):
+    """
+    Generate a series of plotfiles for a resolution of the benchmark ladder.
+    Existing series with the same parameters are reused, plotfiles are also
+    linked under every basename in linknames so the same files can be read
+    by analysis modules of other simulations. Returns list of file tags
+    """
+    nblockx, nblocky = LADDER[resolution]
+    parameters = {"basename": basename, "resolution": resolution, "nfiles": nfiles,
+                  "dt": dt, "nxb": nxb, "nyb": nyb}
+
+    os.makedirs(dataset_dir, exist_ok=True)
+    parameter_file = os.path.join(dataset_dir, "synthetic.json")
+
+    if os.path.exists(parameter_file):
+        with open(parameter_file, "r") as synthetic:
+            if json.load(synthetic) == parameters:
+                return [*range(nfiles)]
+
+    for tag in range(nfiles):
+        write_plotfile(os.path.join(dataset_dir, basename + str(tag).zfill(4)),
+                       nblockx*8//nxb, nblocky*8//nyb, nxb, nyb, time=tag*dt)
+
+        for linkname in linknames or []:
+            linkfile = os.path.join(dataset_dir, linkname + str(tag).zfill(4))
+            if os.path.lexists(linkfile):
+                os.remove(linkfile)
+            os.symlink(basename + str(tag).zfill(4), linkfile)
+
+    with open(parameter_file, "w") as synthetic:
+        json.dump(parameters, synthetic)
+
+    return [*range(nfiles)]
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
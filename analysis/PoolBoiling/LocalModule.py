@@ -1,58 +1,186 @@
 import os
 import sys
 import json
+import hashlib
 import itertools
 import numpy
+from scipy import ndimage
+from scipy.stats import t as student_t
 import boxkit
 import boxkit.resources.flash as flash_box
 from boxkit.library import Action
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import AMRModule
+import CommonModule
+import ContourModule
+import PyramidModule
+
 SIM_LENGTH_SCALE = 1e-3
 SIM_TIME_SCALE = 10e-3
 SIM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../simulation/PoolBoiling")
 SIM_BASENAME = "INS_Pool_Boiling_hdf5_plt_cnt_"
+PYRAMID_VARLIST = ["dfun", "velx", "vely", "temp"]
+STATS_VARLIST = ["vely", "temp", "dfun"]
+
+# Version of process_dataset, increment when the
+# computation changes to invalidate cached results
+PROCESS_VERSION = 3
+
+def plotfile_path(dataset_dir, tag):
+    """
+    Get path to plotfile for a file tag
+    """
+    return os.path.join(dataset_dir, SIM_BASENAME + str(tag).zfill(4))
 
-def read_datasets(dataset_dir, file_tags):
+def read_datasets(dataset_dir, file_tags, lazy=False):
     """
-    Read datasets from file tags
+    Read datasets from file tags, if lazy is True return proxies that
+    read header information from the plotfile index and read a
+    variable only when it is indexed. Other data access opens the
+    plotfile until release is called or the with block ends
     """
-    datasets = [boxkit.read_dataset(os.path.join(dataset_dir, SIM_BASENAME + str(tag).zfill(4)),
-                                    source="flash") for tag in file_tags]
+    if lazy:
+        return CommonModule.plotfile_index(dataset_dir, SIM_BASENAME, file_tags)
+
+    datasets = [boxkit.read_dataset(plotfile_path(dataset_dir, tag), source="flash") for tag in file_tags]
     return datasets
 
-def process_dataset(dataset):
+def nearest_file_tags(dataset_dir, times):
+    """
+    Get dictionary of file tags nearest to simulation times for every key
+    """
+    return {key: CommonModule.nearest_file_tags(dataset_dir[key], SIM_BASENAME, times) for key in dataset_dir}
+
+def process_plotfile(filename):
+    """
+    Read a plotfile, process it and release the dataset
+    """
+    with CommonModule.profile_stage("process_plotfile", filename):
+        with CommonModule.profile_stage("read_dataset", filename):
+            dataset = boxkit.read_dataset(filename, source="flash")
+        result = process_dataset(dataset)
+        dataset.purge()
+    return result
+
+def process_plotfile_amr(filename, yloc=0.0):
     """
-    Get heat flux profile
+    Get wall heat flux and bubble diameter on leaf blocks of a plotfile
+    without merging, for runs with lrefine_max > 1. Diameter is computed
+    from the first vapor region, same bubble as process_dataset, with its
+    area in cells of the finest level, which is the cell count that
+    process_dataset measures on uniform grids
     """
-    hflux = numpy.array([])
-    xloc = numpy.array([])
-    iliq = numpy.array([])
+    layout = AMRModule.read_layout(filename)
+    mean_hflux = AMRModule.wall_heat_flux(filename, yloc, nthreads=1, backend="serial")
+    regions = AMRModule.lset_regions(filename, nthreads=1, backend="serial")["volume"]
+
+    area = regions[0]/layout["volume"].min() if len(regions) else 0.
+    return numpy.array([float(layout["time"]), float(mean_hflux), float(2*numpy.sqrt(2*area/numpy.pi))])
+
+def follow_run(run_dir, series_file=None, poll_interval=30., settle_time=60., timeout=None):
+    """
+    Process heat flux and bubble diameter for plotfiles of a running simulation as they
+    are written, appending file tag and result to series_file
+    """
+    series_file = series_file or os.path.join(run_dir, "analysis_series.txt")
+
+    return CommonModule.follow_plotfiles(run_dir, SIM_BASENAME, process_plotfile, series_file,
+                                         version=PROCESS_VERSION, poll_interval=poll_interval,
+                                         settle_time=settle_time, timeout=timeout)
+
+def process_datasets(dataset_dir, file_tags, nthreads=1, backend="loky", cache=True):
+    """
+    Process heat flux and bubble diameter for every key in a study dictionary,
+    distributing plotfiles across a pool of nthreads workers. If cache
+    is True only plotfiles missing from the on-disk cache are processed
+    """
+    filelist = [plotfile_path(dataset_dir[key], tag) for key in dataset_dir for tag in file_tags[key]]
+
+    if cache:
+        resultlist = CommonModule.cached_apply(filelist, process_plotfile, PROCESS_VERSION,
+                                               nthreads=nthreads, backend=backend)
+    else:
+        resultlist = Action(process_plotfile, nthreads=nthreads, backend=backend)(filelist)
 
-    yloc = 0.0
+    results = {}
+    offset = 0
+    for key in dataset_dir:
+        results[key] = numpy.array(resultlist[offset:offset+len(file_tags[key])]).reshape(-1, 3)
+        offset = offset + len(file_tags[key])
 
-    data_slice = boxkit.create_slice(dataset, ymin=yloc, ymax=yloc)
+    return results
 
-    for block in data_slice.blocklist:
+def contour_datasets(dataset_dir, file_tags, nthreads=1, backend="loky"):
+    """
+    Get simulation times and dfun=0 contours for every key in a study
+    dictionary. Contours are cached next to the plotfiles, animations
+    are rendered from them with ContourModule.animate
+    """
+    times, contours = {}, {}
+    for key in dataset_dir:
+        times[key], contours[key] = ContourModule.contour_series(dataset_dir[key], SIM_BASENAME, file_tags[key],
+                                                                 nthreads=nthreads, backend=backend)
+
+    return times, contours
+
+def pyramid_datasets(dataset_dir, file_tags, varlist=None, nthreads=1, backend="loky"):
+    """
+    Export plotfiles of every key in a study dictionary to preview pyramids
+    next to the plotfiles and return dictionary of key to list of pyramid
+    files. Views are read with PyramidModule.read_view and profiles with
+    PyramidModule.read_profile
+    """
+    return {key: PyramidModule.export_series([plotfile_path(dataset_dir[key], tag) for tag in file_tags[key]],
+                                             varlist or PYRAMID_VARLIST, nthreads=nthreads, backend=backend)
+            for key in dataset_dir}
+
+def process_dataset(dataset, yloc=0.0, profile=False):
+    """
+    Get heat flux profile, reading dfun once and temp only for wall blocks
+    to compute wall heat flux, liquid fraction and bubble diameter.
+    If profile is True also return per-x heat flux profile
+    """
+    blocklist = [block for block in dataset.blocklist if block.ymin <= yloc < block.ymax]
+    walltags = sorted(block.tag for block in blocklist)
+
+    with CommonModule.profile_stage("read_variables"):
+        dfun = numpy.asarray(dataset["dfun"][:])
+        walltemp = dict(zip(walltags, numpy.asarray(dataset["temp"][walltags])))
+
+    hflux = numpy.empty(len(blocklist)*dataset.nxb)
+    xloc = numpy.empty(len(blocklist)*dataset.nxb)
+    iliq = numpy.empty(len(blocklist)*dataset.nxb)
+
+    for index, block in enumerate(blocklist):
         yindex = (numpy.abs(block.yrange("center") - yloc)).argmin()
         zindex = 0
-        xloc = numpy.append(xloc, block.xrange("center"))
-        hflux = numpy.append(hflux,(block["dfun"][zindex,yindex,:]<0)*(1-block["temp"][zindex,yindex,:])/(0.5*block.dy))
-        #hflux = numpy.append(hflux,(1-block["temp"][zindex,yindex,:])/(0.5*block.dy))
-        iliq = numpy.append(iliq,block["dfun"][zindex,yindex,:]<0)
+        window = slice(index*dataset.nxb, (index+1)*dataset.nxb)
+        xloc[window] = block.xrange("center")
+        iliq[window] = dfun[block.tag,zindex,yindex,:]<0
+        hflux[window] = iliq[window]*(1-walltemp[block.tag][zindex,yindex,:])/(0.5*block.dy)
 
     mean_hflux = numpy.mean(hflux[:])/numpy.mean(iliq[:])
-    #mean_hflux = numpy.mean(hflux[:])
-
-    merged_dataset = boxkit.mergeblocks(dataset, ["dfun"])
-    merged_dataset.fill_guard_cells()
 
-    shapelist = boxkit.regionprops(merged_dataset, "dfun")
-    if shapelist:
-        diameter = 2*numpy.sqrt(2*shapelist[0]["area"]/numpy.pi)
+    # Label vapor regions on the merged grid using full connectivity
+    # and measure the number of cells of the first region, same as
+    # boxkit.regionprops which reports area in cells
+    with CommonModule.profile_stage("label_bubbles"):
+        labels, nregions = ndimage.label(CommonModule.merge_array(dataset, dfun >= 0),
+                                         structure=numpy.ones((3, 3, 3)))
+    if nregions:
+        area = numpy.count_nonzero(labels == 1)
+        diameter = 2*numpy.sqrt(2*area/numpy.pi)
     else:
         diameter = 0.
 
-    return numpy.array([float(dataset.time), float(mean_hflux), float(diameter)])
+    result = numpy.array([float(dataset.time), float(mean_hflux), float(diameter)])
+
+    if profile:
+        order = xloc.argsort()
+        return result, numpy.array([xloc[order], hflux[order]])
+
+    return result
 
 def ref_comparison_dict():
     """
@@ -218,7 +346,7 @@ def temporal_stats(datasets, backend="serial", nthreads=1):
     ]
 
     # Create an mean dataset
-    stats_dataset = datasets[0].clone(storage="numpy-memmap")
+    stats_dataset = CommonModule.scratch_dataset(datasets[0].clone(storage="numpy-memmap"))
 
     # loop over varlist append values to
     # add it to the variance dataset and peform calculations
@@ -236,25 +364,408 @@ def temporal_stats(datasets, backend="serial", nthreads=1):
         for block, blk_list in zip(dataset.blocklist, blk_reduce_list):
             blk_list.append(block)
 
-    for varkey in varlist_dataset:
-        Action(mean_blk_list, nthreads=nthreads, backend=backend)(
+    with CommonModule.profile_stage("reduce_blocks"):
+        for varkey in varlist_dataset:
+            Action(mean_blk_list, nthreads=nthreads, backend=backend)(
+                (blk_list for blk_list in blk_reduce_list),
+                varkey,
+                sample_size,
+            )
+
+            Action(variance_blk_list, nthreads=nthreads, backend=backend)(
+                (blk_list for blk_list in blk_reduce_list),
+                varkey,
+                sample_size,
+            )
+
+        Action(turb_blk_list, nthreads=nthreads, backend=backend)(
             (blk_list for blk_list in blk_reduce_list),
-            varkey,
             sample_size,
         )
 
-        Action(variance_blk_list, nthreads=nthreads, backend=backend)(
-            (blk_list for blk_list in blk_reduce_list),
-            varkey,
-            sample_size,
+
+    with CommonModule.profile_stage("mergeblocks"):
+        merged_dataset = CommonModule.merge_dataset(stats_dataset, stats_dataset.varlist)
+
+    stats_dataset.purge()
+    return merged_dataset
+
+
+def temporal_stats_stream(dataset_dir, file_tags):
+    """
+    Compute variance and mean by streaming over file tags, reading
+    one plotfile at a time and updating statistics in a single pass
+    """
+    file_tags = iter(file_tags)
+
+    try:
+        tag = next(file_tags)
+    except StopIteration:
+        raise ValueError("[LocalModule.temporal_stats_stream] Empty list of file tags")
+
+    template = boxkit.read_dataset(plotfile_path(dataset_dir, tag), source="flash")
+    partial = merge_stats(sample_stats(template), stream_stats(dataset_dir, file_tags))
+
+    stats_dataset = finalize_stats(partial, template)
+    template.purge()
+
+    return stats_dataset
+
+
+def temporal_stats_parallel(dataset_dir, file_tags, chunk_size=20, nthreads=1, backend="loky",
+                            partials_dir=None, comm=None):
+    """
+    Compute variance and mean by splitting file tags into chunks of chunk_size,
+    computing partial statistics for each chunk on a pool of nthreads workers
+    and merging them pairwise in a tree.
+
+    If partials_dir is provided, partial statistics for each chunk are stored
+    there and reused, so extending file_tags only computes the new chunks.
+    If comm is an mpi4py communicator, chunks are distributed across ranks and
+    the result is returned on rank 0 and None on the other ranks.
+    """
+    file_tags = list(file_tags)
+
+    if not file_tags:
+        raise ValueError("[LocalModule.temporal_stats_parallel] Empty list of file tags")
+
+    chunklist = [file_tags[index:index+chunk_size] for index in range(0, len(file_tags), chunk_size)]
+
+    if comm is not None:
+        chunklist = chunklist[comm.Get_rank()::comm.Get_size()]
+
+    if chunklist:
+        partials = Action(chunk_stats, nthreads=nthreads, backend=backend)(
+            chunklist, dataset_dir, partials_dir
         )
+        partial = reduce_stats(partials)
+    else:
+        partial = {"count": 0}
+
+    if comm is not None:
+        partial = reduce_stats_mpi(partial, comm)
+        if comm.Get_rank() != 0:
+            return None
+
+    template = boxkit.read_dataset(plotfile_path(dataset_dir, file_tags[0]), source="flash")
+    stats_dataset = finalize_stats(partial, template)
+    template.purge()
+
+    return stats_dataset
+
+
+def temporal_stats_amr(dataset_dir, file_tags, output=None, batch_size=64, nthreads=1, backend="loky"):
+    """
+    Compute variance and mean on leaf blocks at any mix of refinement levels,
+    streaming batches of blocks through all plotfiles. Results are written
+    to output, temporal_stats.h5 in dataset_dir by default, which is read
+    back as a dataset with the same variables as temporal_stats
+    """
+    output = output or os.path.join(dataset_dir, "temporal_stats.h5")
+
+    AMRModule.temporal_moments([plotfile_path(dataset_dir, tag) for tag in file_tags], output, STATS_VARLIST,
+                               {"turb_yflux": ("temp", "vely")}, batch_size=batch_size, nthreads=nthreads,
+                               backend=backend)
+
+    return boxkit.read_dataset(output, source="flash")
+
+def stats_pyramid(stats_dataset, dataset_dir, varlist=None):
+    """
+    Export result of temporal_stats to a preview pyramid
+    temporal_stats_pyramid.h5 in dataset_dir
+    """
+    return PyramidModule.export_dataset(stats_dataset, os.path.join(dataset_dir, PyramidModule.PYRAMID_NAME.format(
+        "temporal_stats")), varlist)
+
+def temporal_stats_converge(dataset_dir, file_tags, tolerance=0.02, order="strided", nbatches=10,
+                            min_samples=None, confidence=0.95, seed=0):
+    """
+    Compute variance and mean reading plotfiles in sampling_order until the
+    batch means confidence intervals of the wall-normal profiles of vely_mean,
+    temp_mean and turb_yflux are within tolerance of the largest magnitude
+    of each profile.
+
+    Batches are nbatches contiguous time ranges of file_tags, so correlation
+    in time within a batch widens the intervals. Returns the statistics
+    dataset and a report with file tags read, confidence half-widths,
+    effective sample size and whether the tolerance was met
+    """
+    file_tags = sorted(file_tags)
+
+    if len(file_tags) < 2*nbatches:
+        raise ValueError(f"[LocalModule.temporal_stats_converge] Need at least {2*nbatches} file tags")
+
+    batch_index = {tag: batch for batch, tags in enumerate(numpy.array_split(file_tags, nbatches)) for tag in tags}
+    min_samples = min_samples or 4*nbatches
+
+    batches = [{"count": 0} for _ in range(nbatches)]
+    profiles = []
+    sampled = []
+    template = None
+    report = None
+
+    for tag in sampling_order(file_tags, order, nbatches, seed):
+        with CommonModule.profile_stage("read_dataset", plotfile_path(dataset_dir, tag)):
+            dataset = boxkit.read_dataset(plotfile_path(dataset_dir, tag), source="flash")
+
+        with CommonModule.profile_stage("sample_stats", plotfile_path(dataset_dir, tag)):
+            partial = sample_stats(dataset)
+            profiles.append([horizontal_mean(dataset, partial[varkey]) for varkey in ["vely_mean", "temp_mean"]])
+            batches[batch_index[tag]] = merge_stats(batches[batch_index[tag]], partial)
+
+        sampled.append(tag)
+
+        if template is None:
+            template = dataset
+        else:
+            dataset.purge()
+
+        if len(sampled) >= min_samples and min(batch["count"] for batch in batches) >= 2:
+            report = batch_means(batches, numpy.array(profiles), template, tolerance, confidence)
+            if report["converged"]:
+                break
+
+    if report is None or report["count"] != len(sampled):
+        report = batch_means(batches, numpy.array(profiles), template, tolerance, confidence)
+
+    report["file_tags"] = sorted(sampled)
 
-    Action(turb_blk_list, nthreads=nthreads, backend=backend)(
-        (blk_list for blk_list in blk_reduce_list),
-        sample_size,
-    )
+    stats_dataset = finalize_stats(reduce_stats(batches), template)
+    template.purge()
 
-    return boxkit.mergeblocks(stats_dataset, stats_dataset.varlist)
+    return stats_dataset, report
+
+
+def sampling_order(file_tags, order="strided", nstrata=10, seed=0):
+    """
+    Order file tags for sampling. strided starts with a coarse stride and
+    halves it until every tag is visited so that every prefix covers the
+    whole series, stratified draws one random tag from each of nstrata
+    time ranges per round and sequential keeps the order of file_tags
+    """
+    file_tags = [int(tag) for tag in file_tags]
+
+    if order == "sequential":
+        return file_tags
+
+    if order == "strided":
+        ordered = []
+        visited = set()
+        stride = 1 << max(len(file_tags)-1, 0).bit_length()
+
+        while stride >= 1:
+            for index in range(0, len(file_tags), stride):
+                if index not in visited:
+                    visited.add(index)
+                    ordered.append(file_tags[index])
+            stride = stride//2
+
+        return ordered
+
+    if order == "stratified":
+        generator = numpy.random.default_rng(seed)
+        strata = [list(generator.permutation(stratum)) for stratum in numpy.array_split(file_tags, nstrata)]
+
+        return [int(strata[loc][rank]) for rank in range(max(len(stratum) for stratum in strata))
+                for loc in generator.permutation(len(strata)) if rank < len(strata[loc])]
+
+    raise ValueError(f"[LocalModule.sampling_order] Unknown order {order}")
+
+
+def horizontal_mean(dataset, data):
+    """
+    Average block data over the horizontal directions of
+    the merged grid to get a profile along y
+    """
+    return CommonModule.merge_array(dataset, data).mean(axis=(0, 2))
+
+
+def batch_means(batches, profiles, template, tolerance=0.02, confidence=0.95):
+    """
+    Get batch means confidence half-widths of wall-normal profiles from
+    statistics accumulators of batches, and effective sample size of the
+    vely and temp profiles from profiles of individual samples of shape
+    (nsamples, 2, ny), as sample variance over variance of the mean
+    """
+    batches = [batch for batch in batches if batch["count"] > 0]
+    nbatches = len(batches)
+
+    batch_profiles = {"vely_mean": [horizontal_mean(template, batch["vely_mean"]) for batch in batches],
+                      "temp_mean": [horizontal_mean(template, batch["temp_mean"]) for batch in batches],
+                      "turb_yflux": [horizontal_mean(template, batch["turb_comoment"]/batch["count"])
+                                     for batch in batches]}
+
+    quantile = student_t.ppf(0.5 + confidence/2, nbatches-1)
+    report = {"count": len(profiles), "nbatches": nbatches, "halfwidth": {}, "relative_halfwidth": {}, "ess": {}}
+
+    for varkey, values in batch_profiles.items():
+        values = numpy.array(values)
+        halfwidth = quantile*values.std(axis=0, ddof=1)/numpy.sqrt(nbatches)
+        scale = max(numpy.abs(values.mean(axis=0)).max(), numpy.finfo(float).tiny)
+
+        report["halfwidth"][varkey] = halfwidth
+        report["relative_halfwidth"][varkey] = float(halfwidth.max()/scale)
+
+    for index, varkey in enumerate(["vely_mean", "temp_mean"]):
+        sample_variance = profiles[:, index].var(axis=0, ddof=1)
+        mean_variance = numpy.array(batch_profiles[varkey]).var(axis=0, ddof=1)/nbatches
+        valid = mean_variance > 0
+        ess = numpy.median(sample_variance[valid]/mean_variance[valid]) if valid.any() else len(profiles)
+        report["ess"][varkey] = float(min(ess, len(profiles)))
+
+    report["converged"] = max(report["relative_halfwidth"].values()) <= tolerance
+
+    return report
+
+
+def stream_stats(dataset_dir, file_tags):
+    """
+    Create statistics accumulator by reading one plotfile at a time
+    """
+    partial = {"count": 0}
+
+    for tag in file_tags:
+        with CommonModule.profile_stage("read_dataset", plotfile_path(dataset_dir, tag)):
+            dataset = boxkit.read_dataset(plotfile_path(dataset_dir, tag), source="flash")
+        with CommonModule.profile_stage("sample_stats", plotfile_path(dataset_dir, tag)):
+            partial = merge_stats(partial, sample_stats(dataset))
+        dataset.purge()
+
+    return partial
+
+
+def chunk_stats(chunk, dataset_dir, partials_dir=None):
+    """
+    Create statistics accumulator for a chunk of file tags, loading
+    it from partials_dir if it has been computed before
+    """
+    if not partials_dir:
+        return stream_stats(dataset_dir, chunk)
+
+    chunk_key = hashlib.sha1(f"{os.path.abspath(dataset_dir)}:{chunk}".encode()).hexdigest()[:12]
+    filename = os.path.join(partials_dir, f"stats_{chunk[0]:04d}_{chunk[-1]:04d}_{chunk_key}.npz")
+
+    if os.path.exists(filename):
+        with numpy.load(filename) as partial_file:
+            partial = {key: partial_file[key] for key in partial_file.files}
+        partial["count"] = int(partial["count"])
+        return partial
+
+    partial = stream_stats(dataset_dir, chunk)
+
+    os.makedirs(partials_dir, exist_ok=True)
+    with open(filename + ".tmp", "wb") as partial_file:
+        numpy.savez(partial_file, **partial)
+    os.replace(filename + ".tmp", filename)
+
+    return partial
+
+
+def reduce_stats(partials):
+    """
+    Merge list of statistics accumulators pairwise in a tree
+    """
+    partials = list(partials)
+
+    with CommonModule.profile_stage("reduce_stats"):
+        while len(partials) > 1:
+            partials = [merge_stats(partials[index], partials[index+1]) if index+1 < len(partials)
+                        else partials[index] for index in range(0, len(partials), 2)]
+
+    return partials[0]
+
+
+def reduce_stats_mpi(partial, comm):
+    """
+    Merge statistics accumulators across mpi ranks in a
+    binary tree, result is available on rank 0
+    """
+    rank, size = comm.Get_rank(), comm.Get_size()
+
+    step = 1
+    while step < size:
+        if rank % (2*step) == 0:
+            if rank + step < size:
+                partial = merge_stats(partial, comm.recv(source=rank+step, tag=step))
+        else:
+            comm.send(partial, dest=rank-step, tag=step)
+            break
+        step = 2*step
+
+    return partial
+
+
+def sample_stats(dataset):
+    """
+    Create statistics accumulator from a single dataset
+    """
+    level = dataset.blocklist[0].level
+    for block in dataset.blocklist:
+        if block.level != level:
+            raise ValueError(
+                f"[LocalModule.sample_stats] All blocks must be at level {level}"
+            )
+
+    partial = {"count": 1}
+
+    for varkey in STATS_VARLIST:
+        partial[varkey+"_mean"] = numpy.array(dataset[varkey][:], dtype=float)
+        partial[varkey+"_m2"] = numpy.zeros_like(partial[varkey+"_mean"])
+
+    partial["turb_comoment"] = numpy.zeros_like(partial["temp_mean"])
+
+    return partial
+
+
+def merge_stats(partial, other):
+    """
+    Merge statistics accumulators partial and other using the pairwise
+    update of Chan et al. for mean, M2 and co-moment. Returns a new
+    accumulator, partial and other are left unchanged
+    """
+    if partial["count"] == 0 or other["count"] == 0:
+        source = other if partial["count"] == 0 else partial
+        return {key: numpy.copy(value) if isinstance(value, numpy.ndarray) else value for key, value in source.items()}
+
+    count = partial["count"] + other["count"]
+    weight = partial["count"]*other["count"]/count
+
+    delta = {varkey: other[varkey+"_mean"] - partial[varkey+"_mean"] for varkey in STATS_VARLIST}
+
+    merged = {"count": count,
+              "turb_comoment": partial["turb_comoment"] + other["turb_comoment"] + delta["temp"]*delta["vely"]*weight}
+
+    for varkey in STATS_VARLIST:
+        merged[varkey+"_m2"] = partial[varkey+"_m2"] + other[varkey+"_m2"] + delta[varkey]**2*weight
+        merged[varkey+"_mean"] = partial[varkey+"_mean"] + delta[varkey]*other["count"]/count
+
+    return merged
+
+
+def finalize_stats(partial, dataset):
+    """
+    Convert statistics accumulator to a merged dataset with same
+    layout and variables as temporal_stats
+    """
+    stats_dataset = CommonModule.scratch_dataset(dataset.clone(storage="numpy-memmap"))
+
+    for varkey in STATS_VARLIST:
+        stats_dataset.addvar(varkey+"_mean")
+    stats_dataset.addvar("turb_yflux")
+    for varkey in STATS_VARLIST:
+        stats_dataset.addvar(varkey+"_fluc")
+
+    for varkey in STATS_VARLIST:
+        stats_dataset[varkey+"_mean"][:] = partial[varkey+"_mean"]
+        stats_dataset[varkey+"_fluc"][:] = partial[varkey+"_m2"]/partial["count"]
+
+    stats_dataset["turb_yflux"][:] = partial["turb_comoment"]/partial["count"]
+
+    with CommonModule.profile_stage("mergeblocks"):
+        merged_dataset = CommonModule.merge_dataset(stats_dataset, stats_dataset.varlist)
+
+    stats_dataset.purge()
+    return merged_dataset
 
 
 def variance_blk_list(blk_list, varkey, sample_size):
@@ -263,7 +774,7 @@ def variance_blk_list(blk_list, varkey, sample_size):
     """
     stats_blk = blk_list[0]
 
-    for work_blk in blk_list[2:]:
+    for work_blk in blk_list[1:]:
         stats_blk[varkey+"_fluc"] = (stats_blk[varkey+"_fluc"] 
                                   + (work_blk[varkey] - stats_blk[varkey+"_mean"])**2/sample_size)
 
@@ -273,7 +784,7 @@ def turb_blk_list(blk_list, sample_size):
     """
     stats_blk = blk_list[0]
 
-    for work_blk in blk_list[2:]:
+    for work_blk in blk_list[1:]:
         stats_blk["turb_yflux"] = (stats_blk["turb_yflux"]
             + (work_blk["temp"]-stats_blk["temp_mean"])*(work_blk["vely"]-stats_blk["vely_mean"])/sample_size)
 
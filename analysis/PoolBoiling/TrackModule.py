@@ -0,0 +1,234 @@
+import os
+import sys
+import numpy
+from scipy import ndimage
+from scipy.spatial import cKDTree
+import boxkit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import CommonModule
+import LocalModule
+
+# Version of label_plotfile, increment when the
+# computation changes to invalidate cached regions
+LABEL_VERSION = 1
+
+REGION_COLUMNS = ["volume", "xcenter", "ycenter", "zcenter", "xmin", "ymin", "zmin", "xmax", "ymax", "zmax"]
+TRACK_COLUMNS = ["id", "frame", "time", "volume", "xcenter", "ycenter", "zcenter", "velx", "vely", "velz"]
+BUBBLE_COLUMNS = ["id", "parent", "birth", "departure", "death", "max_volume"]
+EVENT_COLUMNS = ["time", "kind", "id", "other"]
+
+# Event kinds recorded during linking
+EVENT_MERGE = 1
+EVENT_SPLIT = 2
+
+def label_plotfile(filename):
+    """
+    Label every bubble in a plotfile using full connectivity on the merged
+    grid and return array of shape (nbubbles, len(REGION_COLUMNS)) with
+    volume, centroid and bounding box in simulation coordinates
+    """
+    dataset = boxkit.read_dataset(filename, source="flash")
+    regions = label_dataset(dataset)
+    dataset.purge()
+    return regions
+
+def label_dataset(dataset):
+    """
+    Label bubbles of a dataset, see label_plotfile
+    """
+    labels, nregions = ndimage.label(CommonModule.merge_array(dataset, numpy.asarray(dataset["dfun"][:]) >= 0),
+                                     structure=numpy.ones((3, 3, 3)))
+
+    regions = numpy.zeros((nregions, len(REGION_COLUMNS)))
+    if not nregions:
+        return regions
+
+    block = dataset.blocklist[0]
+    spacing = numpy.array([block.dz, block.dy, block.dx])
+    origin = numpy.array([min(block.zmin for block in dataset.blocklist),
+                          min(block.ymin for block in dataset.blocklist),
+                          min(block.xmin for block in dataset.blocklist)])
+
+    index = numpy.arange(1, nregions+1)
+    count = ndimage.sum_labels(numpy.ones(labels.shape), labels, index)
+    center = numpy.array(ndimage.center_of_mass(numpy.ones(labels.shape), labels, index))
+    bounds = numpy.array([[(box.start, box.stop) for box in boxes]
+                          for boxes in ndimage.find_objects(labels)], dtype=float)
+
+    regions[:, 0] = count*numpy.prod(spacing)
+    regions[:, 1:4] = (origin + (center + 0.5)*spacing)[:, ::-1]
+    regions[:, 4:7] = (origin + bounds[:, :, 0]*spacing)[:, ::-1]
+    regions[:, 7:10] = (origin + bounds[:, :, 1]*spacing)[:, ::-1]
+
+    return regions
+
+def label_datasets(dataset_dir, file_tags, nthreads=1, backend="loky"):
+    """
+    Get simulation times and labelled regions for every file tag, cached
+    next to the plotfiles so that tracking can be repeated cheaply
+    """
+    filelist = [LocalModule.plotfile_path(dataset_dir, tag) for tag in file_tags]
+
+    times = CommonModule.plotfile_times(dataset_dir, LocalModule.SIM_BASENAME, file_tags)[1]
+    regionlist = CommonModule.cached_apply(filelist, label_plotfile, LABEL_VERSION,
+                                           nthreads=nthreads, backend=backend)
+
+    return times, [numpy.reshape(regions, (-1, len(REGION_COLUMNS))) for regions in regionlist]
+
+def overlap_pairs(previous, current, margin=0.):
+    """
+    Find pairs of regions in consecutive frames with overlapping bounding
+    boxes. Candidates are found by querying a KD-tree of current centroids
+    within the largest possible centroid distance of overlapping boxes
+    """
+    if not len(previous) or not len(current):
+        return numpy.empty((0, 2), dtype=int)
+
+    diagonal = lambda regions: numpy.linalg.norm(regions[:, 7:10] - regions[:, 4:7], axis=1)
+
+    tree = cKDTree(current[:, 1:4])
+    radius = diagonal(previous) + diagonal(current).max() + 2*margin
+
+    pairs = [(iprev, icurr) for iprev, candidates in enumerate(tree.query_ball_point(previous[:, 1:4], radius))
+             for icurr in candidates]
+
+    if not pairs:
+        return numpy.empty((0, 2), dtype=int)
+
+    pairs = numpy.array(pairs, dtype=int)
+    overlap = numpy.all((previous[pairs[:, 0], 4:7] <= current[pairs[:, 1], 7:10] + margin) &
+                        (current[pairs[:, 1], 4:7] <= previous[pairs[:, 0], 7:10] + margin), axis=1)
+
+    return pairs[overlap]
+
+def link_regions(times, regionlist, margin=0., yloc=0.0):
+    """
+    Link labelled regions across frames and assign persistent bubble ids.
+
+    Regions with overlapping bounding boxes in consecutive frames are
+    connected. When bubbles merge the largest parent keeps its id and the
+    others end, when a bubble splits the largest child keeps the id and the
+    others start with the bubble as parent. Returns dictionary of arrays
+    with TRACK_COLUMNS, BUBBLE_COLUMNS and EVENT_COLUMNS. Departure time
+    is the first time a bubble that touched the wall at yloc lifts off
+    """
+    idlist = []
+    parent = []
+    events = []
+
+    for frame, regions in enumerate(regionlist):
+        current_ids = numpy.full(len(regions), -1, dtype=int)
+        split_from = {}
+
+        if frame:
+            previous, previous_ids = regionlist[frame-1], idlist[-1]
+            pairs = overlap_pairs(previous, regions, margin)
+
+            # Every previous region continues into its largest overlapping child
+            best_child = {}
+            for iprev, icurr in pairs:
+                if iprev not in best_child or regions[icurr, 0] > regions[best_child[iprev], 0]:
+                    best_child[iprev] = icurr
+
+            # A child reached by several parents is a merge, it keeps the id of the largest
+            for iprev in sorted(best_child, key=lambda iprev: -previous[iprev, 0]):
+                icurr = best_child[iprev]
+                if current_ids[icurr] < 0:
+                    current_ids[icurr] = previous_ids[iprev]
+                else:
+                    events.append([times[frame], EVENT_MERGE, previous_ids[iprev], current_ids[icurr]])
+
+            # Remaining overlapping children are split from their largest parent
+            for iprev, icurr in pairs:
+                if current_ids[icurr] < 0 and (icurr not in split_from or previous[iprev, 0] > previous[split_from[icurr], 0]):
+                    split_from[icurr] = iprev
+
+        for icurr in numpy.flatnonzero(current_ids < 0):
+            current_ids[icurr] = len(parent)
+            parent.append(-1)
+
+            if icurr in split_from:
+                parent[-1] = previous_ids[split_from[icurr]]
+                events.append([times[frame], EVENT_SPLIT, parent[-1], current_ids[icurr]])
+
+        idlist.append(current_ids)
+
+    return build_tables(times, regionlist, idlist, numpy.array(parent, dtype=int), events, yloc)
+
+def build_tables(times, regionlist, idlist, parent, events, yloc=0.0):
+    """
+    Build track, bubble and event tables from region ids of every frame
+    """
+    nrows = sum(len(regions) for regions in regionlist)
+
+    tracks = numpy.zeros((nrows, len(TRACK_COLUMNS)))
+    touched = numpy.zeros(nrows, dtype=bool)
+
+    offset = 0
+    for frame, (regions, ids) in enumerate(zip(regionlist, idlist)):
+        window = slice(offset, offset+len(regions))
+        tracks[window, 0] = ids
+        tracks[window, 1] = frame
+        tracks[window, 2] = times[frame]
+        tracks[window, 3:7] = regions[:, :4]
+        touched[window] = regions[:, 5] <= yloc
+        offset = offset + len(regions)
+
+    # Sort by id and frame so that every bubble is a contiguous block of rows
+    order = numpy.lexsort((tracks[:, 1], tracks[:, 0]))
+    tracks = tracks[order]
+    touched = touched[order]
+
+    bubble_ids, start, count = numpy.unique(tracks[:, 0].astype(int), return_index=True, return_counts=True)
+    bubbles = numpy.full((len(bubble_ids), len(BUBBLE_COLUMNS)), numpy.nan)
+
+    for index, (bubble, first, length) in enumerate(zip(bubble_ids, start, count)):
+        rows = slice(first, first+length)
+
+        if length > 1:
+            tracks[rows, 7:10] = numpy.gradient(tracks[rows, 4:7], tracks[rows, 2], axis=0)
+
+        onwall = numpy.flatnonzero(touched[rows])
+        lifted = numpy.flatnonzero(~touched[rows])
+        if len(onwall) and len(lifted[lifted > onwall[0]]):
+            bubbles[index, 3] = tracks[first + lifted[lifted > onwall[0]][0], 2]
+
+        bubbles[index, 0] = bubble
+        bubbles[index, 1] = parent[bubble]
+        bubbles[index, 2] = tracks[first, 2]
+        bubbles[index, 4] = tracks[first+length-1, 2]
+        bubbles[index, 5] = tracks[rows, 3].max()
+
+    return {"tracks": tracks,
+            "bubbles": bubbles,
+            "events": numpy.array(events, dtype=float).reshape(-1, len(EVENT_COLUMNS))}
+
+def track_bubbles(dataset_dir, file_tags, margin=0., yloc=0.0, nthreads=1, backend="loky"):
+    """
+    Track bubbles for every key in a study dictionary. Labelling is
+    distributed across nthreads workers and linking is done in one pass
+    """
+    tracking = {}
+    for key in dataset_dir:
+        times, regionlist = label_datasets(dataset_dir[key], file_tags[key], nthreads, backend)
+        tracking[key] = link_regions(times, regionlist, margin, yloc)
+
+    return tracking
+
+def save_tracking(tracking, prefix):
+    """
+    Save tables from track_bubbles as text files prefix_<key>_<table>.txt
+    """
+    columns = {"tracks": TRACK_COLUMNS, "bubbles": BUBBLE_COLUMNS, "events": EVENT_COLUMNS}
+
+    for key in tracking:
+        for table in columns:
+            numpy.savetxt(f"{prefix}_{key.replace('/', '_')}_{table}.txt", tracking[key][table],
+                          header=" ".join(columns[table]))
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
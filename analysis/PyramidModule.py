@@ -0,0 +1,174 @@
+import os
+import h5py
+import numpy
+import boxkit
+from boxkit.library import Action
+
+import CommonModule
+
+# Version of write_pyramid, increment when the
+# layout changes to invalidate exported pyramids
+PYRAMID_VERSION = 1
+
+PYRAMID_NAME = "{}_pyramid.h5"
+
+def downsample(data):
+    """
+    Average 2x2 cells in the last two axes, odd sizes
+    are padded by repeating the last row or column
+    """
+    pad = [(0, 0)]*(data.ndim-2) + [(0, data.shape[-2] % 2), (0, data.shape[-1] % 2)]
+    data = numpy.pad(data, pad, mode="edge")
+    return data.reshape(*data.shape[:-2], data.shape[-2]//2, 2, data.shape[-1]//2, 2).mean(axis=(-3, -1))
+
+def write_pyramid(output, fields, bounds, attributes=None, min_size=64, chunk=128, dtype="float32"):
+    """
+    Write merged fields of shape (nz, ny, nx) to output with one group per
+    variable holding level_0 at full resolution and 2x downsampled levels
+    in the x-y plane down to min_size cells, as well as row_mean, mean along
+    x, and column_mean, mean along y, at full resolution. Levels are stored
+    in compressed chunks of chunk x chunk cells so that a view reads only
+    the tiles it covers. bounds is (xmin, xmax, ymin, ymax)
+    """
+    with CommonModule.profile_stage("write_pyramid", output), h5py.File(output + ".tmp", "w") as h5file:
+        h5file.attrs.update({"version": PYRAMID_VERSION, "bounds": numpy.asarray(bounds, dtype=float),
+                             **(attributes or {})})
+
+        for varkey, data in fields.items():
+            group = h5file.create_group(varkey)
+            group["row_mean"] = data.mean(axis=2)
+            group["column_mean"] = data.mean(axis=1)
+
+            level = 0
+            while True:
+                group.create_dataset(f"level_{level}", data=data.astype(dtype), compression="gzip",
+                                     compression_opts=1, shuffle=True,
+                                     chunks=(1, min(chunk, data.shape[1]), min(chunk, data.shape[2])))
+                if max(data.shape[1:]) <= min_size:
+                    break
+                data = downsample(data)
+                level += 1
+
+            group.attrs["nlevels"] = level + 1
+            group.attrs["shape"] = group["level_0"].shape
+
+    os.replace(output + ".tmp", output)
+    return output
+
+def export_dataset(dataset, output, varlist=None, attributes=None, **kwargs):
+    """
+    Export variables of a dataset, for example the result of temporal_stats,
+    to a pyramid. All blocks must be at the same level, keyword arguments are
+    passed to write_pyramid
+    """
+    varlist = varlist or dataset.varlist
+
+    bounds = [min(block.xmin for block in dataset.blocklist), max(block.xmax for block in dataset.blocklist),
+              min(block.ymin for block in dataset.blocklist), max(block.ymax for block in dataset.blocklist)]
+
+    fields = {varkey: CommonModule.merge_array(dataset, numpy.asarray(dataset[varkey][:])) for varkey in varlist}
+    return write_pyramid(output, fields, bounds, attributes, **kwargs)
+
+def pyramid_current(output, filename, varlist):
+    """
+    Check if pyramid exists for the current version of a plotfile
+    and holds every variable in varlist
+    """
+    if not os.path.exists(output):
+        return False
+
+    with h5py.File(output, "r") as h5file:
+        return (h5file.attrs.get("version") == PYRAMID_VERSION
+                and tuple(h5file.attrs.get("fingerprint", ())) == CommonModule.file_fingerprint(filename)
+                and all(varkey in h5file for varkey in varlist))
+
+def export_plotfile(filename, varlist, output=None, **kwargs):
+    """
+    Export variables of a plotfile to a pyramid next to it, unless the
+    pyramid is already current. Returns path to pyramid
+    """
+    output = output or PYRAMID_NAME.format(filename)
+
+    if pyramid_current(output, filename, varlist):
+        return output
+
+    with CommonModule.profile_stage("export_plotfile", filename):
+        time = CommonModule.plotfile_time(filename)
+        dataset = boxkit.read_dataset(filename, source="flash")
+        export_dataset(dataset, output, varlist, {"time": time, "fingerprint": CommonModule.file_fingerprint(filename)},
+                       **kwargs)
+        dataset.purge()
+
+    return output
+
+def export_series(filelist, varlist, nthreads=1, backend="loky"):
+    """
+    Export pyramids for plotfiles in filelist on a pool of nthreads workers
+    """
+    with CommonModule.profile_stage("export_series"):
+        return Action(export_plotfile, nthreads=nthreads, backend=backend)(list(filelist), varlist)
+
+def select_level(group, bounds, xlim, ylim, pixels):
+    """
+    Get coarsest level with at least pixels (width, height) cells across the
+    window and its cell size. Cell size of every level is the domain extent
+    over the shape of that level, so that cells of levels padded by
+    downsample span the domain and their centers stay inside it
+    """
+    for level in reversed(range(group.attrs["nlevels"])):
+        ny, nx = group[f"level_{level}"].shape[1:]
+        dx, dy = (bounds[1]-bounds[0])/nx, (bounds[3]-bounds[2])/ny
+        if (xlim[1]-xlim[0])/dx >= pixels[0] and (ylim[1]-ylim[0])/dy >= pixels[1]:
+            return level, dx, dy
+
+    ny, nx = group["level_0"].shape[1:]
+    return 0, (bounds[1]-bounds[0])/nx, (bounds[3]-bounds[2])/ny
+
+def read_view(filename, varkey, xlim=None, ylim=None, pixels=(1000, 1000), zindex=0):
+    """
+    Read variable in the window xlim, ylim from the coarsest pyramid level
+    that still has pixels (width, height) cells across the window, only
+    tiles that overlap the window are read. Returns cell centers x, y and
+    data of shape (ny, nx) for pcolormesh, contour or imshow
+    """
+    with h5py.File(filename, "r") as h5file:
+        if varkey not in h5file:
+            raise ValueError(f"[PyramidModule.read_view] Variable {varkey} not found in {filename}")
+
+        bounds = h5file.attrs["bounds"]
+        xlim = bounds[:2] if xlim is None else xlim
+        ylim = bounds[2:] if ylim is None else ylim
+
+        group = h5file[varkey]
+        level, dx, dy = select_level(group, bounds, xlim, ylim, pixels)
+        nz, ny, nx = group[f"level_{level}"].shape
+
+        xstart = min(max(int(numpy.floor((xlim[0]-bounds[0])/dx)), 0), nx)
+        xend = min(max(int(numpy.ceil((xlim[1]-bounds[0])/dx)), xstart), nx)
+        ystart = min(max(int(numpy.floor((ylim[0]-bounds[2])/dy)), 0), ny)
+        yend = min(max(int(numpy.ceil((ylim[1]-bounds[2])/dy)), ystart), ny)
+
+        with CommonModule.profile_stage("read_view", filename):
+            data = group[f"level_{level}"][zindex, ystart:yend, xstart:xend]
+
+    return (bounds[0] + (numpy.arange(xstart, xend) + 0.5)*dx,
+            bounds[2] + (numpy.arange(ystart, yend) + 0.5)*dy, data)
+
+def read_profile(filename, varkey, axis="y", zindex=0):
+    """
+    Read precomputed mean of a variable along x as a profile in y
+    for axis y or mean along y as a profile in x for axis x.
+    Returns cell centers and profile
+    """
+    with h5py.File(filename, "r") as h5file:
+        bounds = h5file.attrs["bounds"]
+        profile = h5file[varkey]["row_mean" if axis == "y" else "column_mean"][zindex]
+
+    lower, upper = bounds[2:] if axis == "y" else bounds[:2]
+    return lower + (numpy.arange(len(profile)) + 0.5)*(upper-lower)/len(profile), profile
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
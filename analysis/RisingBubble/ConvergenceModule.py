@@ -0,0 +1,169 @@
+import re
+import functools
+import numpy
+import boxkit
+import LocalModule
+import CommonModule
+
+# Version of restrict_plotfile, increment when the
+# computation changes to invalidate cached fields
+RESTRICT_VERSION = 1
+
+# Safety factor for grid convergence index with three levels
+GCI_SAFETY_FACTOR = 1.25
+
+def ladder_keys(dataset_dir):
+    """
+    Get keys of a refinement ladder sorted from coarse to fine
+    """
+    return sorted(dataset_dir, key=ladder_resolution)
+
+def ladder_resolution(key):
+    """
+    Get resolution from a ladder key like Case2/h160
+    """
+    match = re.search(r"h(\d+)", key)
+
+    if not match:
+        raise ValueError(f"[ConvergenceModule.ladder_resolution] Unable to find resolution in key {key!r}")
+
+    return int(match.group(1))
+
+def grid_shape(filename):
+    """
+    Get shape (ny, nx) of the uniform grid for a plotfile
+    """
+    dataset = boxkit.read_dataset(filename, source="flash")
+    shape = (int(round((dataset.ymax-dataset.ymin)/dataset.blocklist[0].dy)),
+             int(round((dataset.xmax-dataset.xmin)/dataset.blocklist[0].dx)))
+    dataset.purge()
+
+    return shape
+
+def restrict_plotfile(filename, shape, varlist):
+    """
+    Read a plotfile, merge varlist and restrict it to a grid of given shape
+    """
+    dataset = boxkit.read_dataset(filename, source="flash")
+    block = LocalModule.merged_block(dataset, varlist)
+
+    fields = []
+    for var in varlist:
+        data = LocalModule.block_interior(block, var)
+        fields.append(LocalModule.restrict_data(data, data.shape[-1]//shape[-1]))
+
+    dataset.purge()
+
+    return numpy.array(fields)
+
+def restricted_fields(dataset_dir, file_tags, shape, varlist=None, nthreads=1, backend="loky"):
+    """
+    Get fields for every key restricted to a grid of given shape as arrays
+    of size (ntags, nvar, ny, nx). Restricted fields are cached next to the
+    plotfiles, so adding a level to a ladder costs one new restriction
+    """
+    varlist = varlist or ["dfun", "velx", "vely"]
+
+    filelist = [LocalModule.plotfile_path(dataset_dir[key], tag) for key in dataset_dir for tag in file_tags[key]]
+
+    resultlist = CommonModule.cached_apply(filelist, functools.partial(restrict_plotfile, shape=shape, varlist=varlist),
+                                           RESTRICT_VERSION, label=f"restrict_plotfile:{shape[0]}x{shape[1]}:{','.join(varlist)}",
+                                           nthreads=nthreads, backend=backend)
+
+    fields = {}
+    offset = 0
+    for key in dataset_dir:
+        fields[key] = numpy.array(resultlist[offset:offset+len(file_tags[key])])
+        offset = offset + len(file_tags[key])
+
+    return fields
+
+def field_convergence(dataset_dir, file_tags, varlist=None, nthreads=1, backend="loky"):
+    """
+    Compute convergence of fields for a refinement ladder. Fields for
+    every level are restricted to the coarsest grid and each file tag of
+    the coarsest level is paired with the plotfile nearest in time
+    """
+    varlist = varlist or ["dfun", "velx", "vely"]
+    keys = ladder_keys(dataset_dir)
+
+    times = CommonModule.plotfile_times(dataset_dir[keys[0]], LocalModule.SIM_BASENAME, file_tags[keys[0]])[1]
+    file_tags = {key: CommonModule.nearest_file_tags(dataset_dir[key], LocalModule.SIM_BASENAME, times, file_tags[key])
+                 for key in keys}
+
+    shape = grid_shape(LocalModule.plotfile_path(dataset_dir[keys[0]], file_tags[keys[0]][0]))
+    fields = restricted_fields(dataset_dir, file_tags, shape, varlist, nthreads, backend)
+
+    solutions = {var: [fields[key][:, index] for key in keys] for index, var in enumerate(varlist)}
+
+    return {var: ladder_convergence(keys, solutions[var]) for var in varlist}
+
+def quantity_convergence(dataset_dir, file_tags, nthreads=1, backend="loky"):
+    """
+    Compute convergence of benchmark quantities for a refinement ladder.
+    Series for every level are resampled onto a common time base
+    """
+    keys = ladder_keys(dataset_dir)
+    results = CommonModule.align_series(LocalModule.process_datasets(dataset_dir, file_tags,
+                                                                     nthreads=nthreads, backend=backend))
+    quantlist = ["area", "circularity", "center", "velocity"]
+
+    return {quant: ladder_convergence(keys, [results[key][:, index+1] for key in keys])
+            for index, quant in enumerate(quantlist)}
+
+def ladder_convergence(keys, solutions):
+    """
+    Compute errors relative to the finest level, observed order between
+    successive levels and Richardson extrapolation with grid convergence
+    index from the three finest levels for each norm
+    """
+    ratios = [ladder_resolution(fine)/ladder_resolution(coarse) for coarse, fine in zip(keys[:-1], keys[1:])]
+    reference = {normkey: max(value, 1e-300) for normkey, value in norms(solutions[-1]).items()}
+
+    convergence = {"levels": keys}
+
+    for normkey in ["L1", "L2", "Linf"]:
+        error = numpy.array([norms(solution - solutions[-1])[normkey]/reference[normkey]
+                             for solution in solutions[:-1]])
+
+        convergence[normkey] = {"error": error,
+                                "order": numpy.log(error[:-1]/error[1:])/numpy.log(ratios[:len(error)-1])}
+
+        if len(solutions) >= 3:
+            convergence[normkey].update(richardson(*solutions[-3:], ratios[-1], normkey, ratios[-2]))
+
+    return convergence
+
+def richardson(coarse, medium, fine, ratio, normkey="L2", coarse_ratio=None):
+    """
+    Richardson extrapolation for three solutions on a common grid. Returns
+    observed order, extrapolated solution, its relative error estimate and the
+    grid convergence index of the finest solution
+    """
+    if coarse_ratio and not numpy.isclose(coarse_ratio, ratio):
+        raise ValueError(f"[ConvergenceModule.richardson] Non-constant refinement ratio {coarse_ratio} and {ratio}")
+
+    error_coarse = norms(medium - coarse)[normkey]
+    error_fine = norms(fine - medium)[normkey]
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        order = numpy.log(error_coarse/error_fine)/numpy.log(ratio)
+        extrapolated = fine + (fine - medium)/(ratio**order - 1)
+        relative_error = error_fine/norms(fine)[normkey]/(ratio**order - 1)
+
+    return {"observed_order": float(order),
+            "extrapolated": extrapolated,
+            "extrapolated_error": float(relative_error),
+            "gci": float(GCI_SAFETY_FACTOR*relative_error)}
+
+def norms(data):
+    """
+    Compute L1, L2 and Linf norms of data
+    """
+    return LocalModule.array_norms(numpy.array(data, dtype=float))
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
@@ -1,33 +1,229 @@
 import os
+import sys
 import numpy
 import boxkit
 import boxkit.resources.flash as flash_box
+from boxkit.library import Action
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import AMRModule
+import CommonModule
+import ContourModule
+import PyramidModule
+
+SIM_XMIN = -1
 SIM_YMIN = -1
 SIM_LENGTH_SCALE = 0.5
 SIM_TIME_SCALE = 0.71
 SIM_SCALE = numpy.array([SIM_TIME_SCALE, SIM_LENGTH_SCALE**2, 1, SIM_LENGTH_SCALE, SIM_LENGTH_SCALE/SIM_TIME_SCALE])
 SIM_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../simulation")
 SIM_BASENAME = "INS_Rising_Bubble_hdf5_plt_cnt_"
+PYRAMID_VARLIST = ["dfun", "velx", "vely"]
+
+# Version of process_dataset, increment when the
+# computation changes to invalidate cached results
+PROCESS_VERSION = 2
+
+def plotfile_path(dataset_dir, tag):
+    """
+    Get path to plotfile for a file tag
+    """
+    return os.path.join(dataset_dir, SIM_BASENAME + str(tag).zfill(4))
 
-def read_datasets(dataset_dir, file_tags):
+def read_datasets(dataset_dir, file_tags, lazy=False):
     """
-    Read datasets from file tags
+    Read datasets from file tags, if lazy is True return proxies that
+    read header information from the plotfile index and read a
+    variable only when it is indexed. Other data access opens the
+    plotfile until release is called or the with block ends
     """
-    datasets = [boxkit.read_dataset(os.path.join(dataset_dir, SIM_BASENAME + str(tag).zfill(4)),
-                                    source="flash") for tag in file_tags]
+    if lazy:
+        return CommonModule.plotfile_index(dataset_dir, SIM_BASENAME, file_tags)
+
+    datasets = [boxkit.read_dataset(plotfile_path(dataset_dir, tag), source="flash") for tag in file_tags]
     return datasets
 
+def nearest_file_tags(dataset_dir, times):
+    """
+    Get dictionary of file tags nearest to simulation times for every key
+    """
+    return {key: CommonModule.nearest_file_tags(dataset_dir[key], SIM_BASENAME, times) for key in dataset_dir}
+
+def process_plotfile(filename):
+    """
+    Read a plotfile, process it and release the dataset
+    """
+    with CommonModule.profile_stage("process_plotfile", filename):
+        with CommonModule.profile_stage("read_dataset", filename):
+            dataset = boxkit.read_dataset(filename, source="flash")
+        result = process_dataset(dataset)
+        dataset.purge()
+    return result
+
+def process_plotfile_amr(filename):
+    """
+    Process benchmark quantities on leaf blocks of a plotfile without merging,
+    for runs with lrefine_max > 1. Quantities are summed over all bubbles,
+    which equals process_plotfile as long as there is a single bubble
+    """
+    measures = AMRModule.lset_measures(filename, nthreads=1, backend="serial")
+
+    return numpy.array([float(measures["time"]), float(measures["volume"]), float(measures["circularity"]),
+                        float(measures["centroid"][1] - SIM_YMIN), float(measures["velocity"][1])])
+
+def follow_run(run_dir, series_file=None, poll_interval=30., settle_time=60., timeout=None):
+    """
+    Process benchmark quantities for plotfiles of a running simulation as they
+    are written, appending file tag and result to series_file
+    """
+    series_file = series_file or os.path.join(run_dir, "analysis_series.txt")
+
+    return CommonModule.follow_plotfiles(run_dir, SIM_BASENAME, process_plotfile, series_file,
+                                         version=PROCESS_VERSION, poll_interval=poll_interval,
+                                         settle_time=settle_time, timeout=timeout)
+
+def process_datasets(dataset_dir, file_tags, nthreads=1, backend="loky", cache=True):
+    """
+    Process benchmark quantities for every key in a study dictionary,
+    distributing plotfiles across a pool of nthreads workers. If cache
+    is True only plotfiles missing from the on-disk cache are processed
+    """
+    filelist = [plotfile_path(dataset_dir[key], tag) for key in dataset_dir for tag in file_tags[key]]
+
+    if cache:
+        resultlist = CommonModule.cached_apply(filelist, process_plotfile, PROCESS_VERSION,
+                                               nthreads=nthreads, backend=backend)
+    else:
+        resultlist = Action(process_plotfile, nthreads=nthreads, backend=backend)(filelist)
+
+    results = {}
+    offset = 0
+    for key in dataset_dir:
+        results[key] = numpy.array(resultlist[offset:offset+len(file_tags[key])]).reshape(-1, 5)
+        offset = offset + len(file_tags[key])
+
+    return results
+
+def contour_datasets(dataset_dir, file_tags, nthreads=1, backend="loky"):
+    """
+    Get simulation times and dfun=0 contours for every key in a study
+    dictionary. Contours are cached next to the plotfiles, animations
+    are rendered from them with ContourModule.animate
+    """
+    times, contours = {}, {}
+    for key in dataset_dir:
+        times[key], contours[key] = ContourModule.contour_series(dataset_dir[key], SIM_BASENAME, file_tags[key],
+                                                                 nthreads=nthreads, backend=backend)
+
+    return times, contours
+
+def pyramid_datasets(dataset_dir, file_tags, varlist=None, nthreads=1, backend="loky"):
+    """
+    Export plotfiles of every key in a study dictionary to preview pyramids
+    next to the plotfiles and return dictionary of key to list of pyramid
+    files. Views are read with PyramidModule.read_view and profiles with
+    PyramidModule.read_profile
+    """
+    return {key: PyramidModule.export_series([plotfile_path(dataset_dir[key], tag) for tag in file_tags[key]],
+                                             varlist or PYRAMID_VARLIST, nthreads=nthreads, backend=backend)
+            for key in dataset_dir}
+
 
 def process_dataset(dataset):
     """
     Process dataset to get values for benchmark quantities
     """
-    merged_dataset = boxkit.mergeblocks(dataset, ["dfun", "velx", "vely"])
-    merged_dataset.fill_guard_cells()
+    with CommonModule.profile_stage("mergeblocks"):
+        merged_dataset = CommonModule.merge_dataset(dataset, ["dfun", "velx", "vely"], storage="numpy")
+
+    with CommonModule.profile_stage("fill_guard_cells"):
+        merged_dataset.fill_guard_cells()
+
+    return measure_main_bubble(merged_dataset, dataset.time)
+
+def process_dataset_band(dataset, band=3, hint=None):
+    """
+    Process dataset to get values for benchmark quantities by merging only
+    blocks around the interface band |dfun| < band*dx instead of the whole
+    domain. hint is the window (xmin, xmax, ymin, ymax) returned for the
+    previous frame and is used to search for the band first. Returns values
+    and the window for the next frame
+    """
+    blocklist = dataset.blocklist
+    bounds = numpy.array([[block.xmin, block.xmax, block.ymin, block.ymax] for block in blocklist])
+    blocksize = bounds[0, [1, 3]] - bounds[0, [0, 2]]
+    delta = band*blocklist[0].dx
+
+    if hint is None:
+        candidates = numpy.arange(len(blocklist))
+    else:
+        candidates = numpy.flatnonzero(block_window_mask(bounds, hint, blocksize*1e-6))
+
+    with CommonModule.profile_stage("read_variables"):
+        dfun = numpy.asarray(dataset["dfun"][candidates.tolist()])
+
+    bandtags = candidates[numpy.abs(dfun).reshape(len(candidates), -1).min(axis=1) < delta]
+
+    # Search whole domain if the band is missing or reaches
+    # an edge of the hinted window inside the domain
+    if hint is not None:
+        edges = [(bounds[bandtags, 0] < hint[0] + blocksize[0]/2) & (hint[0] > dataset.xmin + blocksize[0]/2),
+                 (bounds[bandtags, 1] > hint[1] - blocksize[0]/2) & (hint[1] < dataset.xmax - blocksize[0]/2),
+                 (bounds[bandtags, 2] < hint[2] + blocksize[1]/2) & (hint[2] > dataset.ymin + blocksize[1]/2),
+                 (bounds[bandtags, 3] > hint[3] - blocksize[1]/2) & (hint[3] < dataset.ymax - blocksize[1]/2)]
+
+        if not len(bandtags) or any(edge.any() for edge in edges):
+            return process_dataset_band(dataset, band, hint=None)
+
+    if not len(bandtags):
+        raise ValueError(f"[LocalModule.process_dataset_band] No interface found in {dataset!r}")
+
+    # Expand bounding box of band blocks by one
+    # block, limited to domain boundaries
+    window = (max(bounds[bandtags, 0].min() - blocksize[0], dataset.xmin),
+              min(bounds[bandtags, 1].max() + blocksize[0], dataset.xmax),
+              max(bounds[bandtags, 2].min() - blocksize[1], dataset.ymin),
+              min(bounds[bandtags, 3].max() + blocksize[1], dataset.ymax))
 
-    shapelist = flash_box.lset_shape_measurement_2d(merged_dataset, correction=True)
-    quantlist = flash_box.lset_quant_measurement_2d(merged_dataset)
+    windowtags = numpy.flatnonzero(block_window_mask(bounds, window, blocksize*1e-6)).tolist()
+
+    merged_dataset = boxkit.create_dataset(nblockx=1, nblocky=1, nblockz=1,
+                                           nxb=int(round((window[1]-window[0])/blocklist[0].dx)),
+                                           nyb=int(round((window[3]-window[2])/blocklist[0].dy)),
+                                           nzb=1, xmin=window[0], xmax=window[1], ymin=window[2], ymax=window[3],
+                                           zmin=dataset.zmin, zmax=dataset.zmax, storage="numpy-memmap")
+    CommonModule.scratch_dataset(merged_dataset)
+
+    for varkey in ["dfun", "velx", "vely"]:
+        merged_dataset.addvar(varkey)
+        block = merged_dataset.blocklist[0]
+        block[varkey][block.zguard:block.nzb+block.zguard,
+                      block.yguard:block.nyb+block.yguard,
+                      block.xguard:block.nxb+block.xguard] = CommonModule.merge_array(
+                          dataset, numpy.asarray(dataset[varkey][windowtags]), windowtags)
+
+    with CommonModule.profile_stage("fill_guard_cells"):
+        merged_dataset.fill_guard_cells()
+
+    result = measure_main_bubble(merged_dataset, dataset.time)
+    merged_dataset.purge()
+
+    return result, window
+
+def block_window_mask(bounds, window, tolerance):
+    """
+    Get mask of blocks inside window (xmin, xmax, ymin, ymax) up to tolerance
+    """
+    return ((bounds[:, 0] >= window[0] - tolerance[0]) & (bounds[:, 1] <= window[1] + tolerance[0]) &
+            (bounds[:, 2] >= window[2] - tolerance[1]) & (bounds[:, 3] <= window[3] + tolerance[1]))
+
+def measure_main_bubble(merged_dataset, time):
+    """
+    Measure benchmark quantities for the bubble with largest area
+    """
+    with CommonModule.profile_stage("lset_measurement"):
+        shapelist = flash_box.lset_shape_measurement_2d(merged_dataset, correction=True)
+        quantlist = flash_box.lset_quant_measurement_2d(merged_dataset)
 
     if len(shapelist) != len(quantlist):
         raise ValueError(f"len(shapelist) == {len(shapelist)} and len(quantlist) == {len(quantlist)}")
@@ -38,6 +234,7 @@ def process_dataset(dataset):
 
     for shape, quant in zip(shapelist, quantlist):
         if shape["area"] > max_bubble_area:
+            max_bubble_area = shape["area"]
             main_bubble_shape = shape
             main_bubble_quant = quant
 
@@ -45,50 +242,123 @@ def process_dataset(dataset):
     center = main_bubble_quant["centroid"][0] - SIM_YMIN
     area = main_bubble_shape["area"]
     velocity = main_bubble_quant["velocity"][0]
-    time = dataset.time
 
     return numpy.array([float(time), float(area), float(circularity), float(center), float(velocity)])
 
+def process_series_band(dataset_dir, file_tags, band=3):
+    """
+    Process benchmark quantities for a series of file tags using the
+    narrow-band measurement, passing the window of each frame to the next
+    """
+    results = []
+    window = None
+
+    for tag in file_tags:
+        with CommonModule.profile_stage("read_dataset", plotfile_path(dataset_dir, tag)):
+            dataset = boxkit.read_dataset(plotfile_path(dataset_dir, tag), source="flash")
+        result, window = process_dataset_band(dataset, band, hint=window)
+        dataset.purge()
+        results.append(result)
+
+    return numpy.array(results).reshape(-1, 5)
+
 def compute_norm(fine_datasets, coarse_datasets, order=None, scale=None):
     """
-    Compute norm between two datasets
+    Compute norm between two datasets, order is 1, 2 (default) or numpy.inf
     """
-    varlist = ["dfun", "velx", "vely"]
+    norms = compute_norms(fine_datasets, coarse_datasets, scale=scale)
+    normkey = {None: "L2", 1: "L1", 2: "L2", numpy.inf: "Linf"}[order]
 
-    fine_blocks =  [boxkit.mergeblocks(dataset, varlist).blocklist[0] for dataset in fine_datasets]
-    coarse_blocks = [boxkit.mergeblocks(dataset, varlist).blocklist[0] for dataset in coarse_datasets]
+    return {var: norms[var][normkey] for var in norms}
 
-    norm = dict(zip(varlist, [0.]*len(varlist)))
+def compute_norms(fine_datasets, coarse_datasets, scale=None, varlist=None):
+    """
+    Compute L1, L2 and Linf norms between fine and coarse datasets or
+    pre-merged blocks, restricting both to a common grid
+    """
+    varlist = varlist or ["dfun", "velx", "vely"]
 
-    for fblock, cblock in zip(fine_blocks, coarse_blocks):
+    with CommonModule.profile_stage("mergeblocks"):
+        fine_blocks = [merged_block(dataset, varlist) for dataset in fine_datasets]
+        coarse_blocks = [merged_block(dataset, varlist) for dataset in coarse_datasets]
 
-        if not scale:
-            scale = {"coarse": 1, "fine": int(cblock.dx/fblock.dx)}
+    norms = {var: {"L1": 0., "L2": 0., "Linf": 0.} for var in varlist}
 
-        for var in varlist:
-            cdata = cblock[var][0,cblock.yguard:cblock.nyb+cblock.yguard, cblock.xguard:cblock.nxb+cblock.xguard]        
-            fdata = fblock[var][0,fblock.yguard:fblock.nyb+fblock.yguard, fblock.xguard:fblock.nxb+fblock.xguard]
+    with CommonModule.profile_stage("restrict_norms"):
+        for fblock, cblock in zip(fine_blocks, coarse_blocks):
 
-            cwork = get_offset_data(cdata, scale["coarse"])
-            fwork = get_offset_data(fdata, scale["fine"])
+            if not scale:
+                scale = {"coarse": 1, "fine": int(round(cblock.dx/fblock.dx))}
 
-            norm[var] = norm[var] + numpy.linalg.norm(fwork-cwork, ord=order)/len(coarse_blocks)
+            for var in varlist:
+                cwork = restrict_data(block_interior(cblock, var), scale["coarse"])
+                fwork = restrict_data(block_interior(fblock, var), scale["fine"])
 
-    return norm
+                for normkey, value in array_norms(numpy.subtract(fwork, cwork)).items():
+                    norms[var][normkey] += value/len(coarse_blocks)
 
-def get_offset_data(data, scale):
+    return norms
+
+def array_norms(error):
     """
-    Offset data
+    Compute L1, L2 and Linf norms of an array in one pass, error is overwritten
+    """
+    error = numpy.abs(error, out=error).ravel()
+
+    return {"L1": float(error.sum()), "L2": float(numpy.sqrt(numpy.dot(error, error))), "Linf": float(error.max())}
+
+def merged_block(dataset, varlist):
+    """
+    Get merged block from a dataset, blocks and single block datasets are returned as is
+    """
+    if not hasattr(dataset, "blocklist"):
+        return dataset
+
+    if len(dataset.blocklist) == 1:
+        return dataset.blocklist[0]
+
+    return CommonModule.merge_dataset(dataset, varlist, storage="numpy").blocklist[0]
+
+def block_interior(block, var):
+    """
+    Get data for a variable without guard cells, 2D data is returned as a 2D array
+    """
+    data = block[var][block.zguard:block.nzb+block.zguard,
+                      block.yguard:block.nyb+block.yguard,
+                      block.xguard:block.nxb+block.xguard]
+
+    if block.nzb == 1:
+        data = data[0]
+
+    return data
+
+def restrict_data(data, scale):
+    """
+    Restrict data to a coarser grid by averaging over scale**ndim cells.
+    The average is computed on a strided view of data, without temporaries
     """
     if scale == 1:
-        work = data
-    else:
-        work = 0.
-        for xoff in range(scale):
-            for yoff in range(scale):
-                work = work + data[yoff::scale, xoff::scale]/(scale**2)
+        return data
+
+    if any(size % scale for size in data.shape):
+        raise ValueError(f"[LocalModule.restrict_data] Shape {data.shape} not divisible by scale {scale}")
+
+    data = numpy.asarray(data)
+
+    shape, strides = [], []
+    for size, stride in zip(data.shape, data.strides):
+        shape.extend([size//scale, scale])
+        strides.extend([stride*scale, stride])
+
+    view = numpy.lib.stride_tricks.as_strided(data, shape=shape, strides=strides, writeable=False)
 
-    return work
+    return view.mean(axis=tuple(range(1, 2*data.ndim, 2)))
+
+def get_offset_data(data, scale):
+    """
+    Offset data
+    """
+    return restrict_data(data, scale)
 
 def case2_grid_convergence_dict():
     """
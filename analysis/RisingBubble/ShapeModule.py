@@ -0,0 +1,166 @@
+import numpy
+from scipy.spatial import cKDTree
+
+import LocalModule
+import StoreModule
+
+# Reference shapes are given at final time of both cases
+REFERENCE_TIME = 3.0
+
+SHAPE_ERROR_COLUMNS = ["hausdorff", "mean_distance", "symmetric_difference"]
+
+def reference_shapes(case):
+    """
+    Get reference bubble shapes of a case as dictionary of group and level,
+    for example g1l4, to segments of shape (nsegments, 2, 2). Consecutive
+    points of the reference files are the end points of a segment
+    """
+    shapes = StoreModule.query(quantity="shape", kind="reference", case=case)
+
+    if not shapes:
+        raise ValueError(f"[ShapeModule.reference_shapes] No reference shapes for case {case}, "
+                         + "run StoreModule.build_reference_store")
+
+    return {name.split("_")[-1][2:]: numpy.stack([shape["x"], shape["y"]], axis=1).reshape(-1, 2, 2)
+            for name, shape in shapes.items()}
+
+def reference_coordinates(contour):
+    """
+    Map contour vertices from simulation to reference coordinates
+    """
+    return (numpy.asarray(contour, dtype=float) - [LocalModule.SIM_XMIN, LocalModule.SIM_YMIN])*LocalModule.SIM_LENGTH_SCALE
+
+def contour_segments(contour):
+    """
+    Get segments of shape (nsegments, 2, 2) from a contour of
+    ContourModule with polylines separated by a row of NaN
+    """
+    vertices = numpy.reshape(numpy.asarray(contour, dtype=float), (-1, 2))
+    segments = numpy.stack([vertices[:-1], vertices[1:]], axis=1)
+    return segments[~numpy.isnan(segments).any(axis=(1, 2))]
+
+def sample_segments(segments, spacing):
+    """
+    Sample points along segments at most spacing apart. Returns points
+    and length of curve represented by every point, so that means over
+    points are means over arc length
+    """
+    length = numpy.linalg.norm(segments[:, 1]-segments[:, 0], axis=1)
+    count = numpy.maximum(numpy.ceil(length/spacing).astype(int), 1)
+
+    index = numpy.repeat(numpy.arange(len(segments)), count)
+    offset = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count)-count, count)
+    fraction = (offset + 0.5)/count[index]
+
+    points = segments[index, 0] + fraction[:, None]*(segments[index, 1]-segments[index, 0])
+    return points, (length/count)[index]
+
+def rasterize(segments, origin, spacing, shape):
+    """
+    Get mask of grid cells with centers inside the closed curves made of
+    segments. Crossings of segments with every row of cell centers are
+    counted once in the first cell to their right, the even-odd rule is
+    then a cumulative sum along rows, so segments need not be ordered
+    """
+    nrows, ncols = shape
+    start, end = segments[:, 0], segments[:, 1]
+
+    # rows with centers in [lower, upper) of every segment
+    lower = numpy.minimum(start[:, 1], end[:, 1])
+    upper = numpy.maximum(start[:, 1], end[:, 1])
+    first = numpy.clip(numpy.ceil((lower-origin[1])/spacing - 0.5).astype(int), 0, nrows)
+    last = numpy.clip(numpy.ceil((upper-origin[1])/spacing - 0.5).astype(int), 0, nrows)
+    count = numpy.maximum(last-first, 0)
+
+    index = numpy.repeat(numpy.arange(len(segments)), count)
+    row = first[index] + numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count)-count, count)
+
+    ycenter = origin[1] + (row + 0.5)*spacing
+    xcross = start[index, 0] + (ycenter-start[index, 1])*(end[index, 0]-start[index, 0])/(end[index, 1]-start[index, 1])
+    column = numpy.clip(numpy.ceil((xcross-origin[0])/spacing - 0.5).astype(int), 0, ncols)
+
+    crossings = numpy.bincount(row*(ncols+1) + column, minlength=nrows*(ncols+1)).reshape(nrows, ncols+1)
+    return (numpy.cumsum(crossings[:, :ncols], axis=1) % 2).astype(bool)
+
+def shape_errors(contours, references, resolution=2048):
+    """
+    Compare every contour with every reference shape. Contours is a
+    dictionary of key to list of contours in reference coordinates, one
+    per frame, and references a dictionary of name to segments. Curves
+    are sampled and rasterized once on a common grid with resolution cells
+    along its longest side, distances from all contours to a reference
+    are one KD-tree query. Returns list of (key, frame, reference) labels
+    and array of SHAPE_ERROR_COLUMNS with a row for every label
+    """
+    shapes = {(key, frame): contour_segments(contour)
+              for key in contours for frame, contour in enumerate(contours[key])}
+    shapes.update({name: numpy.asarray(segments, dtype=float) for name, segments in references.items()})
+
+    vertices = numpy.concatenate([segments.reshape(-1, 2) for segments in shapes.values()])
+    if not len(vertices):
+        raise ValueError("[ShapeModule.shape_errors] No contour or reference segments to compare")
+
+    lower, upper = vertices.min(axis=0), vertices.max(axis=0)
+    spacing = (upper-lower).max()/resolution
+    origin = lower - 2*spacing
+    grid = tuple(numpy.ceil((upper-lower)/spacing).astype(int)[::-1] + 4)
+
+    samples = {label: sample_segments(segments, spacing) for label, segments in shapes.items()}
+    masks = {label: rasterize(segments, origin, spacing, grid) for label, segments in shapes.items()}
+    trees = {label: cKDTree(samples[label][0]) for label in shapes if len(shapes[label])}
+
+    frames = [label for label in shapes if label not in references and label in trees]
+    points = numpy.concatenate([samples[label][0] for label in frames] + [numpy.empty((0, 2))])
+    weights = numpy.concatenate([samples[label][1] for label in frames] + [numpy.empty(0)])
+    offsets = numpy.cumsum([0] + [len(samples[label][0]) for label in frames])[:-1]
+
+    labels, values = [], []
+    for name in references:
+        if name not in trees or not frames:
+            continue
+
+        # distances from all frames to reference
+        distance = trees[name].query(points, workers=-1)[0]
+        frame_max = numpy.maximum.reduceat(distance, offsets)
+        frame_mean = numpy.add.reduceat(distance*weights, offsets)/numpy.add.reduceat(weights, offsets)
+
+        reference_points, reference_weights = samples[name]
+        for index, label in enumerate(frames):
+            distance = trees[label].query(reference_points, workers=-1)[0]
+            labels.append((*label, name))
+            values.append([max(frame_max[index], distance.max()),
+                           0.5*(frame_mean[index] + numpy.average(distance, weights=reference_weights)),
+                           numpy.count_nonzero(masks[label] ^ masks[name])*spacing**2])
+
+    for label in shapes:
+        if label not in references and label not in trees:
+            labels.extend([(*label, name) for name in references])
+            values.extend([[numpy.nan]*len(SHAPE_ERROR_COLUMNS)]*len(references))
+
+    return labels, numpy.array(values).reshape(-1, len(SHAPE_ERROR_COLUMNS))
+
+def compare_study(dataset_dir, case, time=REFERENCE_TIME, resolution=2048, nthreads=1, backend="loky"):
+    """
+    Compare dfun=0 contours nearest to reference time for every key of a
+    study dictionary with every reference group and level of a case.
+    Contours are taken from the cache of LocalModule.contour_datasets
+    """
+    file_tags = LocalModule.nearest_file_tags(dataset_dir, [time/LocalModule.SIM_TIME_SCALE])
+    contours = LocalModule.contour_datasets(dataset_dir, file_tags, nthreads=nthreads, backend=backend)[1]
+
+    return shape_errors({key: [reference_coordinates(contour) for contour in contours[key]] for key in contours},
+                        reference_shapes(case), resolution)
+
+def print_errors(labels, values):
+    """
+    Print table of shape errors
+    """
+    print(f"{'key':<24} {'frame':>5} {'reference':>9} " + " ".join(f"{column:>20}" for column in SHAPE_ERROR_COLUMNS))
+    for (key, frame, name), row in zip(labels, values):
+        print(f"{key!s:<24} {frame:>5} {name:>9} " + " ".join(f"{value:>20.6e}" for value in row))
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    pass
@@ -0,0 +1,112 @@
+import os
+import re
+import json
+import glob
+import numpy
+
+STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Benchmarks/Store")
+REFERENCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Benchmarks/Reference")
+
+COLUMNS = {"bench": ["time", "area", "circularity", "center", "velocity"], "shape": ["x", "y"]}
+
+def read_manifest(store_path=STORE_PATH):
+    """
+    Read manifest of the store, building reference series on first use,
+    also when computed series have been stored before any reference
+    """
+    manifest_file = os.path.join(store_path, "manifest.json")
+
+    if not any(entry.get("kind") == "reference" for entry in load_manifest(manifest_file).values()):
+        build_reference_store(store_path)
+
+    return load_manifest(manifest_file)
+
+def load_manifest(manifest_file):
+    """
+    Load manifest file, empty if it does not exist
+    """
+    if not os.path.exists(manifest_file):
+        return {}
+
+    with open(manifest_file, "r") as manifest:
+        return json.load(manifest)
+
+def write_series(name, data, attributes, store_path=STORE_PATH):
+    """
+    Write series of shape (nrows, ncolumns) to the store column by column
+    and register it in the manifest with attributes
+    """
+    os.makedirs(store_path, exist_ok=True)
+    manifest_file = os.path.join(store_path, "manifest.json")
+
+    entries = load_manifest(manifest_file)
+
+    numpy.save(os.path.join(store_path, name + ".npy"), numpy.ascontiguousarray(numpy.asarray(data, dtype=float).T))
+    entries[name] = {**attributes, "file": name + ".npy", "nrows": int(len(data))}
+
+    with open(manifest_file + ".tmp", "w") as manifest:
+        json.dump(entries, manifest, indent=1, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+def build_reference_store(store_path=STORE_PATH, reference_path=REFERENCE_PATH):
+    """
+    Convert reference benchmark quantities and bubble shapes from text
+    files named c<case>g<group>l<level>[s].txt to the store
+    """
+    for filename in sorted(glob.glob(os.path.join(reference_path, "*", "c*g*l*.txt"))):
+        case, group, level, shape = re.match(r"c(\d+)g(\d+)l(\d+)(s?)\.txt", os.path.basename(filename)).groups()
+        quantity = "shape" if shape else "bench"
+
+        write_series(f"reference_{quantity}_c{case}g{group}l{level}", numpy.loadtxt(filename),
+                     {"kind": "reference", "quantity": quantity, "case": int(case),
+                      "group": int(group), "level": int(level)}, store_path)
+
+def store_results(dataset_dir, results, store_path=STORE_PATH):
+    """
+    Store results of LocalModule.process_datasets for keys like Case2/h160
+    with the archive date taken from dataset_dir
+    """
+    for key in results:
+        case = int(re.search(r"Case(\d+)", key).group(1))
+        resolution = int(re.search(r"h(\d+)", key).group(1))
+        archive = os.path.basename(os.path.normpath(dataset_dir[key]))
+        name = "computed_bench_" + re.sub(r"[^A-Za-z0-9.-]+", "_", key) + "_" + archive
+
+        write_series(name, results[key], {"kind": "computed", "quantity": "bench", "case": case,
+                                          "resolution": resolution, "archive": archive, "key": key}, store_path)
+
+def query(columns=None, quantity="bench", store_path=STORE_PATH, **attributes):
+    """
+    Query series matching quantity and attributes such as kind, case, group,
+    level, resolution, archive or key. Returns dictionary of series name to
+    dictionary of memory-mapped columns
+    """
+    manifest = read_manifest(store_path)
+    columns = columns or COLUMNS[quantity]
+
+    matches = {}
+    for name, entry in sorted(manifest.items()):
+        if entry["quantity"] != quantity:
+            continue
+        if any(entry.get(key) != value for key, value in attributes.items()):
+            continue
+
+        data = numpy.load(os.path.join(store_path, entry["file"]), mmap_mode="r")
+        matches[name] = {column: data[COLUMNS[quantity].index(column)] for column in columns}
+
+    return matches
+
+def reference(case, group, level, quantity="bench", store_path=STORE_PATH):
+    """
+    Get memory-mapped reference series with same layout as numpy.loadtxt
+    """
+    manifest = read_manifest(store_path)
+    entry = manifest[f"reference_{quantity}_c{case}g{group}l{level}"]
+
+    return numpy.load(os.path.join(store_path, entry["file"]), mmap_mode="r").T
+
+if __name__ == "__main__":
+    """
+    Main
+    """
+    build_reference_store()
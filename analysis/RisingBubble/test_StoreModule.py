@@ -0,0 +1,14 @@
+import numpy
+
+import StoreModule
+
+def test_reference_after_store_results(tmp_path):
+    """
+    References are built when computed results are stored first
+    """
+    results = {"Case1/h40": numpy.array([[0.0, 0.2, 1.0, 0.5, 0.0], [0.1, 0.2, 0.99, 0.51, 0.1]])}
+    StoreModule.store_results({"Case1/h40": str(tmp_path / "2024-01-01")}, results, store_path=str(tmp_path))
+
+    assert StoreModule.reference(1, 1, 4, store_path=str(tmp_path)).shape[1] == 5
+    assert StoreModule.query(quantity="shape", kind="reference", case=1, store_path=str(tmp_path))
+    assert StoreModule.query(kind="computed", store_path=str(tmp_path))
@@ -1,15 +1,11 @@
 # cache the value of current working directory
 NodeDir=$(realpath .)
 
-# run Flash-X setup
-cd $FLASHX_HOME && echo Flash-X HEAD is at $(git rev-parse --short HEAD)
-cd $FLASHX_HOME && git checkout $FlashSha && ./setup $FlashOptions
-
-# compile the simulation and copy files
-cd $FLASHX_HOME/object && make -j && cp flashx $NodeDir/ && cp setup_params $NodeDir/
-
-# copy AMReX configuration
-cd $AMREX2D_HOME/lib/pkgconfig && cp amrex.pc $NodeDir/
-
-# chdir into node directory and do clean up
-cd $NodeDir && rm -rf $FLASHX_HOME/object
+# report Flash-X commit used for the build
+cd $FLASHX_HOME && echo Flash-X build uses commit $(git rev-parse --short $FlashSha)
+
+# build Flash-X once for every combination of FlashSha, FlashOptions,
+# site Makefile.h and AMReX installation, then link flashx,
+# setup_params and amrex.pc from the build cache
+source $PROJECT_HOME/simulation/flashBuildCache.sh
+flashBuildCache $NodeDir $AMREX2D_HOME
@@ -11,6 +11,12 @@ if [[ $SiteName == "summit/gcc-10.2.0" || $SiteName == "summit/gcc-9.3.0" ]]; th
 	export NGPU_PER_NODE=6
 	export NRS_PER_NODE=6
 	export NMPI_PER_RS=7
+
+	# use MPI layout chosen by planRun.py for this run
+	if [ -f $JobWorkDir/resources.env ]; then
+		source $JobWorkDir/resources.env
+	fi
+
 	export NCORES_PER_RS=$(($NCORES_PER_NODE / $NRS_PER_NODE))
 	export NCORES_PER_MPI=$(($NCORES_PER_RS / $NMPI_PER_RS))
 	export NRS=$(($NNODES * $NRS_PER_NODE))
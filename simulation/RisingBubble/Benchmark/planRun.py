@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import math
+import click
+import numpy
+
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../../analysis/Performance"))
+import HarvestModule
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Run from the README used to estimate cost per cell update when no
+# runs have been harvested, Case2/h640 took 15 hours on 350 processors
+README_RUN = {"case": "Case2", "points": 640, "hours": 15, "ranks": 350}
+
+# Blocks per rank added to the work of every rank in the
+# parallel efficiency model b/(b+OVERHEAD_BLOCKS)
+OVERHEAD_BLOCKS = 1.0
+
+# Memory estimate per cell including guard cells, face variables and
+# multigrid levels, and fixed memory per MPI rank in bytes
+BYTES_PER_CELL = 1500
+BYTES_PER_RANK = 200e6
+
+# Resources per node and wall time limits as (maximum nodes, hours),
+# summit values follow calResources.sh and the batch queue policy
+SITES = {"summit": {"cores_per_node": 42, "rs_per_node": 6, "max_mpi_per_rs": 7, "memory_per_node": 512e9,
+                    "wall_limits": [(45, 2), (91, 6), (921, 12), (4608, 24)]},
+         "default": {"cores_per_node": 32, "rs_per_node": 1, "max_mpi_per_rs": 32, "memory_per_node": 128e9,
+                     "wall_limits": [(1000000, 24)]}}
+
+def read_setup(case):
+    """
+    Read dimensionless setup from top level and case flash.toml files
+    """
+    with open(os.path.join(BENCHMARK_PATH, "flash.toml"), "rb") as tomlfile:
+        setup = tomllib.load(tomlfile)
+
+    with open(os.path.join(BENCHMARK_PATH, case, "flash.toml"), "rb") as tomlfile:
+        for section, values in tomllib.load(tomlfile).items():
+            setup.setdefault(section, {}).update(values)
+
+    return setup
+
+def read_block_size():
+    """
+    Read cells per block nxb and nyb from setup options in flashOptions.sh
+    """
+    with open(os.path.join(BENCHMARK_PATH, "flashOptions.sh"), "r") as optionsfile:
+        options = optionsfile.read()
+
+    size = [re.search(rf"-{key}=(\d+)", options) for key in ["nxb", "nyb"]]
+
+    if not all(size):
+        raise ValueError("[planRun.read_block_size] nxb and nyb not found in flashOptions.sh")
+
+    return tuple(int(match.group(1)) for match in size)
+
+def grid_blocks(setup, points, nxb, nyb):
+    """
+    Get number of blocks in x and y for points across the domain width
+    """
+    grid = setup["Grid"]
+    nblockx = points//nxb
+    nblocky = int(round(points*(grid["ymax"]-grid["ymin"])/(grid["xmax"]-grid["xmin"])/nyb))
+
+    return nblockx, nblocky
+
+def run_time_step(case, points):
+    """
+    Get ins_dtSpec of an existing run Case*/h<points>/flash.toml or None
+    """
+    filename = os.path.join(BENCHMARK_PATH, case, f"h{points}", "flash.toml")
+
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, "rb") as tomlfile:
+        return tomllib.load(tomlfile).get("IncompNS", {}).get("ins_dtSpec")
+
+def reference_cost(run=None):
+    """
+    Get core-seconds per cell update of a reference run, README_RUN by
+    default, from its cells, its steps tmax/ins_dtSpec and the parallel
+    efficiency model of plan_resources, so that planning the same run on
+    the same number of ranks reproduces its wall time
+    """
+    run = run or README_RUN
+    setup = read_setup(run["case"])
+    nxb, nyb = read_block_size()
+    nblockx, nblocky = grid_blocks(setup, run["points"], nxb, nyb)
+
+    dt = run_time_step(run["case"], run["points"])
+    if dt is None:
+        raise ValueError(f"[planRun.reference_cost] No ins_dtSpec for {run['case']}/h{run['points']}")
+
+    steps = math.ceil(setup["Driver"]["tmax"]/dt)
+    blocks_per_rank = nblockx*nblocky/run["ranks"]
+    efficiency = blocks_per_rank/(blocks_per_rank + OVERHEAD_BLOCKS)
+
+    return run["hours"]*3600*run["ranks"]*efficiency/(nblockx*nblocky*nxb*nyb*steps)
+
+def time_step(setup, h, velocity=1.0, safety=1.0):
+    """
+    Get time step limits for grid spacing h: advective CFL with ins_cfl,
+    explicit viscous with ins_sigma using the larger kinematic viscosity
+    of the two phases and capillary limit of Brackbill et al.
+    Returns dictionary of limits and the smallest limit times safety
+    """
+    inv_reynolds = setup["IncompNS"]["ins_invReynolds"]
+    rho_gas = setup["Multiphase"]["mph_rhoGas"]
+    mu_gas = setup["Multiphase"]["mph_muGas"]
+    inv_weber = setup["Multiphase"]["mph_invWeber"]
+
+    limits = {"cfl": setup["IncompNS"]["ins_cfl"]*h/velocity,
+              "viscous": setup["IncompNS"]["ins_sigma"]*h**2/(inv_reynolds*max(1., mu_gas/rho_gas)),
+              "capillary": numpy.sqrt((1+rho_gas)*h**3/(4*numpy.pi*inv_weber))}
+
+    return limits, safety*min(limits.values())
+
+def calibrated_cost(study, site, database=HarvestModule.DATABASE_FILE):
+    """
+    Get median cost per cell-update of harvested runs for a study on a
+    site, falling back to all sites and then to reference_cost. Returns
+    cost and number of runs it is calibrated from
+    """
+    if os.path.exists(database):
+        runs = [run for run in HarvestModule.query_runs(database, study=study) if run["cost_per_cell_update"]]
+
+        for selected in [[run for run in runs if str(run["site"]).startswith(site)], runs]:
+            if selected:
+                return float(numpy.median([run["cost_per_cell_update"] for run in selected])), len(selected)
+
+    return reference_cost(), 0
+
+def wall_limit(site, nodes):
+    """
+    Get wall time limit in hours for a number of nodes
+    """
+    for max_nodes, hours in SITES[site]["wall_limits"]:
+        if nodes <= max_nodes:
+            return hours
+    return None
+
+def plan_resources(nblocks, block_cells, cell_updates, cost, site="summit", maxblocks=100,
+                   overhead_blocks=OVERHEAD_BLOCKS, margin=0.2, max_segments=1, max_nodes=4608):
+    """
+    Choose nodes and MPI ranks per resource set for nblocks blocks of
+    block_cells cells. Parallel efficiency is
+    modelled as b/(b+overhead_blocks) for b blocks per rank. Candidates must
+    fit maxblocks and memory per node, the plan with fewest node-hours
+    among those needing at most max_segments jobs within the wall time
+    limit is returned, otherwise the plan with fewest jobs
+    """
+    resources = SITES[site]
+    cells = nblocks*block_cells
+    candidates = []
+
+    for nmpi_per_rs in range(1, resources["max_mpi_per_rs"]+1):
+        for nodes in range(1, max_nodes+1):
+            ranks = nodes*resources["rs_per_node"]*nmpi_per_rs
+            blocks_per_rank = nblocks/ranks
+
+            if blocks_per_rank < 1:
+                break
+            if math.ceil(blocks_per_rank) > maxblocks:
+                continue
+
+            memory = cells*BYTES_PER_CELL/nodes + ranks/nodes*BYTES_PER_RANK
+            if memory > resources["memory_per_node"]:
+                continue
+
+            efficiency = blocks_per_rank/(blocks_per_rank + overhead_blocks)
+            wall_time = cost*cell_updates/(ranks*efficiency)
+            limit = wall_limit(site, nodes)
+
+            if limit is None:
+                break
+
+            candidates.append({"nodes": nodes, "nrs": nodes*resources["rs_per_node"], "nmpi_per_rs": nmpi_per_rs,
+                               "ranks": ranks, "blocks_per_rank": blocks_per_rank, "efficiency": efficiency,
+                               "wall_time": wall_time, "memory_per_node": memory,
+                               "node_hours": wall_time*nodes/3600,
+                               "core_hours": wall_time*nodes*resources["cores_per_node"]/3600,
+                               "segments": math.ceil(wall_time*(1+margin)/(limit*3600)),
+                               "wall_request": min(limit*3600, wall_time*(1+margin))})
+
+    if not candidates:
+        raise ValueError(f"[planRun.plan_resources] No decomposition of {nblocks} blocks fits {site}")
+
+    feasible = [plan for plan in candidates if plan["segments"] <= max_segments]
+    if feasible:
+        return min(feasible, key=lambda plan: (plan["node_hours"], plan["nodes"]))
+
+    return min(candidates, key=lambda plan: (plan["segments"], plan["node_hours"]))
+
+def write_toml(filename, nblockx, nblocky, dt):
+    """
+    Write Grid, IncompNS and Driver sections of a run like Case*/h*/flash.toml
+    """
+    with open(filename, "w") as tomlfile:
+        tomlfile.write(f"[Grid]\n  nblockx = {nblockx}\n  nblocky = {nblocky}\n  nrefs = 10000\n"
+                       + "  lrefine_min = 1\n  lrefine_max = 1\n\n")
+        tomlfile.write(f"[IncompNS]\n  ins_dtSpec = {dt:.7g}\n\n")
+        tomlfile.write(f"[Driver]\n  dtinit = {dt:.7g}\n  dtmax = {dt:.7g}\n")
+
+def write_jobfile(filename, nodes, wall_request):
+    """
+    Write Jobfile of a run like Case*/h*/Jobfile with the number of nodes
+    and wall time on the bsub command line, which takes precedence over
+    the #BSUB -nnodes and -W options inherited from the root Jobfile
+    """
+    minutes = int(math.ceil(wall_request/60/15)*15)
+
+    with open(filename, "w") as jobfile:
+        jobfile.write("# YAML configuration file for `jobrunner`.\n\n"
+                      + "# schedular command generated by planRun.py, command line\n"
+                      + "# options override #BSUB options of the root Jobfile\n"
+                      + f"schedular:\n  command: bsub -nnodes {nodes} -W {minutes//60}:{minutes%60:02d}\n\n"
+                      + "# job configuration for setting up and submitting jobs,\n"
+                      + "# archive and clean artifacts, defining target and input scripts\n"
+                      + "job:\n  input:\n    - flash.toml\n"
+                      + "  archive:\n    - flash.par\n    - \"*_hdf5_*\"\n    - \"*.log\"\n    - \"*.out\"\n"
+                      + "  clean:\n    - flash.par\n    - \"*_hdf5_*\"\n    - \"*.log\"\n    - \"unitTest*\"\n"
+                      + "    - \"*.out\"\n    - \"*.log\"\n")
+
+def write_resources(filename, nmpi_per_rs):
+    """
+    Write MPI layout of a run to resources.env, which calResources.sh
+    sources from the job directory in place of its default layout
+    """
+    with open(filename, "w") as envfile:
+        envfile.write("# MPI layout generated by planRun.py, read by calResources.sh\n"
+                      + f"export NMPI_PER_RS={nmpi_per_rs}\n")
+
+
+@click.command(name="planRun")
+@click.argument("case", type=click.Choice(["Case1", "Case2"]))
+@click.argument("points", type=int)
+@click.option("--site", "-s", type=click.Choice(list(SITES)), default="summit", help="Site for resources")
+@click.option("--velocity", type=float, default=1.0, help="Maximum velocity for the CFL limit")
+@click.option("--safety", type=float, default=1.0, help="Factor applied to the smallest time step limit")
+@click.option("--dt", type=float, help="Time step, defaults to ins_dtSpec of an existing run or the limits")
+@click.option("--max-segments", type=int, default=1, help="Number of restart jobs allowed")
+@click.option("--write", is_flag=True, help="Write flash.toml and Jobfile to Case/h<points>")
+@click.option("--force", is_flag=True, help="Overwrite existing flash.toml and Jobfile")
+def plan(case, points, site, velocity, safety, dt, max_segments, write, force):
+    """
+    \b
+    Plan time step, decomposition and resources
+    for a resolution of the benchmark ladder
+    """
+    setup = read_setup(case)
+    grid = setup["Grid"]
+
+    nxb, nyb = read_block_size()
+    nblockx, nblocky = grid_blocks(setup, points, nxb, nyb)
+    h = (grid["xmax"]-grid["xmin"])/points
+
+    limits, dt_limit = time_step(setup, h, velocity, safety)
+    dt_run = run_time_step(case, points)
+    dt_source = "option" if dt else "existing run" if dt_run else "limits"
+    dt = dt or dt_run or dt_limit
+
+    steps = math.ceil(setup["Driver"]["tmax"]/dt)
+    cell_updates = float(nblockx*nblocky*nxb*nyb)*steps
+    cost, nruns = calibrated_cost("RisingBubble/Benchmark", site)
+
+    resources = plan_resources(nblockx*nblocky, nxb*nyb, cell_updates, cost, site, max_segments=max_segments)
+
+    print(f"Grid: nblockx = {nblockx}, nblocky = {nblocky}, nxb = {nxb}, nyb = {nyb}, h = {h:.6g}")
+    print("Time step limits: " + ", ".join(f"{key} = {value:.4g}" for key, value in limits.items())
+          + f", dt = {dt:.7g} from {dt_source}")
+    print(f"Steps: {steps}, cell updates: {cell_updates:.4g}")
+    print(f"Cost per cell-update: {cost:.4g} core-s " + (f"from {nruns} runs" if nruns else "(README run)"))
+    print(f"Nodes: {resources['nodes']}, NRS = {resources['nrs']}, NMPI_PER_RS = {resources['nmpi_per_rs']}, "
+          + f"ranks = {resources['ranks']}, blocks/rank = {resources['blocks_per_rank']:.1f}")
+    print(f"Wall time: {resources['wall_time']/3600:.2f} h in {resources['segments']} job(s), "
+          + f"core-hours: {resources['core_hours']:.1f}, memory/node: {resources['memory_per_node']/1e9:.1f} GB")
+
+    if write:
+        rundir = os.path.join(BENCHMARK_PATH, case, f"h{points}")
+
+        if os.path.exists(os.path.join(rundir, "flash.toml")) and not force:
+            print(f"Not overwriting existing run in {rundir}, use --force")
+            return
+
+        os.makedirs(rundir, exist_ok=True)
+        write_toml(os.path.join(rundir, "flash.toml"), nblockx, nblocky, dt)
+        write_jobfile(os.path.join(rundir, "Jobfile"), resources["nodes"], resources["wall_request"])
+        write_resources(os.path.join(rundir, "resources.env"), resources["nmpi_per_rs"])
+        print(f"Written flash.toml, Jobfile and resources.env to {rundir}")
+
+if __name__ == "__main__":
+    plan()
@@ -0,0 +1,92 @@
+# Content addressed cache for Flash-X builds shared by every case
+#
+# Source this file from flashBuild.sh and call
+#
+#   flashBuildCache $NodeDir $AMREX2D_HOME
+#
+# The build key is a hash of the resolved FlashSha, uncommitted
+# changes in $FLASHX_HOME, normalized FlashOptions, site Makefile.h
+# and AMReX installation. The first setup with a key builds Flash-X
+# in its own object directory and git worktree at FlashSha, with the
+# uncommitted changes applied as git checkout would carry them over.
+# Untracked files are not part of the build. Later setups with the
+# same key wait on the lock and link flashx, setup_params and
+# amrex.pc from the cache. Set FLASHX_BUILD_CACHE to change the
+# cache directory
+
+# Print normalized build inputs, simulation name followed
+# by the remaining setup options in sorted order
+flashBuildInputs() {
+	local AMReXHome=$1
+
+	echo "FlashSha $(git -C $FLASHX_HOME rev-parse "$FlashSha^{commit}")"
+	echo "FlashDiff $(git -C $FLASHX_HOME diff --binary HEAD | sha256sum | awk '{print $1}')"
+	echo "FlashOptions $(echo $FlashOptions | awk '{print $1}') $(echo $FlashOptions | tr -s ' \t' '\n' | tail -n +2 | sort | tr '\n' ' ')"
+	echo "Makefile.h $(sha256sum $SiteHome/Makefile.h | awk '{print $1}')"
+	echo "amrex.pc $(sha256sum $AMReXHome/lib/pkgconfig/amrex.pc | awk '{print $1}')"
+	echo "libamrex $(ls -l --time-style=+%s $AMReXHome/lib/libamrex* 2>/dev/null | awk '{print $5, $6, $7}' | sha256sum | awk '{print $1}')"
+}
+
+# Link file into node directory, copy if the
+# cache is on a different file system
+flashBuildLink() {
+	ln -f $1 $2/ 2>/dev/null || cp $1 $2/
+}
+
+flashBuildCache() {
+	local NodeDir=$1
+	local AMReXHome=$2
+	local CacheDir=${FLASHX_BUILD_CACHE:-$PROJECT_HOME/software/flashx/cache}
+
+	mkdir -p $CacheDir
+
+	local BuildInputs=$(flashBuildInputs $AMReXHome)
+	local BuildKey=$(echo "$BuildInputs" | sha256sum | cut -c 1-16)
+	local BuildDir=$CacheDir/$BuildKey
+
+	echo Flash-X build key is $BuildKey
+
+	(
+		# hold lock for this key while building, concurrent
+		# setups with the same key wait for the build
+		flock 9
+
+		if [ ! -f $BuildDir/flashx ]; then
+
+			echo Building Flash-X in $BuildDir.partial
+			rm -rf $BuildDir.partial && mkdir -p $BuildDir.partial
+			echo "$BuildInputs" > $BuildDir.partial/inputs.txt
+
+			# git worktree metadata is shared by all keys
+			flock $CacheDir/worktree.lock git -C $FLASHX_HOME worktree add --detach $BuildDir.partial/source $FlashSha || exit 1
+			git -C $FLASHX_HOME diff --binary HEAD > $BuildDir.partial/source.diff
+
+			cd $BuildDir.partial/source && \
+			{ [ ! -s $BuildDir.partial/source.diff ] || git apply --binary $BuildDir.partial/source.diff; } > $BuildDir.partial/build.log 2>&1 && \
+			./setup $FlashOptions -objdir=$BuildDir.partial/object >> $BuildDir.partial/build.log 2>&1 && \
+			cd $BuildDir.partial/object && make -j >> $BuildDir.partial/build.log 2>&1 && \
+			cp flashx setup_params $BuildDir.partial/ && \
+			cp $AMReXHome/lib/pkgconfig/amrex.pc $BuildDir.partial/
+			BuildStatus=$?
+
+			flock $CacheDir/worktree.lock git -C $FLASHX_HOME worktree remove --force $BuildDir.partial/source
+			rm -rf $BuildDir.partial/object
+
+			if [ $BuildStatus -ne 0 ]; then
+				echo Flash-X build failed, see $BuildDir.partial/build.log
+				exit 1
+			fi
+
+			rm -rf $BuildDir && mv $BuildDir.partial $BuildDir
+		else
+			echo Using cached Flash-X build
+		fi
+
+	) 9>$CacheDir/$BuildKey.lock || return 1
+
+	flashBuildLink $BuildDir/flashx $NodeDir
+	flashBuildLink $BuildDir/setup_params $NodeDir
+	flashBuildLink $BuildDir/amrex.pc $NodeDir
+
+	cd $NodeDir
+}
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import subprocess
+import click
+
+# Launch command for a case as a function of number of ranks, placement
+# of ranks on hosts and target. jsrun places resource sets on free cores
+# of the allocation by itself, mpirun is given the hosts explicitly
+LAUNCHERS = {"jsrun": lambda ranks, placement, target: ["stdbuf", "-o0", "jsrun", "-n", str(ranks), "-a", "1",
+                                                         "-c", "1", "-b", "packed:1", "-d", "packed", target],
+             "mpirun": lambda ranks, placement, target: ["mpirun", "-np", str(ranks), "--host",
+                                                          ",".join(f"{host}:{count}" for host, count in
+                                                                   placement.items()), target]}
+
+def read_hostfile(filename, skip_first=True):
+    """
+    Read slots per host from a hostfile like LSB_DJOB_HOSTFILE with
+    one line per slot, lines of the form 'host N' or 'host slots=N'
+    are also accepted. The first line is the launch node of an LSF
+    allocation and is skipped if skip_first. Returns dictionary
+    of host to number of slots in order of appearance
+    """
+    with open(filename, "r") as hostfile:
+        lines = [line.split() for line in hostfile if line.strip() and not line.startswith("#")]
+
+    slots = {}
+    for fields in lines[1:] if skip_first else lines:
+        count = int(fields[1].replace("slots=", "")) if len(fields) > 1 else 1
+        slots[fields[0]] = slots.get(fields[0], 0) + count
+
+    if not slots:
+        raise ValueError(f"[packJobs.read_hostfile] No hosts found in {filename}")
+
+    return slots
+
+def parse_case(spec, ranks):
+    """
+    Parse case specification of the form directory[:ranks]
+    """
+    directory, _, case_ranks = spec.partition(":")
+
+    if not os.path.isdir(directory):
+        raise ValueError(f"[packJobs.parse_case] Case directory {directory} does not exist")
+
+    return {"case": directory, "ranks": int(case_ranks) if case_ranks else ranks}
+
+def place_case(ranks, free):
+    """
+    Place ranks on hosts with free slots. A case is placed on the
+    single host with the fewest free slots that fits it, otherwise
+    spread over hosts with the most free slots first. Returns
+    dictionary of host to ranks or None if ranks do not fit
+    """
+    fitting = [host for host in free if free[host] >= ranks]
+
+    if fitting:
+        return {min(fitting, key=lambda host: free[host]): ranks}
+
+    if sum(free.values()) < ranks:
+        return None
+
+    placement = {}
+    remaining = ranks
+    for host in sorted(free, key=lambda host: -free[host]):
+        if remaining == 0:
+            break
+        if free[host] > 0:
+            placement[host] = min(free[host], remaining)
+            remaining -= placement[host]
+
+    return placement
+
+def pack_cases(cases, slots, launcher="mpirun", target="./flashx", output="packJobs.out", poll=1.0):
+    """
+    Run cases concurrently inside one allocation. Cases are queued
+    largest first and every time slots are released the queue is
+    backfilled with the largest cases that fit the free slots.
+    Output of each case is written to output in the case directory and
+    variables in the optional env dictionary of a case are added to its
+    environment. Returns list of result records in order of completion
+    """
+    free = dict(slots)
+    origin = time.time()
+    queue = sorted(cases, key=lambda case: -case["ranks"])
+    running = []
+    results = []
+
+    for case in [case for case in queue if case["ranks"] > sum(slots.values())]:
+        print(f"Skipping {case['case']}, {case['ranks']} ranks exceed {sum(slots.values())} slots")
+        results.append({**case, "hosts": {}, "status": None, "start": 0.0, "elapsed": 0.0,
+                        "error": "does not fit allocation"})
+        queue.remove(case)
+
+    while queue or running:
+        for case in list(queue):
+            placement = place_case(case["ranks"], free)
+            if placement is None:
+                continue
+
+            queue.remove(case)
+            command = LAUNCHERS[launcher](case["ranks"], placement, target)
+
+            try:
+                with open(os.path.join(case["case"], output), "w") as outfile:
+                    process = subprocess.Popen(command, cwd=case["case"], stdout=outfile, stderr=subprocess.STDOUT,
+                                               env={**os.environ, **case.get("env", {})})
+            except OSError as error:
+                results.append({**case, "hosts": placement, "status": None, "start": time.time()-origin,
+                                "elapsed": 0.0, "error": str(error)})
+                print(f"Failed to launch {case['case']}: {error}")
+                continue
+
+            for host, count in placement.items():
+                free[host] -= count
+
+            print(f"Launched {case['case']} with {case['ranks']} ranks on "
+                  + ", ".join(f"{host}:{count}" for host, count in placement.items()))
+            running.append((case, placement, process, time.time()))
+
+        time.sleep(poll if running else 0)
+
+        for entry in list(running):
+            case, placement, process, start = entry
+            if process.poll() is None:
+                continue
+
+            running.remove(entry)
+            for host, count in placement.items():
+                free[host] += count
+
+            results.append({**case, "hosts": placement, "status": process.returncode, "start": start-origin,
+                            "elapsed": time.time()-start, "error": None})
+            print(f"Finished {case['case']} with exit status {process.returncode}")
+
+    return results
+
+def report(results, slots):
+    """
+    Print exit status and elapsed time of every case and the
+    fraction of allocated slot-seconds used by the cases
+    """
+    print(f"\n{'case':<48} {'ranks':>6} {'status':>8} {'elapsed':>10}")
+    for result in results:
+        status = result["error"] if result["status"] is None else result["status"]
+        print(f"{result['case']:<48} {result['ranks']:>6} {status!s:>8} {result['elapsed']:>9.1f}s")
+
+    used = sum(result["ranks"]*result["elapsed"] for result in results)
+    span = max([result["start"]+result["elapsed"] for result in results] + [0.0])
+    if span > 0:
+        print(f"\nWall time: {span:.1f}s, slot utilization: {used/(span*sum(slots.values())):.1%}")
+
+
+@click.command(name="packJobs")
+@click.argument("cases", nargs=-1, required=True)
+@click.option("--hostfile", "-f", default=lambda: os.getenv("LSB_DJOB_HOSTFILE"),
+              help="Hostfile of the allocation, defaults to LSB_DJOB_HOSTFILE")
+@click.option("--skip-first/--no-skip-first", default=True, help="Skip launch node on the first line of hostfile")
+@click.option("--launcher", "-l", type=click.Choice(list(LAUNCHERS)), default="jsrun", help="MPI launcher")
+@click.option("--ranks", "-n", type=int, default=1, help="Ranks of cases given without :ranks")
+@click.option("--target", "-t", default="./flashx", help="Executable run in every case directory")
+@click.option("--output", "-o", default="packJobs.out", help="Output file written in every case directory")
+@click.option("--poll", type=float, default=1.0, help="Seconds between checks for finished cases")
+@click.option("--results", "-r", help="Write per-case results to a JSON file")
+def pack(cases, hostfile, skip_first, launcher, ranks, target, output, poll, results):
+    """
+    \b
+    Run many small cases inside one allocation,
+    CASES are directories with optional rank counts
+    as directory:ranks, for example Case1/h40:16
+    """
+    if not hostfile:
+        raise ValueError("[packJobs.pack] Provide --hostfile or set LSB_DJOB_HOSTFILE")
+
+    slots = read_hostfile(hostfile, skip_first)
+    print(f"Packing {len(cases)} cases on {len(slots)} hosts with {sum(slots.values())} slots")
+
+    case_results = pack_cases([parse_case(spec, ranks) for spec in cases], slots, launcher, target, output, poll)
+    report(case_results, slots)
+
+    if results:
+        with open(results, "w") as resultfile:
+            json.dump(case_results, resultfile, indent=1)
+
+    if any(result["status"] != 0 for result in case_results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    pack()
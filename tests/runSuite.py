@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import glob
+import json
+import time
+import shlex
+import shutil
+import hashlib
+import subprocess
+import numpy
+import click
+
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../simulation"))
+import packJobs
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = os.path.join(TESTS_PATH, "runSuite.json")
+WORK_PATH = os.path.join(TESTS_PATH, "runSuite")
+SITE_NAME = "multiphase.simulations"
+
+# Options of a Tests.suite entry as (key, takes value), see Tests.suite
+SUITE_OPTIONS = {"--test": ("test", True), "-t": ("test", True),
+                 "--nprocs": ("nprocs", True), "-np": ("nprocs", True),
+                 "--env": ("env", True), "-e": ("env", True),
+                 "--debug": ("debug", False), "-debug": ("debug", False),
+                 "--cbase": ("cbase", True), "-cbase": ("cbase", True),
+                 "--rbase": ("rbase", True), "-rbase": ("rbase", True),
+                 "--tolerance": ("tolerance", True), "-tol": ("tolerance", True)}
+
+# Line written by Flash-X unit tests that pass
+UNITTEST_SUCCESS = "all results conformed with expected values"
+
+def parse_suite(filename):
+    """
+    Parse Tests.suite with one test per line, simulation
+    path followed by options, into a list of tests
+    """
+    tests = []
+
+    with open(filename, "r") as suitefile:
+        for line in suitefile:
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+
+            test = {"simulation": fields[0], "test": None, "nprocs": 1, "env": [], "debug": False,
+                    "cbase": None, "tolerance": 0.0}
+
+            options = iter(fields[1:])
+            for option in options:
+                if option not in SUITE_OPTIONS:
+                    raise ValueError(f"[runSuite.parse_suite] Unknown option {option} in {filename}")
+
+                key, takes_value = SUITE_OPTIONS[option]
+                value = next(options, None) if takes_value else True
+
+                if value is None:
+                    raise ValueError(f"[runSuite.parse_suite] Option {option} needs a value in {filename}")
+
+                if key == "rbase":
+                    raise ValueError(f"[runSuite.parse_suite] Restart comparison {option} is not supported, "
+                                     + f"found for {fields[0]} in {filename}")
+
+                if key == "env":
+                    test["env"].append(value)
+                else:
+                    test[key] = value
+
+            if test["test"] is None:
+                raise ValueError(f"[runSuite.parse_suite] Missing --test for {fields[0]} in {filename}")
+
+            test["nprocs"] = int(test["nprocs"])
+            test["tolerance"] = float(test["tolerance"])
+            test["name"] = f"{test['simulation']}:{test['test']}"
+            tests.append(test)
+
+    return tests
+
+def simulation_path(flashx_home):
+    """
+    Get path to simulations in Flash-X source tree
+    """
+    return os.path.join(flashx_home, "source", "Simulation", "SimulationMain")
+
+def read_test_spec(flashx_home, test):
+    """
+    Read setup options and parfile of a test from
+    tests/tests.toml in its simulation directory
+    """
+    filename = os.path.join(simulation_path(flashx_home), test["simulation"], "tests", "tests.toml")
+
+    with open(filename, "rb") as tomlfile:
+        spec = tomllib.load(tomlfile)
+
+    for node in test["test"].split("/"):
+        if node not in spec:
+            raise ValueError(f"[runSuite.read_test_spec] {test['test']} not found in {filename}")
+        spec = spec[node]
+
+    parfiles = spec.get("parfiles", "").replace("<pathToSimulations>", simulation_path(flashx_home)).split()
+
+    return {"setup_options": spec["setupOptions"] + (" -debug" if test["debug"] else ""),
+            "parfile": parfiles[0] if parfiles else os.path.join(simulation_path(flashx_home),
+                                                                 test["simulation"], "flash.par")}
+
+def digest(*items):
+    """
+    Get short sha256 digest of items
+    """
+    return hashlib.sha256("\n".join(str(item) for item in items).encode()).hexdigest()[:16]
+
+def file_digest(filename):
+    """
+    Get sha256 digest of file contents, None if file does not exist
+    """
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, "rb") as contents:
+        return hashlib.sha256(contents.read()).hexdigest()
+
+def source_version(flashx_home):
+    """
+    Get Flash-X commit and digest of uncommitted changes
+    """
+    sha = subprocess.run(["git", "-C", flashx_home, "rev-parse", "HEAD"],
+                         capture_output=True, text=True, check=True).stdout.strip()
+    changes = subprocess.run(["git", "-C", flashx_home, "diff", "HEAD"],
+                             capture_output=True, text=True, check=True).stdout
+
+    return sha, digest(changes) if changes else None
+
+def plan_suite(tests, flashx_home, site=SITE_NAME):
+    """
+    Add build key and run key to every test. The build key covers Flash-X
+    version, simulation, setup options and site Makefile.h so that tests
+    with the same setup share a build. The run key also covers parfile,
+    processes, environment, baseline and tolerance
+    """
+    version = source_version(flashx_home)
+    makefile = file_digest(os.path.join(flashx_home, "sites", site, "Makefile.h"))
+
+    for test in tests:
+        test.update(read_test_spec(flashx_home, test))
+        options = shlex.split(test["setup_options"])
+
+        test["build_key"] = digest(*version, makefile, test["simulation"], " ".join(sorted(options)))
+        test["run_key"] = digest(test["build_key"], file_digest(test["parfile"]), test["nprocs"],
+                                 sorted(test["env"]), test["cbase"], test["tolerance"])
+
+    return tests
+
+def build_simulation(build_dir, flashx_home, simulation, setup_options, site=SITE_NAME):
+    """
+    Setup and compile a simulation in build_dir, a build that
+    already exists is reused. Returns True if flashx is available
+    """
+    if os.path.exists(os.path.join(build_dir, "flashx")):
+        return True
+
+    object_dir = build_dir + ".partial"
+    shutil.rmtree(object_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(build_dir), exist_ok=True)
+
+    with open(build_dir + ".log", "w") as logfile:
+        status = subprocess.run(["./setup", simulation, *shlex.split(setup_options), f"-site={site}",
+                                 f"-objdir={object_dir}"], cwd=flashx_home, stdout=logfile,
+                                stderr=subprocess.STDOUT).returncode
+        if status == 0:
+            status = subprocess.run(["make", "-j"], cwd=object_dir, stdout=logfile,
+                                    stderr=subprocess.STDOUT).returncode
+
+    if status != 0 or not os.path.exists(os.path.join(object_dir, "flashx")):
+        return False
+
+    os.replace(object_dir, build_dir)
+    return True
+
+def prepare_run(run_dir, build_dir, parfile):
+    """
+    Create clean run directory with flashx and data files
+    linked from the build and parfile copied as flash.par
+    """
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+
+    datafiles = ["flashx"]
+    if os.path.exists(os.path.join(build_dir, "setup_datafiles")):
+        with open(os.path.join(build_dir, "setup_datafiles"), "r") as setupfile:
+            datafiles.extend(os.path.basename(line.strip()) for line in setupfile if line.strip())
+
+    for datafile in datafiles:
+        if os.path.exists(os.path.join(build_dir, datafile)):
+            os.symlink(os.path.join(build_dir, datafile), os.path.join(run_dir, datafile))
+
+    shutil.copy(parfile, os.path.join(run_dir, "flash.par"))
+
+def verify_test(test, run_dir, archive, sfocu, site=SITE_NAME):
+    """
+    Check result of a test run. Unit tests pass if every unitTest_* file
+    reports success, comparison tests compare the last checkpoint with
+    the same checkpoint of the -cbase baseline using sfocu. Returns
+    passed flag and message
+    """
+    if test["test"].startswith("UnitTest"):
+        unitfiles = glob.glob(os.path.join(run_dir, "unitTest_*"))
+        if not unitfiles:
+            return False, "no unitTest files"
+
+        for unitfile in unitfiles:
+            with open(unitfile, "r") as results:
+                if UNITTEST_SUCCESS not in results.read():
+                    return False, f"failed in {os.path.basename(unitfile)}"
+
+        return True, "unit test passed"
+
+    if not test["cbase"]:
+        return True, "run completed"
+
+    checkpoints = sorted(glob.glob(os.path.join(run_dir, "*_chk_*")))
+    if not checkpoints:
+        return False, "no checkpoint"
+
+    baseline = os.path.join(archive, site, test["test"], test["cbase"], os.path.basename(checkpoints[-1]))
+    if not os.path.exists(baseline):
+        return False, f"missing baseline {baseline}"
+
+    command = [sfocu] + (["-t", str(test["tolerance"])] if test["tolerance"] else []) + [checkpoints[-1], baseline]
+    result = subprocess.run(command, capture_output=True, text=True, check=False)
+
+    with open(os.path.join(run_dir, "sfocu.out"), "w") as sfocufile:
+        sfocufile.write(result.stdout + result.stderr)
+
+    return "SUCCESS" in result.stdout, "sfocu " + ("passed" if "SUCCESS" in result.stdout else "failed")
+
+def read_state(filename):
+    """
+    Read state of previous runs, test name to run key of
+    the last run, passed flag and history of runs
+    """
+    if not os.path.exists(filename):
+        return {}
+
+    with open(filename, "r") as statefile:
+        return json.load(statefile)
+
+def write_state(state, filename):
+    """
+    Write state of runs
+    """
+    with open(filename + ".tmp", "w") as statefile:
+        json.dump(state, statefile, indent=1)
+    os.replace(filename + ".tmp", filename)
+
+def timing_trend(history, elapsed):
+    """
+    Get median elapsed time of previous passing runs and change of
+    elapsed relative to it, None for values that are not available
+    """
+    previous = [entry["elapsed"] for entry in history if entry["passed"]]
+
+    if not previous:
+        return None, None
+
+    median = float(numpy.median(previous))
+    return median, None if elapsed is None else elapsed/median - 1
+
+def run_suite(suite, flashx_home, archive, cores, sfocu, site=SITE_NAME, workdir=WORK_PATH,
+              state_file=STATE_FILE, force=False, dry_run=False, history_length=20):
+    """
+    Run tests of a suite concurrently on cores. Tests that passed with the
+    same run key before are skipped, every distinct build key is compiled
+    once and tests are packed by number of processes onto cores with
+    backfill. Returns list of (test, status, elapsed, message), with
+    status pending for tests that would run if dry_run is True
+    """
+    tests = plan_suite(parse_suite(suite), flashx_home, site)
+    state = read_state(state_file)
+
+    pending = [test for test in tests if force or not (state.get(test["name"], {}).get("run_key") == test["run_key"]
+                                                       and state[test["name"]]["passed"])]
+    builds = sorted(set(test["build_key"] for test in pending))
+
+    for test in tests:
+        print(f"{'run' if test in pending else 'skip':<5} {test['name']:<72} np={test['nprocs']:<3} "
+              + f"build={test['build_key']}")
+    print(f"{len(pending)} of {len(tests)} tests to run with {len(builds)} builds on {cores} cores")
+
+    results = {test["name"]: (test, "skipped", None, "unchanged since last passing run")
+               for test in tests if test not in pending}
+
+    if dry_run or not pending:
+        results.update({test["name"]: (test, "pending", None, "would run") for test in pending})
+        return [results[test["name"]] for test in tests]
+
+    built = {}
+    for build_key in builds:
+        test = next(test for test in pending if test["build_key"] == build_key)
+        print(f"Building {test['simulation']} with {test['setup_options']}")
+        built[build_key] = build_simulation(os.path.join(workdir, "builds", build_key), flashx_home,
+                                            test["simulation"], test["setup_options"], site)
+
+    cases = []
+    for test in pending:
+        if not built[test["build_key"]]:
+            results[test["name"]] = (test, "failed", None, f"build failed, see builds/{test['build_key']}.log")
+            continue
+
+        if test["nprocs"] > cores:
+            results[test["name"]] = (test, "failed", None, f"needs {test['nprocs']} of {cores} cores")
+            continue
+
+        run_dir = os.path.join(workdir, "runs", digest(test["name"]))
+        prepare_run(run_dir, os.path.join(workdir, "builds", test["build_key"]), test["parfile"])
+        cases.append({"case": run_dir, "ranks": test["nprocs"], "test": test,
+                      "env": dict(variable.split("=", 1) for variable in test["env"])})
+
+    for record in packJobs.pack_cases(cases, {"localhost": cores}, "mpirun", "./flashx", output="test.out", poll=0.5):
+        test = record["test"]
+
+        if record["status"] != 0:
+            passed, message = False, record["error"] or f"exit status {record['status']}"
+        else:
+            passed, message = verify_test(test, record["case"], archive, sfocu, site)
+
+        results[test["name"]] = (test, "passed" if passed else "failed", record["elapsed"], message)
+
+        entry = state.setdefault(test["name"], {"history": []})
+        entry.update({"run_key": test["run_key"], "passed": passed})
+        entry["history"] = (entry["history"] + [{"date": time.strftime("%Y-%m-%dT%H:%M:%S"), "run_key": test["run_key"],
+                                                  "elapsed": record["elapsed"], "passed": passed}])[-history_length:]
+
+    write_state(state, state_file)
+
+    return [results[test["name"]] for test in tests]
+
+def report(results, state_file=STATE_FILE):
+    """
+    Print status, elapsed time and change of elapsed time
+    against the median of previous passing runs for every test.
+    Only tests that ran, which have elapsed time, added their
+    run to the history, so only they exclude its last entry
+    """
+    state = read_state(state_file)
+
+    print(f"\n{'test':<72} {'status':<8} {'elapsed':>9} {'median':>9} {'change':>8}  message")
+    for test, status, elapsed, message in results:
+        history = state.get(test["name"], {}).get("history", [])
+        median, change = timing_trend(history[:-1] if elapsed is not None else history, elapsed)
+
+        print(f"{test['name']:<72} {status:<8} "
+              + (f"{elapsed:8.1f}s " if elapsed is not None else f"{'-':>9} ")
+              + (f"{median:8.1f}s " if median is not None else f"{'-':>9} ")
+              + (f"{change:+7.1%}  " if change is not None else f"{'-':>8}  ")
+              + message)
+
+
+@click.command(name="runSuite")
+@click.option("--suite", "-s", default=os.path.join(TESTS_PATH, "Tests.suite"), help="Test suite file")
+@click.option("--cores", "-c", type=int, default=os.cpu_count(), help="Cores available for tests")
+@click.option("--site", default=SITE_NAME, help="Flash-X site used for builds and baselines")
+@click.option("--sfocu", default=None, help="Path to sfocu, defaults to $FLASHX_HOME/tools/sfocu/sfocu")
+@click.option("--force", "-f", is_flag=True, help="Run tests that passed before with the same inputs")
+@click.option("--dry-run", is_flag=True, help="Only show which tests would run")
+def run(suite, cores, site, sfocu, force, dry_run):
+    """
+    \b
+    Run Tests.suite concurrently, sharing builds and
+    skipping tests unchanged since their last passing run
+    """
+    flashx_home = os.getenv("FLASHX_HOME")
+    if not flashx_home:
+        raise ValueError("[runSuite.run] FLASHX_HOME is not set, source environment.sh")
+
+    archive = os.getenv("FLASHTEST_MAIN_ARCHIVE", os.path.join(TESTS_PATH, "MainArchive"))
+    sfocu = sfocu or os.path.join(flashx_home, "tools", "sfocu", "sfocu")
+
+    results = run_suite(suite, flashx_home, archive, cores, sfocu, site, force=force, dry_run=dry_run)
+    report(results)
+
+    if any(status == "failed" for _, status, _, _ in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    run()